@@ -150,6 +150,25 @@ DATACITE_PASSWORD = os.environ.get('DATACITE_PASSWORD', None)
 DATACITE_DOI_URL = 'http://search.datacite.org/works'
 DOI_BASE_URL = 'http://arapheno.1001genomes.org'
 
+# On-disk cache of the study value matrices shared by all workers (empty to disable)
+STUDY_MATRIX_CACHE_DIR = os.environ.get('STUDY_MATRIX_CACHE_DIR', '/tmp/arapheno/study_matrices')
+STUDY_MATRIX_CACHE_MAX_BYTES = int(os.environ.get('STUDY_MATRIX_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+
+# Memory-mapped rnaseq x obs_unit value matrices of the RNASeq studies (empty to read the values from the database)
+RNASEQ_MATRIX_DIR = os.environ.get('RNASEQ_MATRIX_DIR', '/tmp/arapheno/rnaseq_matrices')
+
+# On-disk cache of the ISA-TAB archives of the studies (empty to build them on every download)
+ISATAB_CACHE_DIR = os.environ.get('ISATAB_CACHE_DIR', '/tmp/arapheno/isatab')
+
+# Cache-Control max-age of the responses of published studies, phenotypes and rnaseqs (see phenotypedb.conditional)
+PUBLISHED_MAX_AGE = int(os.environ.get('PUBLISHED_MAX_AGE', 24 * 60 * 60))
+
+# Size of the per worker cache of phenotype correlation results
+CORRELATION_CACHE_MAX_BYTES = int(os.environ.get('CORRELATION_CACHE_MAX_BYTES', 64 * 1024 ** 2))
+
+# Size of the per worker cache of co-expression neighbours
+COEXPRESSION_CACHE_MAX_BYTES = int(os.environ.get('COEXPRESSION_CACHE_MAX_BYTES', 16 * 1024 ** 2))
+
 
 LOGGING = {
     'version': 1,
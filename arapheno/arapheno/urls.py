@@ -120,8 +120,11 @@ restpatterns = [
 
     url(r'^rest/phenotype/(?P<q>%s)/transformations/(?P<transformation>%s)/$' % (REGEX_PHENOTYPE, REGEX_TRANSFORMATIONS ), rest.transformations),
 
-    url(r'^rest/phenotype/(?P<q>%s)/values/$' % REGEX_PHENOTYPE, rest.phenotype_value),
+    url(r'^rest/phenotype/(?P<q>%s)/values/$' % REGEX_PHENOTYPE, rest.phenotype_value, name='phenotype_values'),
+    url(r'^rest/phenotype/(?P<q>%s)/statistics/$' % REGEX_PHENOTYPE, rest.phenotype_statistics),
+    url(r'^rest/phenotype/(?P<q>%s)/summary/$' % REGEX_PHENOTYPE, rest.phenotype_summary),
     url(r'^rest/phenotype/(?P<q>%s)/similar/$' % REGEX_PHENOTYPE, rest.phenotype_similar_list),
+    url(r'^rest/phenotype/(?P<q>%s)/association/(?P<study_id>%s)/$' % (REGEX_PHENOTYPE, ID_REGEX), rest.phenotype_rnaseq_association),
 
     url(r'^rest/study/list/$', rest.study_list),
     url(r'^rest/study/(?P<q>%s)/$' % REGEX_STUDY, rest.study_detail),
@@ -157,7 +160,17 @@ restpatterns = [
 
     url(r'^rest/rnaseq/(?P<study_id>%s)/(?P<gene_id>%s)/values/$' % (ID_REGEX, rest.GENEID_REGEX), rest.rnaseq_value_by_gene_id),
 
-    url(r'^rest/rnaseq/(?P<q>%s)/values/$' % REGEX_PHENOTYPE, rest.rnaseq_value),
+    url(r'^rest/rnaseq/(?P<study_id>%s)/(?P<gene_id>%s)/coexpression/$' % (ID_REGEX, rest.GENEID_REGEX), rest.rnaseq_coexpression),
+
+    url(r'^rest/rnaseq/(?P<study_id>%s)/genes/values/$' % ID_REGEX, rest.rnaseq_gene_matrix),
+
+    url(r'^rest/rnaseq/gene/(?P<gene_id>%s)/values/$' % rest.GENEID_REGEX, rest.rnaseq_gene_values),
+
+    url(r'^rest/rnaseq/(?P<q>%s)/values/$' % REGEX_PHENOTYPE, rest.rnaseq_value, name='rnaseq_values'),
+
+    url(r'^rest/rnaseq/(?P<q>%s)/statistics/$' % REGEX_PHENOTYPE, rest.rnaseq_statistics),
+
+    url(r'^rest/rnaseq/(?P<q>%s)/summary/$' % REGEX_PHENOTYPE, rest.rnaseq_summary),
 
 ]
 #extend restpatterns with suffix options
@@ -4,16 +4,68 @@ Autocomplete Light Registry for global search
 from autocomplete_light import shortcuts as autocomplete_light
 from phenotypedb.models import Accession, Phenotype, Study, OntologyTerm, RNASeq
 from django.db.models import Count
+from django.db.models.functions import Length
+from utils.autocomplete import PrefixIndex, get_index
 
 
-class GlobalSearchAutocomplete(autocomplete_light.AutocompleteGenericBase):
+class IndexedAutocompleteMixin(object):
+    """
+    Renders the suggestions from the in-memory prefix index of the worker process
+    instead of querying the choices on every keystroke.
+    The first queried_choices choices are too large to be kept in memory
+    and are queried with query_choices instead
+    """
+    queried_choices = 0
+
+    def autocomplete_html(self):
+        query = self.request.GET.get('q', '').strip()
+        if not query:
+            return u""
+        suggestions = []
+        for entity in range(self.queried_choices):
+            # the limit is divided among the choices like in AutocompleteGenericBase
+            limit = (self.limit_choices - len(suggestions)) // (len(self.choices) - entity)
+            suggestions.extend(self.choice_link(choice) for choice in self.query_choices(entity, query, limit))
+        index = get_index(type(self).__name__, self.build_index)
+        suggestions.extend(suggestion.html for suggestion in
+                           index.suggest(query, self.limit_choices - len(suggestions)))
+        return u"".join(suggestions)
+
+    def query_choices(self, entity, query, limit):
+        """Returns the choices of a queried entity whose name starts with the query, shortest first"""
+        queryset = self.choices[entity].filter(name__istartswith=query)
+        return queryset.order_by(Length('name').asc(), 'name', 'id')[:limit]
+
+    def build_index(self):
+        """Builds the prefix index of the rendered choices and their search fields"""
+        entries = []
+        entities = range(self.queried_choices, len(self.choices))
+        for entity in entities:
+            search_fields = self.search_fields[entity]
+            for choice in self.choices[entity].all().iterator():
+                fields = [_lookup(choice, search_field) for search_field in search_fields]
+                entries.append((entity, fields[0], fields, self.choice_link(choice)))
+        return PrefixIndex(entries, entities)
+
+
+def _lookup(choice, search_field):
+    """Returns the value of a search field like to_term__name of a choice"""
+    value = choice
+    for attribute in search_field.split('__'):
+        value = getattr(value, attribute, None)
+        if value is None:
+            return None
+    return value
+
+
+class GlobalSearchAutocomplete(IndexedAutocompleteMixin, autocomplete_light.AutocompleteGenericBase):
     """
     Global search autocomplete configuration class
     """
-    choices = (Phenotype.objects.published(),
+    choices = (Phenotype.objects.published().select_related('to_term'),
                Study.objects.published(),
                Accession.objects.all(),
-               OntologyTerm.objects.all())
+               OntologyTerm.objects.select_related('source'))
     search_fields = (('name', 'to_term__id', 'to_term__name',), #phenotype search field
                      ('name',), #study search field
                      ('name',), #Accession search field
@@ -32,30 +84,30 @@ class GlobalSearchAutocomplete(autocomplete_light.AutocompleteGenericBase):
     def choice_html(self, choice):
         return self.choice_html_format % (self.choice_value(choice), self.choice_label(choice))
 
-    #Render Autocomplete HTML for different search results
-    def autocomplete_html(self):
-        html = ""
-        for choice in self.choices_for_request():
-            if isinstance(choice, Phenotype):
-                html += ("<a href='phenotype/%d'>%s</a>" % (choice.id, self.choice_html(choice)))
-            elif isinstance(choice, Study):
-                html += ("<a href='study/%d'>%s</a>" % (choice.id, self.choice_html(choice)))
-            elif isinstance(choice, Accession):
-                html += ("<a href='accession/%d'>%s</a>" % (choice.id, self.choice_html(choice)))
-            elif isinstance(choice, OntologyTerm):
-                html += ("<a href='ontology/%s/%s'>%s</a>" % (choice.source.acronym,choice.id, self.choice_html(choice)))
-        return html
+    #Render Link for different search results
+    def choice_link(self, choice):
+        if isinstance(choice, Phenotype):
+            return "<a href='phenotype/%d'>%s</a>" % (choice.id, self.choice_html(choice))
+        elif isinstance(choice, Study):
+            return "<a href='study/%d'>%s</a>" % (choice.id, self.choice_html(choice))
+        elif isinstance(choice, Accession):
+            return "<a href='accession/%d'>%s</a>" % (choice.id, self.choice_html(choice))
+        elif isinstance(choice, OntologyTerm):
+            return "<a href='ontology/%s/%s'>%s</a>" % (choice.source.acronym,choice.id, self.choice_html(choice))
+        return ""
 
 autocomplete_light.register(GlobalSearchAutocomplete)
 
-class RNASeqGlobalSearchAutocomplete(autocomplete_light.AutocompleteGenericBase):
+class RNASeqGlobalSearchAutocomplete(IndexedAutocompleteMixin, autocomplete_light.AutocompleteGenericBase):
     """
     Global search autocomplete configuration class
     """
     studies = Study.objects.published().annotate(pheno_count=Count('phenotype')).annotate(rna_count=Count('rnaseq'))
     studies = studies.filter(pheno_count=0).filter(rna_count__gt=0)
 
-    choices = (RNASeq.objects.all(),
+    # there are too many rnaseqs to index them in every worker, see the rnaseq name index (migration 0031)
+    queried_choices = 1
+    choices = (RNASeq.objects.only('id', 'name'),
                studies,
                Accession.objects.all(),)
     search_fields = (('name',), #rnaseq search field
@@ -75,16 +127,14 @@ class RNASeqGlobalSearchAutocomplete(autocomplete_light.AutocompleteGenericBase)
     def choice_html(self, choice):
         return self.choice_html_format % (self.choice_value(choice), self.choice_label(choice))
 
-    #Render Autocomplete HTML for different search results
-    def autocomplete_html(self):
-        html = ""
-        for choice in self.choices_for_request():
-            if isinstance(choice, RNASeq):
-                html += ("<a href='/rnaseq/%d'>%s</a>" % (choice.id, self.choice_html(choice)))
-            elif isinstance(choice, Study):
-                html += ("<a href='/study/%d'>%s</a>" % (choice.id, self.choice_html(choice)))
-            elif isinstance(choice, Accession):
-                html += ("<a href='/accession/%d'>%s</a>" % (choice.id, self.choice_html(choice)))
-        return html
+    #Render Link for different search results
+    def choice_link(self, choice):
+        if isinstance(choice, RNASeq):
+            return "<a href='/rnaseq/%d'>%s</a>" % (choice.id, self.choice_html(choice))
+        elif isinstance(choice, Study):
+            return "<a href='/study/%d'>%s</a>" % (choice.id, self.choice_html(choice))
+        elif isinstance(choice, Accession):
+            return "<a href='/accession/%d'>%s</a>" % (choice.id, self.choice_html(choice))
+        return ""
 
 autocomplete_light.register(RNASeqGlobalSearchAutocomplete)
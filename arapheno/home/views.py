@@ -4,8 +4,10 @@ from django.db.models import Q
 
 from forms import GlobalSearchForm, RNASeqGlobalSearchForm
 
+from phenotypedb.conditional import conditional, data_validators
 from phenotypedb.models import Study, Phenotype, Accession, OntologyTerm, RNASeq
-from phenotypedb.tables import PhenotypeTable, StudyTable, AccessionTable, OntologyTermTable, RNASeqTable, RNASeqStudyTable
+from phenotypedb.tables import PhenotypeTable, StudyTable, AccessionTable, OntologyTermTable, RNASeqTable, RNASeqStudyTable, RankedTableData
+from utils.search import RankedResults, get_querysets, search
 
 from django.db.models import Count
 from django_tables2 import RequestConfig
@@ -13,6 +15,7 @@ from django_tables2 import RequestConfig
 '''
 Home View of AraPheno
 '''
+@conditional(data_validators, private=True)
 def home(request):
     search_form = GlobalSearchForm()
     if "global_search-autocomplete" in request.POST:
@@ -26,6 +29,7 @@ def home(request):
     stats['last_update'] = Study.objects.all().order_by("-update_date")[0].update_date.strftime('%b/%d/%Y') if stats['studies'] > 0 else 'N/A'
     return render(request,'home/home.html',{"search_form":search_form,"stats":stats, 'is_rnaseq': False})
 
+@conditional(data_validators, private=True)
 def home_rnaseq(request):
     search_form = RNASeqGlobalSearchForm()
     if "rnaseq_global_search-autocomplete" in request.POST:
@@ -90,50 +94,45 @@ def faqissue(request):
 '''
 Search Result View for Global Search in AraPheno
 '''
+@conditional(data_validators, private=True)
 def SearchResults(request,query=None):
+    results = search(query)
+    querysets = get_querysets()
     if query==None:
-        phenotypes = Phenotype.objects.published().all()
-        studies = Study.objects.published().all()
-        accessions = Accession.objects.all()
-        ontologies = OntologyTerm.objects.all()
         download_url = "/rest/search"
     else:
-        phenotypes = Phenotype.objects.published().filter(Q(name__icontains=query) |
-                                              Q(to_term__id__icontains=query) |
-                                              Q(to_term__name__icontains=query))
-        studies = Study.objects.published().filter(name__icontains=query)
-        accessions = Accession.objects.filter(name__icontains=query)
-        ontologies = OntologyTerm.objects.filter(name__icontains=query)
         download_url = "/rest/search/" + str(query)
 
-    phenotype_table = PhenotypeTable(phenotypes,order_by="-name")
+    # the results are ranked, so the tables can not be sorted
+    phenotype_table = PhenotypeTable(RankedTableData(RankedResults(querysets['phenotype'], results['phenotype'])),orderable=False)
     RequestConfig(request,paginate={"per_page":10}).configure(phenotype_table)
 
-    study_table = StudyTable(studies,order_by="-name")
+    study_table = StudyTable(RankedTableData(RankedResults(querysets['study'], results['study'])),orderable=False)
     RequestConfig(request,paginate={"per_page":10}).configure(study_table)
 
-    accession_table = AccessionTable(accessions,order_by="-name")
+    accession_table = AccessionTable(RankedTableData(RankedResults(querysets['accession'], results['accession'])),orderable=False)
     RequestConfig(request,paginate={"per_page":10}).configure(accession_table)
 
-    ontologies_table = OntologyTermTable(ontologies,order_by="-name")
+    ontologies_table = OntologyTermTable(RankedTableData(RankedResults(querysets['ontology'], results['ontology'])),orderable=False)
     RequestConfig(request,paginate={"per_page":10}).configure(ontologies_table)
 
     variable_dict = {}
     variable_dict['query'] = query
-    variable_dict['nphenotypes'] = phenotypes.count()
+    variable_dict['nphenotypes'] = len(results['phenotype'])
     variable_dict['phenotype_table'] = phenotype_table
     variable_dict['accession_table'] = accession_table
     variable_dict['ontologies_table'] = ontologies_table
     variable_dict['study_table'] = study_table
 
-    variable_dict['nstudies'] = studies.count()
-    variable_dict['naccessions'] = accessions.count()
-    variable_dict['nontologies'] = ontologies.count()
+    variable_dict['nstudies'] = len(results['study'])
+    variable_dict['naccessions'] = len(results['accession'])
+    variable_dict['nontologies'] = len(results['ontology'])
     variable_dict['download_url'] = download_url
 
     return render(request,'home/search_results.html',variable_dict)
 
 # RNASeq search
+@conditional(data_validators, private=True)
 def SearchResultsRNASeq(request,query=None):
     studies = Study.objects.published().annotate(pheno_count=Count('phenotype')).annotate(rna_count=Count('rnaseq'))
     studies = studies.filter(pheno_count=0).filter(rna_count__gt=0)
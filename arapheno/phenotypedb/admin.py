@@ -4,6 +4,7 @@ from phenotypedb.models import Submission, Study, Phenotype, Curation, StudyCura
 from django.core.mail import EmailMessage
 from django.conf import settings
 from utils.datacite import submit_submission_to_datacite
+from utils.precompute import precompute_study
 from django.contrib.messages import INFO,WARNING, ERROR
 from models import PUBLISHED
 
@@ -28,6 +29,8 @@ class SubmissionAdmin(admin.ModelAdmin):
 
     def save_model(self, request, obj, form, change):
         super(SubmissionAdmin, self).save_model(request, obj, form, change)
+        if change and 'status' in form.changed_data and obj.status == PUBLISHED:
+            precompute_study(obj.study)
         if change and 'status' in form.changed_data:
             email = EmailMessage(
                     obj.get_email_subject(),
@@ -0,0 +1,155 @@
+"""
+HTTP validators for the read views.
+The ETag and Last-Modified of a response are derived from the update_date of the study,
+phenotype or rnaseq that the view reads (or from the global DataVersion counter for views
+that read across studies), so conditional GET requests (If-None-Match/If-Modified-Since)
+are answered with 304 Not Modified before the view evaluates any queryset. The update_date
+of a study and the data version also change with its phenotypes, rnaseqs and values
+(see models.touch_study) and the data version with the accessions and ontology terms.
+Responses of published data may be cached for settings.PUBLISHED_MAX_AGE seconds,
+all other responses have to be revalidated
+"""
+import calendar
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from phenotypedb import __build__, __githash__
+from phenotypedb.models import PUBLISHED, DataVersion, Phenotype, RNASeq, Study
+
+
+class Validators(object):
+    """
+    Version key and last modification date of the data of a response and the seconds
+    a response may be used without revalidation (None to always revalidate)
+    """
+
+    def __init__(self, key, last_modified=None, max_age=None):
+        self.key = key
+        self.last_modified = last_modified
+        self.max_age = max_age
+
+
+def conditional(resolver, private=False):
+    """
+    Decorator for read views that sends the ETag and Last-Modified of the Validators
+    returned by resolver(**view_kwargs) and answers conditional GET and HEAD requests
+    with 304 before the view is called. Views that render per user content (HTML pages)
+    must be private, so that the user and the CSRF cookie are part of the ETag
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(request, *args, **kwargs)
+            validators = resolver(**kwargs)
+            if validators is None:
+                # the view returns the 404
+                return view(request, *args, **kwargs)
+            etag = _get_etag(request, validators, private)
+            last_modified = _timestamp(validators.last_modified)
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                response = view(request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                _set_headers(response, etag, last_modified, validators, private)
+            return response
+        return wrapper
+    return decorator
+
+
+def study_validators(q=None, study_id=None, pk=None, **kwargs):
+    """Returns the Validators of a study by id or DOI or None if it does not exist"""
+    study_id = _parse_id(q or study_id or pk)
+    if study_id is None:
+        return None
+    rows = list(Study.objects.filter(pk=study_id).values_list('update_date', 'submission__status')[:1])
+    if not rows:
+        return None
+    update_date, status = rows[0]
+    return Validators(('study', study_id, _format_date(update_date), status), update_date, _get_max_age(status))
+
+
+def phenotype_validators(q=None, pk=None, **kwargs):
+    """Returns the Validators of a phenotype and its study or None if it does not exist"""
+    return _variable_validators(Phenotype, 'phenotype', q or pk)
+
+
+def rnaseq_validators(q=None, pk=None, **kwargs):
+    """Returns the Validators of a rnaseq and its study or None if it does not exist"""
+    return _variable_validators(RNASeq, 'rnaseq', q or pk)
+
+
+def data_validators(**kwargs):
+    """
+    Returns the Validators of views that read across studies (lists, search, accessions, ontologies).
+    They change with the global data version, which has no date, so there is no Last-Modified
+    and the responses are always revalidated
+    """
+    return Validators(('data', DataVersion.get_version(DataVersion.DATA)))
+
+
+def _variable_validators(model, kind, q):
+    variable_id = _parse_id(q)
+    if variable_id is None:
+        return None
+    rows = list(model.objects.filter(pk=variable_id).values_list(
+        'update_date', 'study_id', 'study__update_date', 'study__submission__status')[:1])
+    if not rows:
+        return None
+    update_date, study_id, study_update_date, status = rows[0]
+    dates = [date for date in (update_date, study_update_date) if date is not None]
+    return Validators((kind, variable_id, _format_date(update_date), study_id, _format_date(study_update_date), status),
+                      max(dates) if dates else None, _get_max_age(status))
+
+
+def _get_etag(request, validators, private):
+    # the representation depends on the URL (format, paging, parameters), the Accept header
+    # and the deployed code
+    key = [validators.key, request.get_full_path(), request.META.get('HTTP_ACCEPT'), __githash__, __build__]
+    if private:
+        key.extend([request.user.pk, request.COOKIES.get(settings.CSRF_COOKIE_NAME)])
+    return quote_etag(hashlib.md5(repr(key)).hexdigest())
+
+
+def _set_headers(response, etag, last_modified, validators, private):
+    if not response.has_header('ETag'):
+        response['ETag'] = etag
+    if last_modified is not None and not response.has_header('Last-Modified'):
+        response['Last-Modified'] = http_date(last_modified)
+    if private:
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ('Cookie',))
+    elif validators.max_age:
+        patch_cache_control(response, public=True, max_age=validators.max_age)
+    else:
+        # cached copies have to be revalidated
+        patch_cache_control(response, public=True, no_cache=True)
+    patch_vary_headers(response, ('Accept',))
+
+
+def _get_max_age(status):
+    if status != PUBLISHED:
+        return None
+    return getattr(settings, 'PUBLISHED_MAX_AGE', None)
+
+
+def _parse_id(q):
+    """Returns the primary key of an id or a DOI (<prefix>/study:<id>) or None"""
+    try:
+        return int(str(q).split(':')[-1])
+    except (TypeError, ValueError):
+        return None
+
+
+def _timestamp(date):
+    if date is None:
+        return None
+    return calendar.timegm(date.utctimetuple())
+
+
+def _format_date(date):
+    return None if date is None else date.isoformat()
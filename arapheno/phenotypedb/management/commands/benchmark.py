@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from utils.benchmarks import BENCHMARKS, run
+
+
+class Command(BaseCommand):
+    help = 'Run a benchmark of the data processing code paths on synthetic data'
+
+    def add_arguments(self, parser):
+        parser.add_argument('name', choices=sorted(BENCHMARKS.keys()))
+
+    def handle(self, *args, **options):
+        name = options['name']
+        try:
+            results = run(name)
+        except Exception as err:
+            raise CommandError('Error running benchmark. Reason: %s' % str(err))
+        self.stdout.write('%-50s %12s %14s' % ('benchmark', 'wall time (s)', 'peak mem (MB)'))
+        for label, elapsed, peak in results:
+            self.stdout.write('%-50s %12.3f %14.1f' % (label, elapsed, peak))
+        self.stdout.write(self.style.SUCCESS('Successfully ran benchmark "%s"' % name))
@@ -0,0 +1,19 @@
+"""
+Command Line function to rebuild the gene index of the RNASeqs
+"""
+from django.core.management.base import BaseCommand, CommandError
+from utils.gene_index import rebuild_gene_index
+
+
+class Command(BaseCommand):
+    """
+    Command to rebuild the index of the RNASeqs of all studies by gene id
+    """
+    help = 'Rebuild the index of the RNASeqs of all studies by gene id'
+
+    def handle(self, *args, **options):
+        try:
+            count = rebuild_gene_index()
+        except Exception as err:
+            raise CommandError('Error building gene index. Reason: %s' % str(err))
+        self.stdout.write(self.style.SUCCESS('Successfully indexed %s RNASeqs' % count))
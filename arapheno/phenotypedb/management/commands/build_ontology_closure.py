@@ -0,0 +1,19 @@
+"""
+Command Line function to rebuild the ontology closure table
+"""
+from django.core.management.base import BaseCommand, CommandError
+from utils.ontology import build_closure
+
+
+class Command(BaseCommand):
+    """
+    Command to rebuild the closure table of the ontology term hierarchies
+    """
+    help = 'Rebuild the closure table of the ancestors and descendants of all ontology terms'
+
+    def handle(self, *args, **options):
+        try:
+            count = build_closure()
+        except Exception as err:
+            raise CommandError('Error building ontology closure. Reason: %s' % str(err))
+        self.stdout.write(self.style.SUCCESS('Successfully stored %s ancestor/descendant pairs' % count))
@@ -0,0 +1,19 @@
+"""
+Command Line function to rebuild the search index
+"""
+from django.core.management.base import BaseCommand, CommandError
+from utils.search import rebuild_index
+
+
+class Command(BaseCommand):
+    """
+    Command to rebuild the search index of the published phenotypes and studies, accessions and ontology terms
+    """
+    help = 'Rebuild the search index of the published phenotypes and studies, accessions and ontology terms'
+
+    def handle(self, *args, **options):
+        try:
+            count = rebuild_index()
+        except Exception as err:
+            raise CommandError('Error building search index. Reason: %s' % str(err))
+        self.stdout.write(self.style.SUCCESS('Successfully indexed %s entries' % count))
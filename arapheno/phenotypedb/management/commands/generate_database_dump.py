@@ -1,16 +1,23 @@
-import os, csv
 from django.core.management.base import BaseCommand, CommandError
-from phenotypedb.rest import generate_database_dump
-from django.db import transaction
+from utils.dump import generate_database_dump
 
 
 class Command(BaseCommand):
     help = 'Generate database dump for download'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--processes',
+                            type=int,
+                            default=None,
+                            help='Specify the number of processes (default: number of CPUs)')
+        parser.add_argument('--force',
+                            default=False,
+                            action='store_true',
+                            help='Render all studies again instead of only the changed ones')
 
     def handle(self, *args, **options):
         try:
-            generate_database_dump()
+            generate_database_dump(options['processes'], options['force'])
         except Exception as err:
             raise CommandError('Error generating database dump: %s' % str(err))
-        self.stdout.write(self.style.SUCCESS('Successfully generated database dump'))
\ No newline at end of file
+        self.stdout.write(self.style.SUCCESS('Successfully generated database dump'))
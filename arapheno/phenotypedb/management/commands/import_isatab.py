@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand, CommandError
 from utils.isa_tab import parse_isatab, save_isatab
+from utils.precompute import precompute_study
 
 
 class Command(BaseCommand):
@@ -13,6 +14,8 @@ class Command(BaseCommand):
         try:
             isatab  = parse_isatab(filename)
             studies = save_isatab(isatab)
+            for study in studies:
+                precompute_study(study)
         except Exception as err:
             raise CommandError('Error importing ISA-TAB file. Reason: %s' % str(err))
         self.stdout.write(self.style.SUCCESS('Successfully imported ISA-TAB archive "%s" under following id %s' % (filename,studies)))
\ No newline at end of file
@@ -3,24 +3,27 @@ from phenotypedb.models import Study,RNASeq,RNASeqValue,Publication, Accession,
 
 from django.db import transaction
 import csv
+import numpy as np
 import requests
+from utils.bulk import ImportTimer, bulk_insert, insert_rows
+from utils.gene_index import index_rnaseqs
+from utils.precompute import precompute_study
+
+# number of genes whose values are inserted and committed together
+BLOCK_SIZE = 500
 
 def parse_rnacsv(rnaseq_csv):
-    """parse a csv file and extract accessions and rnaseq names"""
+    """parse a csv file and extract accessions, rnaseq names and the values as a samples x rnaseq matrix"""
     with open(rnaseq_csv, 'r') as f:
         reader = csv.reader(f)
         header = next(reader)[1:] # Skip the empty col
-        # Generate dictionaries:
-        rnavalues = {}
-        for rna_id in header:
-            rnavalues[rna_id] = []
-        # Populate with entries
         accession_ids = []
+        rows = []
         for line in reader:
             accession_ids.append(line[0])
-            for i,rna_id in enumerate(header):
-                rnavalues[rna_id].append(float(line[1+i]))
-    return accession_ids, rnavalues
+            rows.append(np.array(line[1:], dtype=np.float64))
+    values = np.vstack(rows) if rows else np.zeros((0, len(header)))
+    return accession_ids, header, values
 
 def parse_pubinfo(pubmed_id):
     """Download publication information from pubmed."""
@@ -45,18 +48,13 @@ def parse_pubinfo(pubmed_id):
 
 
 @transaction.atomic
-def save_rnaseq(accession_list, rnavalues, options):
-    """save a csv file to db objects"""
+def create_study(samples, options):
+    """create the study with its publication and observation units"""
     # Initialize Publication
     study = Study()
     study.name = options['study_name']
     study.species = Species.objects.get(pk=1)
-    # Create a submission
     study.save()
-    submission = Submission()
-    submission.status = 2 # Published
-    study.submission = submission
-    submission.save()
     # initialize publications
     print("Study created. Initializing publications.")
     if options['pubmed_id'] is not None:
@@ -69,60 +67,86 @@ def save_rnaseq(accession_list, rnavalues, options):
             print('Publication information could not be stored')
     else:
         print('Publication information missing!')
-        
+    bulk_insert([ObservationUnit(study=study, accession_id=accession_id) for _, accession_id, _ in samples])
+    return study
 
-    # Create list of accessions
-    obs_map = {}
-    # Need to skip missing accessions
-    skipped_sample_ids = []
-    if options['growth_conditions']:
-        growth_conditions = set([x.split('_')[-1] for x in accession_list])
-        obs_map_gc = {}
+
+def get_samples(accession_list, options):
+    """return the (sample_id, accession_id, growth condition) of the samples whose accessions exist"""
+    parsed = []
     for sample_id, accession_id in enumerate(accession_list):
+        gc = None
         if options['growth_conditions']:
             gc = accession_id.split('_')[-1]
-            accession_id = int(accession_id.split('_')[0])
+            accession_id = accession_id.split('_')[0]
+        parsed.append((sample_id, int(accession_id), gc))
+    existing = set(Accession.objects.filter(pk__in=set(accession_id for _, accession_id, _ in parsed)).values_list('pk', flat=True))
+    samples = []
+    # Need to skip missing accessions
+    for sample_id, accession_id, gc in parsed:
+        if accession_id in existing:
+            samples.append((sample_id, accession_id, gc))
         else:
-            accession_id = int(accession_id)
-        try:
-            obs_unit = ObservationUnit(study=study,accession=Accession.objects.get(pk=accession_id))
-            obs_unit.save()
-            obs_map[sample_id] = obs_unit
-            if options['growth_conditions']:
-                obs_map_gc[sample_id] = gc
-        except:
             print("Accession {} does not exist, skipping.".format(accession_id))
-            skipped_sample_ids.append(sample_id)
-    # Ensure that only conditions with matching accession ids are kept
-    if options['growth_conditions']:
-        growth_conditions = growth_conditions.intersection(set(obs_map_gc.values()))
-    # Iterate through RNASeq measurements and save values
-    print("There are {} RNA entries for each accessions.".format(len(rnavalues)))
-    c = 0
-    for rna_id in list(rnavalues.keys()):
-        c+=1
-        # If several growth conditions are present, save different RNASeq objects for each gene
-        if options['growth_conditions']:
-            rnaseq_dict = {gc: RNASeq(name=rna_id, scoring=options['scoring'],study=study,species=study.species, growth_conditions=gc) for gc in growth_conditions}
-            for rnaseq in rnaseq_dict.values():
-                rnaseq.save()
-        else:
-            rnaseq = RNASeq(name=rna_id, scoring=options['scoring'],study=study,species=study.species)
-            rnaseq.save()
-        if c % 100 == 0:
-            print("{} / {}".format(c, len(rnavalues)))
-        for sample_id, value in enumerate(rnavalues[rna_id]):
-            if sample_id in skipped_sample_ids:
-                continue
-            if options['growth_conditions']:
-                rnaseq_value = RNASeqValue(value=value, rnaseq=rnaseq_dict[obs_map_gc[sample_id]], obs_unit = obs_map[sample_id])
-            else:
-                rnaseq_value = RNASeqValue(value=value, rnaseq=rnaseq, obs_unit = obs_map[sample_id])
-            rnaseq_value.save()
-    print("Successfully added RNASeq values for {} accessions across {} loci.".format(len(obs_map),len(rnavalues)))
+    return samples
+
+
+def get_observation_units(study, samples):
+    """return the primary keys of the observation units of the samples that were created with the study"""
+    obs_units = list(study.observationunit_set.order_by('pk').values_list('pk', 'accession_id'))
+    if [accession_id for _, accession_id in obs_units] != [accession_id for _, accession_id, _ in samples]:
+        raise Exception('The observation units of study %s do not match the accessions of the file' % study.pk)
+    return np.array([pk for pk, _ in obs_units], dtype=np.int64)
+
+
+def get_resumable_study(study_name):
+    """return the last study with the name that was not completely imported"""
+    study = Study.objects.filter(name=study_name, submission__isnull=True).order_by('-pk').first()
+    if study is None:
+        raise Exception('No unfinished import of study "%s" found' % study_name)
+    return study
+
+
+def save_rnaseq(study, samples, rna_ids, values, options):
+    """save the values of the rnaseqs that are not stored yet in blocks of genes that are committed separately"""
+    obs_pks = get_observation_units(study, samples)
+    sample_ids = np.array([sample_id for sample_id, _, _ in samples], dtype=np.int64)
+    # If several growth conditions are present, save different RNASeq objects for each gene
+    growth_conditions = sorted(set(gc for _, _, gc in samples)) if options['growth_conditions'] else [None]
+    gc_indices = np.array([growth_conditions.index(gc) for _, _, gc in samples], dtype=np.int64)
+    stored = set(study.rnaseq_set.values_list('name', flat=True))
+    remaining = [j for j, rna_id in enumerate(rna_ids) if rna_id not in stored]
+    print("There are {} RNA entries for each accessions, {} are already stored.".format(len(rna_ids), len(rna_ids) - len(remaining)))
+    block_size = options.get('block_size') or BLOCK_SIZE
+    timer = ImportTimer(study.name)
+    count = 0
+    for start in range(0, len(remaining), block_size):
+        block = remaining[start:start + block_size]
+        with transaction.atomic():
+            rnaseqs = bulk_insert([RNASeq(name=rna_ids[j], scoring=options['scoring'], study=study, species=study.species, growth_conditions=gc)
+                                   for j in block for gc in growth_conditions])
+            index_rnaseqs(rnaseqs)
+            # primary keys of the rnaseqs by gene and growth condition
+            rnaseq_pks = np.array([rnaseq.pk for rnaseq in rnaseqs], dtype=np.int64).reshape(len(block), len(growth_conditions))
+            block_values = values[np.ix_(sample_ids, block)]
+            block_rnaseq_pks = rnaseq_pks[:, gc_indices].T
+            block_obs_pks = np.repeat(obs_pks[:, np.newaxis], len(block), axis=1)
+            count += insert_rows(RNASeqValue, ('value', 'rnaseq', 'obs_unit'),
+                                 zip(block_values.T.ravel().tolist(), block_rnaseq_pks.T.ravel().tolist(), block_obs_pks.T.ravel().tolist()))
+        rate = timer.log(count)
+        print("{} / {} genes ({:.0f} values/s)".format(len(rna_ids) - len(remaining) + start + len(block), len(rna_ids), rate))
+    print("Successfully added RNASeq values for {} accessions across {} loci.".format(len(samples),len(rna_ids)))
     return study
 
 
+def publish_study(study):
+    """create the published submission of a completely imported study"""
+    submission = Submission()
+    submission.status = 2 # Published
+    study.submission = submission
+    submission.save()
+
+
 class Command(BaseCommand):
     help = 'Import a csv file containing RNASeq results into the database'
 
@@ -146,15 +170,30 @@ class Command(BaseCommand):
                             default=False,
                             action='store_true',
                             help='Specify if there are different growth conditions, these should be appended (after undescore) to the accession_id in the csv.')
+        parser.add_argument('--block-size',
+                            type=int,
+                            default=BLOCK_SIZE,
+                            help='Specify the number of genes that are committed together')
+        parser.add_argument('--resume',
+                            default=False,
+                            action='store_true',
+                            help='Continue the unfinished import of the study after the last committed block of genes')
 
 
     def handle(self, *args, **options):
         filename = options['filename']
         try:
-            accession_list, rnavalues = parse_rnacsv(filename)
+            accession_list, rna_ids, values = parse_rnacsv(filename)
             print("RNASeq values loaded from file.")
-            study = save_rnaseq(accession_list, rnavalues, options)
+            samples = get_samples(accession_list, options)
+            if options['resume']:
+                study = get_resumable_study(options['study_name'])
+            else:
+                study = create_study(samples, options)
+            save_rnaseq(study, samples, rna_ids, values, options)
+            publish_study(study)
             study.save()
+            precompute_study(study)
         except Exception as err:
             raise CommandError('Error importing CSV file. Reason: %s' % str(err))
         self.stdout.write(self.style.SUCCESS('Successfully imported CSV file "%s" under following id %s' % (filename,study)))
\ No newline at end of file
@@ -0,0 +1,41 @@
+"""
+Command Line function to calculate and store the per phenotype and RNASeq results of existing studies
+"""
+from django.core.management.base import BaseCommand, CommandError
+from phenotypedb.models import Study
+from utils.precompute import precompute_parallel
+
+
+class Command(BaseCommand):
+    """
+    Command to backfill the stored transformations and statistics
+    """
+    help = 'Calculate and store the transformations and statistics of all phenotypes and RNASeqs of the published studies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--id',
+                            dest='study_ids',
+                            type=int,
+                            action='append',
+                            default=None,
+                            help='Specify a primary key of a study (can be repeated)')
+        parser.add_argument('--processes',
+                            type=int,
+                            default=None,
+                            help='Specify the number of processes (default: number of CPUs)')
+        parser.add_argument('--force',
+                            default=False,
+                            action='store_true',
+                            help='Recalculate results that are already stored')
+
+    def handle(self, *args, **options):
+        try:
+            if options['study_ids']:
+                studies = Study.objects.filter(pk__in=options['study_ids'])
+            else:
+                studies = Study.objects.published()
+            studies = list(studies)
+            count = precompute_parallel(studies, options['processes'], options['force'])
+        except Exception as err:
+            raise CommandError('Error precomputing results. Reason: %s' % str(err))
+        self.stdout.write(self.style.SUCCESS('Successfully calculated %s results for %s studies' % (count, len(studies))))
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phenotypedb', '0023_rnaseq_growth_conditions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TransformationResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('study_update_date', models.DateTimeField(blank=True, null=True)),
+                ('data', models.TextField()),
+                ('phenotype', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='phenotypedb.Phenotype')),
+                ('rnaseq', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='phenotypedb.RNASeq')),
+            ],
+        ),
+    ]
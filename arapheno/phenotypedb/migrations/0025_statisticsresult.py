@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:30
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phenotypedb', '0024_transformationresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatisticsResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('study_update_date', models.DateTimeField(blank=True, null=True)),
+                ('count', models.IntegerField(default=0)),
+                ('mean', models.FloatField(blank=True, null=True)),
+                ('variance', models.FloatField(blank=True, null=True)),
+                ('minimum', models.FloatField(blank=True, null=True)),
+                ('first_quartile', models.FloatField(blank=True, null=True)),
+                ('median', models.FloatField(blank=True, null=True)),
+                ('third_quartile', models.FloatField(blank=True, null=True)),
+                ('maximum', models.FloatField(blank=True, null=True)),
+                ('histogram', models.TextField(blank=True, null=True)),
+                ('value_counts', models.TextField(blank=True, null=True)),
+                ('phenotype', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='phenotypedb.Phenotype')),
+                ('rnaseq', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='phenotypedb.RNASeq')),
+            ],
+        ),
+    ]
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:35
+from __future__ import unicode_literals
+
+import logging
+
+from django.db import DatabaseError, migrations, models, transaction
+
+logger = logging.getLogger(__name__)
+
+
+def create_trigram_index(apps, schema_editor):
+    """
+    The search entries are matched with a trigram index on PostgreSQL.
+    Creating the pg_trgm extension requires a superuser (or the CREATE privilege on
+    PostgreSQL 13+). If the app role can not create it, the search works without the
+    index and a superuser has to run the statements below and create the index later
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        installed = cursor.fetchone() is not None
+    if not installed:
+        try:
+            with transaction.atomic(using=schema_editor.connection.alias):
+                schema_editor.execute('CREATE EXTENSION pg_trgm')
+        except DatabaseError as err:
+            logger.warn('Could not create the pg_trgm extension, the search entries are not indexed. '
+                        'Run "CREATE EXTENSION pg_trgm" as superuser and "CREATE INDEX '
+                        'phenotypedb_searchentry_text_trgm ON phenotypedb_searchentry USING gin '
+                        '(text gin_trgm_ops)". Reason: %s', str(err))
+            return
+    schema_editor.execute('CREATE INDEX phenotypedb_searchentry_text_trgm '
+                          'ON phenotypedb_searchentry USING gin (text gin_trgm_ops)')
+
+
+def drop_trigram_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS phenotypedb_searchentry_text_trgm')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phenotypedb', '0025_statisticsresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DataVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('version', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SearchEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entity', models.CharField(db_index=True, max_length=20)),
+                ('object_id', models.CharField(max_length=50)),
+                ('name', models.CharField(blank=True, max_length=255)),
+                ('text', models.TextField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='searchentry',
+            unique_together=set([('entity', 'object_id')]),
+        ),
+        migrations.RunPython(create_trigram_index, drop_trigram_index),
+    ]
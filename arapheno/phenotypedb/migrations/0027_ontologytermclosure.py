@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:40
+from __future__ import unicode_literals
+
+from collections import defaultdict, deque
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+CHUNK_SIZE = 10000
+
+
+def compute_closure(term_ids, edges):
+    """Copy of utils.ontology.compute_closure as of this migration"""
+    children = defaultdict(list)
+    for parent, child in edges:
+        children[parent].append(child)
+    closure = []
+    for term_id in term_ids:
+        depths = {term_id: 0}
+        queue = deque([term_id])
+        while queue:
+            current = queue.popleft()
+            for child in children[current]:
+                if child not in depths:
+                    depths[child] = depths[current] + 1
+                    queue.append(child)
+        closure.extend((term_id, descendant, depth) for descendant, depth in depths.items())
+    return closure
+
+
+def build_closure(apps, schema_editor):
+    """Stores the closure of the ontologies that are already loaded"""
+    OntologyTerm = apps.get_model('phenotypedb', 'OntologyTerm')
+    OntologyTermClosure = apps.get_model('phenotypedb', 'OntologyTermClosure')
+    term_ids = list(OntologyTerm.objects.values_list('pk', flat=True))
+    edges = OntologyTerm.children.through.objects.values_list('from_ontologyterm_id', 'to_ontologyterm_id')
+    closure = compute_closure(term_ids, edges)
+    for start in range(0, len(closure), CHUNK_SIZE):
+        # bulk_create splits the chunks into batches that the database supports
+        OntologyTermClosure.objects.bulk_create(
+            OntologyTermClosure(ancestor_id=ancestor, descendant_id=descendant, depth=depth)
+            for ancestor, descendant, depth in closure[start:start + CHUNK_SIZE])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phenotypedb', '0026_searchentry_dataversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OntologyTermClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.IntegerField(default=0)),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='phenotypedb.OntologyTerm')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='phenotypedb.OntologyTerm')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='ontologytermclosure',
+            unique_together=set([('ancestor', 'descendant')]),
+        ),
+        migrations.RunPython(build_closure, migrations.RunPython.noop),
+    ]
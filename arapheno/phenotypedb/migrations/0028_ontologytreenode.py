@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:42
+from __future__ import unicode_literals
+
+import json
+from collections import Counter, defaultdict
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+PUBLISHED = 2
+
+PHENOTYPE_TERM_FIELDS = ('to_term_id', 'eo_term_id', 'uo_term_id')
+
+CHUNK_SIZE = 10000
+
+
+def compute_tree(terms, edges, closure, phenotype_counts):
+    """Copy of utils.ontology.compute_tree as of this migration"""
+    names = dict(terms)
+    children = defaultdict(list)
+    parents = defaultdict(list)
+    for parent, child in edges:
+        children[parent].append(child)
+        parents[child].append(parent)
+    descendant_counts = Counter()
+    for ancestor, descendant, _ in closure:
+        descendant_counts[ancestor] += phenotype_counts.get(descendant, 0)
+    nodes = {}
+    for term_id, _ in terms:
+        path = []
+        current = term_id
+        while parents[current] and min(parents[current]) not in path and min(parents[current]) != term_id:
+            current = min(parents[current])
+            path.append(current)
+        path.reverse()
+        nodes[term_id] = {'is_root': not parents[term_id],
+                          'child_count': len(children[term_id]),
+                          'phenotype_count': descendant_counts[term_id],
+                          'root_path': json.dumps(path),
+                          'children': json.dumps([{'id': child, 'text': names[child],
+                                                   'children': len(children[child]) > 0,
+                                                   'data': {'phenotype_count': descendant_counts[child]}}
+                                                  for child in sorted(children[term_id])])}
+    return nodes
+
+
+def build_tree(apps, schema_editor):
+    """Stores the tree nodes of the ontologies that are already loaded"""
+    OntologyTerm = apps.get_model('phenotypedb', 'OntologyTerm')
+    OntologyTermClosure = apps.get_model('phenotypedb', 'OntologyTermClosure')
+    OntologyTreeNode = apps.get_model('phenotypedb', 'OntologyTreeNode')
+    Phenotype = apps.get_model('phenotypedb', 'Phenotype')
+    phenotype_counts = Counter()
+    for term_ids in Phenotype.objects.filter(study__submission__status=PUBLISHED).values_list(*PHENOTYPE_TERM_FIELDS):
+        phenotype_counts.update(term_id for term_id in term_ids if term_id)
+    nodes = compute_tree(list(OntologyTerm.objects.values_list('pk', 'name')),
+                         OntologyTerm.children.through.objects.values_list('from_ontologyterm_id', 'to_ontologyterm_id'),
+                         OntologyTermClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'),
+                         phenotype_counts)
+    nodes = list(nodes.items())
+    for start in range(0, len(nodes), CHUNK_SIZE):
+        # bulk_create splits the chunks into batches that the database supports
+        OntologyTreeNode.objects.bulk_create(OntologyTreeNode(term_id=term_id, **fields)
+                                             for term_id, fields in nodes[start:start + CHUNK_SIZE])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phenotypedb', '0027_ontologytermclosure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OntologyTreeNode',
+            fields=[
+                ('term', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='tree_node', serialize=False, to='phenotypedb.OntologyTerm')),
+                ('is_root', models.BooleanField(db_index=True, default=False)),
+                ('child_count', models.IntegerField(default=0)),
+                ('phenotype_count', models.IntegerField(default=0)),
+                ('root_path', models.TextField(default='[]')),
+                ('children', models.TextField(default='[]')),
+            ],
+        ),
+        migrations.RunPython(build_tree, migrations.RunPython.noop),
+    ]
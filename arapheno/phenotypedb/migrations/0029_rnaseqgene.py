@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 18:55
+from __future__ import unicode_literals
+
+import re
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+ISOFORM_PATTERN = re.compile(r'^(.+?)\.\d+$')
+
+CHUNK_SIZE = 10000
+
+
+def normalize_gene_id(name):
+    """Copy of utils.gene_index.normalize_gene_id as of this migration"""
+    gene_id = (name or '').strip().upper()
+    isoform = ISOFORM_PATTERN.match(gene_id)
+    return gene_id, isoform.group(1) if isoform else gene_id
+
+
+def build_gene_index(apps, schema_editor):
+    """Indexes the rnaseqs that are already imported"""
+    RNASeq = apps.get_model('phenotypedb', 'RNASeq')
+    RNASeqGene = apps.get_model('phenotypedb', 'RNASeqGene')
+    entries = []
+    for pk, name, study_id, growth_conditions in RNASeq.objects.values_list('pk', 'name', 'study_id', 'growth_conditions').iterator():
+        gene_id, locus_id = normalize_gene_id(name)
+        entries.append(RNASeqGene(rnaseq_id=pk, study_id=study_id, gene_id=gene_id, locus_id=locus_id,
+                                  growth_conditions=growth_conditions))
+    for start in range(0, len(entries), CHUNK_SIZE):
+        # bulk_create splits the chunks into batches that the database supports
+        RNASeqGene.objects.bulk_create(entries[start:start + CHUNK_SIZE])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phenotypedb', '0028_ontologytreenode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RNASeqGene',
+            fields=[
+                ('rnaseq', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='gene_index', serialize=False, to='phenotypedb.RNASeq')),
+                ('gene_id', models.CharField(db_index=True, max_length=255)),
+                ('locus_id', models.CharField(db_index=True, max_length=255)),
+                ('growth_conditions', models.TextField(blank=True, null=True)),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='phenotypedb.Study')),
+            ],
+        ),
+        migrations.RunPython(build_gene_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+PUBLISHED = 2
+
+CHUNK_SIZE = 10000
+
+
+def _normalize(text):
+    return (text or '').strip().lower()
+
+
+def _entry(SearchEntry, entity, pk, name, *fields):
+    name = _normalize(name)
+    text = '\n'.join([name] + [_normalize(field) for field in fields])
+    return SearchEntry(entity=entity, object_id='%s' % pk, name=name[:255], text=text)
+
+
+def build_search_index(apps, schema_editor):
+    """
+    Indexes the data that is already loaded (see utils.search.rebuild_index).
+    Afterwards the index is kept up to date by the signals of the indexed models
+    """
+    Phenotype = apps.get_model('phenotypedb', 'Phenotype')
+    Study = apps.get_model('phenotypedb', 'Study')
+    Accession = apps.get_model('phenotypedb', 'Accession')
+    OntologyTerm = apps.get_model('phenotypedb', 'OntologyTerm')
+    SearchEntry = apps.get_model('phenotypedb', 'SearchEntry')
+    DataVersion = apps.get_model('phenotypedb', 'DataVersion')
+    entries = []
+    for pk, name, to_term_id, to_term_name in Phenotype.objects.filter(study__submission__status=PUBLISHED).values_list(
+            'pk', 'name', 'to_term_id', 'to_term__name').iterator():
+        fields = [to_term_id, to_term_name] if to_term_id else []
+        entries.append(_entry(SearchEntry, 'phenotype', pk, name, *fields))
+    for pk, name in Study.objects.filter(submission__status=PUBLISHED).values_list('pk', 'name').iterator():
+        entries.append(_entry(SearchEntry, 'study', pk, name))
+    for pk, name in Accession.objects.values_list('pk', 'name').iterator():
+        entries.append(_entry(SearchEntry, 'accession', pk, name))
+    for pk, name in OntologyTerm.objects.values_list('pk', 'name').iterator():
+        entries.append(_entry(SearchEntry, 'ontology', pk, name))
+    SearchEntry.objects.all().delete()
+    for start in range(0, len(entries), CHUNK_SIZE):
+        # bulk_create splits the chunks into batches that the database supports
+        SearchEntry.objects.bulk_create(entries[start:start + CHUNK_SIZE])
+    for name in ('search', 'data'):
+        version, _ = DataVersion.objects.get_or_create(name=name)
+        version.version += 1
+        version.save()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phenotypedb', '0029_rnaseqgene'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
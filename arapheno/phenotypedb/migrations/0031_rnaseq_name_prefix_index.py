@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+def create_name_prefix_index(apps, schema_editor):
+    """
+    The RNASeq autocomplete looks up the names with name__istartswith, which is
+    UPPER(name::text) LIKE UPPER(%s) on PostgreSQL and can not use the plain name index
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE INDEX phenotypedb_rnaseq_name_upper_like '
+                          'ON phenotypedb_rnaseq (UPPER(name::text) text_pattern_ops)')
+
+
+def drop_name_prefix_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS phenotypedb_rnaseq_name_upper_like')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('phenotypedb', '0030_build_search_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_name_prefix_index, drop_name_prefix_index),
+    ]
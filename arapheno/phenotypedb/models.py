@@ -10,7 +10,9 @@ import pandas as pd
 
 from django.core.exceptions import PermissionDenied
 from django.core.urlresolvers import reverse
-from django.db import connection, models
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
 from django.utils.safestring import mark_safe
 from django.conf import settings
 
@@ -162,16 +164,6 @@ class Study(models.Model):
                                      'value']).set_index(['id'])
         return data
 
-    def get_matrix_and_accession_map(self, column='phenotype_name'):
-        """Returns both the dataframe and a matrix version of it"""
-        kind = 'rnaseq' if self.phenotype_set.count()==0 and self.rnaseq_set.count()>0 else 'phenotype'
-        data = self.value_as_dataframe(kind)
-        data.set_index(['obs_unit_id'], inplace=True)
-        df_pivot = data.pivot(columns=column, values='value')
-        data.drop(['value', 'phenotype_id', 'phenotype_name'], axis=1, inplace=True)
-        data = data[~data.index.duplicated(keep='first')]
-        return (data, df_pivot)
-
     @property
     def count_phenotypes(self):
         """Returns number of phenotypes"""
@@ -485,6 +477,11 @@ class Phenotype(models.Model):
         return '%s/phenotype:%s' % (settings.DATACITE_PREFIX, self.id)
     #update_date = models.DateTimeField(default=None,null=True,blank=True)
 
+    def save(self, *args, **kwargs):
+        # the HTTP validators of the phenotype views are derived from the update_date
+        self.update_date = datetime.now()
+        super(Phenotype, self).save(*args, **kwargs)
+
     def __unicode__(self):
         if self.to_term is None:
             return u"%s (Phenotype)" % (mark_safe(self.name))
@@ -583,6 +580,34 @@ class OntologyTerm(models.Model):
         return 'https://bioportal.bioontology.org/ontologies/%s?p=classes&conceptid=http://purl.obolibrary.org/obo/%s' % (self.source.acronym, self.id.replace(':', '_'))
 
 
+class OntologyTermClosure(models.Model):
+    """
+    OntologyTermClosure model
+    Pair of an ontology term and one of its descendants (including the term itself)
+    with the length of the shortest path between them
+    """
+    ancestor = models.ForeignKey('OntologyTerm', related_name='descendant_links', on_delete=models.CASCADE)
+    descendant = models.ForeignKey('OntologyTerm', related_name='ancestor_links', on_delete=models.CASCADE)
+    depth = models.IntegerField(default=0) #0 for the term itself, 1 for its children, etc.
+
+    class Meta:
+        unique_together = ('ancestor', 'descendant')
+
+
+class OntologyTreeNode(models.Model):
+    """
+    OntologyTreeNode model
+    Precomputed position of an ontology term in the tree of its ontology
+    with the jsTree data of its children
+    """
+    term = models.OneToOneField('OntologyTerm', primary_key=True, related_name='tree_node', on_delete=models.CASCADE)
+    is_root = models.BooleanField(default=False, db_index=True) #term without parents
+    child_count = models.IntegerField(default=0)
+    phenotype_count = models.IntegerField(default=0) #published phenotypes annotated with the term or any of its descendants
+    root_path = models.TextField(default='[]') #JSON encoded ids of the ancestors from the root to the parent
+    children = models.TextField(default='[]') #JSON encoded jsTree nodes of the children
+
+
 '''class OntologyTerm2Term(models.Model):
     """OntologyTerm Many To Many table """
     parent = models.ForeignKey("OntologyTerm",related_name="parent")
@@ -658,4 +683,276 @@ class RNASeqValue(models.Model):
     """
     value = models.FloatField()
     rnaseq = models.ForeignKey('RNASeq')
-    obs_unit = models.ForeignKey('ObservationUnit')
\ No newline at end of file
+    obs_unit = models.ForeignKey('ObservationUnit')
+
+
+class RNASeqGene(models.Model):
+    """
+    RNASeqGene model
+    Index of the RNASeqs of all studies by gene id. gene_id is the normalized name of the RNASeq
+    and locus_id the gene id without isoform suffix (e.g. AT1G01010 for AT1G01010.1)
+    """
+    rnaseq = models.OneToOneField('RNASeq', primary_key=True, related_name='gene_index', on_delete=models.CASCADE)
+    study = models.ForeignKey('Study', on_delete=models.CASCADE)
+    gene_id = models.CharField(max_length=255, db_index=True)
+    locus_id = models.CharField(max_length=255, db_index=True)
+    growth_conditions = models.TextField(blank=True, null=True)
+
+
+class TransformationResult(models.Model):
+    """
+    TransformationResult model
+    Stored transformations and Shapiro-Wilk p-values of the values of a phenotype or RNASeq.
+    The result is valid as long as the update_date of the study does not change
+    """
+    phenotype = models.OneToOneField('Phenotype', null=True, blank=True, on_delete=models.CASCADE)
+    rnaseq = models.OneToOneField('RNASeq', null=True, blank=True, on_delete=models.CASCADE)
+    study_update_date = models.DateTimeField(null=True, blank=True) #update_date of the study at computation time
+    data = models.TextField() #JSON encoded accessions and transformations
+
+class StatisticsResult(models.Model):
+    """
+    StatisticsResult model
+    Stored distribution statistics of the values of a phenotype or RNASeq.
+    The Shapiro-Wilk test is stored on the phenotype or RNASeq itself.
+    The result is valid as long as the update_date of the study does not change
+    """
+    phenotype = models.OneToOneField('Phenotype', null=True, blank=True, on_delete=models.CASCADE)
+    rnaseq = models.OneToOneField('RNASeq', null=True, blank=True, on_delete=models.CASCADE)
+    study_update_date = models.DateTimeField(null=True, blank=True) #update_date of the study at computation time
+    count = models.IntegerField(default=0) #number of values
+    mean = models.FloatField(blank=True, null=True)
+    variance = models.FloatField(blank=True, null=True) #sample variance
+    minimum = models.FloatField(blank=True, null=True)
+    first_quartile = models.FloatField(blank=True, null=True)
+    median = models.FloatField(blank=True, null=True)
+    third_quartile = models.FloatField(blank=True, null=True)
+    maximum = models.FloatField(blank=True, null=True)
+    histogram = models.TextField(blank=True, null=True) #JSON encoded bin edges and counts
+    value_counts = models.TextField(blank=True, null=True) #JSON encoded (value, count) pairs of few distinct values
+
+class SearchEntry(models.Model):
+    """
+    SearchEntry model
+    Entry of the search index for a published phenotype, published study, accession or ontology term
+    """
+    entity = models.CharField(max_length=20, db_index=True) #phenotype, study, accession or ontology
+    object_id = models.CharField(max_length=50) #primary key of the indexed object
+    name = models.CharField(max_length=255, blank=True) #lower case name used for ranking
+    text = models.TextField() #lower case searchable fields separated by newlines
+
+    class Meta:
+        unique_together = ('entity', 'object_id')
+
+class DataVersion(models.Model):
+    """
+    DataVersion model
+    Counter that is incremented whenever derived data (e.g. the search index) changes,
+    so that worker processes know when to reload their in-memory copies
+    """
+    DATA = 'data' #name of the version that changes whenever the studies, accessions or ontology terms change
+
+    name = models.CharField(max_length=50, unique=True)
+    version = models.BigIntegerField(default=0)
+
+    @classmethod
+    def get_version(cls, name):
+        """Returns the current version of the data"""
+        versions = list(cls.objects.filter(name=name).values_list('version', flat=True))
+        return versions[0] if versions else 0
+
+    @classmethod
+    def increment(cls, name):
+        """Increments the version of the data"""
+        if cls.objects.filter(name=name).update(version=models.F('version') + 1) == 0:
+            try:
+                with transaction.atomic():
+                    cls.objects.create(name=name, version=1)
+            except IntegrityError:
+                cls.objects.filter(name=name).update(version=models.F('version') + 1)
+
+class _StudyTouch(object):
+    """on_commit marker of a study whose update_date was already set in the current transaction"""
+
+    def __init__(self, study_id):
+        self.study_id = study_id
+
+    def __call__(self):
+        pass
+
+
+def touch_study(study_id):
+    """
+    Sets the update_date of a study and increments the global data version when its phenotypes,
+    rnaseqs or values change, so that the caches and HTTP validators derived from them change.
+    The study is updated only once per transaction (e.g. an import)
+    """
+    conn = transaction.get_connection()
+    if conn.in_atomic_block:
+        for _, func in conn.run_on_commit:
+            if isinstance(func, _StudyTouch) and func.study_id == study_id:
+                return
+        transaction.on_commit(_StudyTouch(study_id))
+    # an update does not send the signals of Study.save
+    Study.objects.filter(pk=study_id).update(update_date=datetime.now())
+    DataVersion.increment(DataVersion.DATA)
+
+# search index entity of the indexed models
+SEARCH_ENTITIES = {Study: 'study', Phenotype: 'phenotype', Accession: 'accession', OntologyTerm: 'ontology'}
+
+@receiver(post_save, sender=Study)
+@receiver(post_delete, sender=Study)
+def invalidate_study_matrix(sender, instance, **kwargs):
+    """Removes the cached value matrices when a study is saved or deleted"""
+    # imported here because utils imports the models
+    from utils.matrix_cache import schedule_invalidation
+    schedule_invalidation(instance.id)
+
+
+@receiver(post_delete, sender=Phenotype)
+@receiver(post_delete, sender=RNASeq)
+def invalidate_variable_study_matrix(sender, instance, **kwargs):
+    """Removes the cached value matrices of the study when a phenotype or rnaseq is deleted"""
+    from utils.matrix_cache import schedule_invalidation
+    schedule_invalidation(instance.study_id)
+
+
+@receiver(post_save, sender=PhenotypeValue)
+@receiver(post_delete, sender=PhenotypeValue)
+def invalidate_phenotype_value_study_matrix(sender, instance, **kwargs):
+    """Removes the cached value matrices and updates the study when a phenotype value is saved or deleted"""
+    from utils.matrix_cache import schedule_variable_invalidation
+    study_id = schedule_variable_invalidation(Phenotype, instance.phenotype_id)
+    if study_id is not None and not kwargs.get('raw', False):
+        touch_study(study_id)
+
+
+@receiver(post_save, sender=RNASeqValue)
+@receiver(post_delete, sender=RNASeqValue)
+def invalidate_rnaseq_value_study_matrix(sender, instance, **kwargs):
+    """Removes the cached value matrices and updates the study when a rnaseq value is saved or deleted"""
+    from utils.matrix_cache import schedule_variable_invalidation
+    study_id = schedule_variable_invalidation(RNASeq, instance.rnaseq_id)
+    if study_id is not None and not kwargs.get('raw', False):
+        touch_study(study_id)
+
+
+@receiver(post_save, sender=Phenotype)
+@receiver(post_delete, sender=Phenotype)
+@receiver(post_save, sender=RNASeq)
+@receiver(post_delete, sender=RNASeq)
+def touch_variable_study(sender, instance, **kwargs):
+    """Updates the study when one of its phenotypes or rnaseqs is saved or deleted"""
+    if not kwargs.get('raw', False):
+        touch_study(instance.study_id)
+
+
+@receiver(post_save, sender=RNASeq)
+def update_gene_index(sender, instance, **kwargs):
+    """Updates the gene index entry of a rnaseq when it is saved"""
+    from utils.gene_index import index_rnaseqs
+    if not kwargs.get('raw', False):
+        index_rnaseqs([instance])
+
+
+@receiver(post_save, sender=Submission)
+def update_search_index(sender, instance, created, **kwargs):
+    """Adds the study to the search index when it is published and removes it otherwise"""
+    from utils.search import index_study, remove_study
+    if instance.status == PUBLISHED:
+        index_study(instance.study)
+    elif not created:
+        remove_study(instance.study_id)
+
+
+@receiver(post_save, sender=Study)
+def update_study_search_index(sender, instance, **kwargs):
+    """Updates the entries of a published study when it is changed"""
+    from utils.search import index_study
+    if not kwargs.get('raw', False):
+        index_study(instance)
+
+
+@receiver(post_save, sender=Phenotype)
+def update_phenotype_search_index(sender, instance, **kwargs):
+    """Updates the entry of a phenotype of a published study when it is changed"""
+    from utils.search import index_phenotype
+    if not kwargs.get('raw', False):
+        index_phenotype(instance)
+
+
+@receiver(post_save, sender=Accession)
+@receiver(post_save, sender=OntologyTerm)
+def update_object_search_index(sender, instance, **kwargs):
+    """
+    Updates the entry of an accession or ontology term when it is changed.
+    Fixtures (raw saves) are indexed with the build_search_index command
+    """
+    from utils.search import index_object
+    if not kwargs.get('raw', False):
+        index_object(SEARCH_ENTITIES[sender], instance.pk, instance.name)
+
+
+@receiver(post_delete, sender=Study)
+@receiver(post_delete, sender=Phenotype)
+@receiver(post_delete, sender=Accession)
+@receiver(post_delete, sender=OntologyTerm)
+def remove_from_search_index(sender, instance, **kwargs):
+    """Removes a deleted study, phenotype, accession or ontology term from the search index"""
+    from utils.search import remove_entries
+    remove_entries(SEARCH_ENTITIES[sender], ['%s' % instance.pk])
+
+
+@receiver(post_save, sender=Study)
+@receiver(post_delete, sender=Study)
+@receiver(post_save, sender=Submission)
+@receiver(post_save, sender=Accession)
+@receiver(post_delete, sender=Accession)
+@receiver(post_save, sender=OntologyTerm)
+@receiver(post_delete, sender=OntologyTerm)
+def increment_data_version(sender, instance, **kwargs):
+    """
+    Increments the global data version when a study is imported, changed, published or deleted
+    and when an accession or ontology term is changed (the data of the studies change with touch_study)
+    """
+    if not kwargs.get('raw', False):
+        DataVersion.increment(DataVersion.DATA)
+
+
+@receiver(post_save, sender=OntologyTerm)
+@receiver(post_delete, sender=OntologyTerm)
+def rebuild_ontology_closure(sender, instance, **kwargs):
+    """
+    Rebuilds the ontology closure table when a term is added, deleted or loaded from
+    a fixture and updates the tree nodes of its parents when it is changed
+    """
+    from utils.ontology import schedule_rebuild, update_term
+    if kwargs.get('created', True) or kwargs.get('raw', False):
+        # fixtures rebuild the closure only once when they are loaded
+        schedule_rebuild()
+    else:
+        update_term(instance.pk)
+
+
+@receiver(m2m_changed, sender=OntologyTerm.children.through)
+def rebuild_ontology_closure_for_children(sender, instance, action, **kwargs):
+    """Rebuilds the ontology closure table when the children of a term change"""
+    from utils.ontology import schedule_rebuild
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        schedule_rebuild()
+
+
+@receiver(post_save, sender=Submission)
+def update_ontology_phenotype_counts(sender, instance, **kwargs):
+    """Updates the phenotype counts of the ontology terms of a study when it is published or unpublished"""
+    from utils.ontology import schedule_count_update
+    if not kwargs.get('raw', False):
+        schedule_count_update(study_ids=[instance.study_id])
+
+
+@receiver(pre_delete, sender=Study)
+def update_deleted_ontology_phenotype_counts(sender, instance, **kwargs):
+    """Updates the phenotype counts of the ontology terms of a study after it is deleted"""
+    from utils.ontology import get_study_term_ids, schedule_count_update
+    # the terms are looked up before the phenotypes are deleted and updated when the delete commits
+    schedule_count_update(term_ids=get_study_term_ids([instance.pk]))
@@ -1,4 +1,10 @@
+from collections import OrderedDict
+
+import unicodecsv as csv
+from django.conf import settings
+from six import BytesIO
 from rest_framework_csv.renderers import CSVRenderer
+from rest_framework_csv.misc import Echo
 from rest_framework import renderers
 
 '''
@@ -23,6 +29,34 @@ class PhenotypeValueRenderer(CSVRenderer):
     header = ['phenotype_name','accession_id','accession_name','accession_cs_number','accession_longitude',
               'accession_latitude','accession_country','phenotype_value','obs_unit_id']
 
+    def render_rows(self, rows, renderer_context={}):
+        """
+        Yields the CSV lines for flat value rows that are ordered like the header
+        """
+        writer_opts = renderer_context.get('writer_opts', self.writer_opts or {})
+        csv_writer = csv.writer(Echo(), encoding=settings.DEFAULT_CHARSET, **writer_opts)
+        yield csv_writer.writerow(self.header)
+        for row in rows:
+            yield csv_writer.writerow(row)
+
+
+class PhenotypeValueJSONRenderer(renderers.JSONRenderer):
+    """
+    JSON renderer that can also stream flat value rows as a list of objects
+    """
+
+    def render_rows(self, rows, renderer_context={}):
+        """
+        Yields the JSON list for flat value rows that are ordered like the
+        PhenotypeValueRenderer header
+        """
+        header = PhenotypeValueRenderer.header
+        separator = b'['
+        for row in rows:
+            yield separator + self.render(OrderedDict(zip(header, row)))
+            separator = b','
+        yield b']' if separator == b',' else b'[]'
+
 class TransformationRenderer(CSVRenderer):
     labels = {'obs_unit_id': 'replicate_id'}
 
@@ -45,10 +79,29 @@ class PhenotypeMatrixRenderer(CSVRenderer):
     labels = {'obs_unit_id':'replicate_id'}
 
     def render(self, data, media_type=None, renderer_context={}, writer_opts=None):
+        if hasattr(data, 'iter_rows'):
+            return self._render_matrix(data, renderer_context)
         if type(data) == list and len(data) > 0:
             renderer_context['header'] = self._get_sorted_headers(data[0].keys())
         return super(PhenotypeMatrixRenderer, self).render(data, media_type, renderer_context,writer_opts)
 
+    def _render_matrix(self, matrix, renderer_context):
+        """
+        Renders a StudyMatrix directly from its arrays
+        """
+        if matrix.shape[0] == 0:
+            return ''
+        writer_opts = renderer_context.get('writer_opts', self.writer_opts or {})
+        labels = renderer_context.get('labels', self.labels) or {}
+        columns, _ = matrix.get_columns('phenotype_name')
+        header = self._get_sorted_headers(['obs_unit_id', 'accession_id', 'accession_name'] + columns)
+        csv_buffer = BytesIO()
+        csv_writer = csv.writer(csv_buffer, encoding=settings.DEFAULT_CHARSET, **writer_opts)
+        csv_writer.writerow([labels.get(x, x) for x in header])
+        for obs_unit_id, accession_id, accession_name, values in matrix.iter_rows('phenotype_name'):
+            csv_writer.writerow([accession_id, obs_unit_id] + values)
+        return csv_buffer.getvalue()
+
 
     def _get_sorted_headers(self,headers):
         headers.remove('obs_unit_id')
@@ -58,6 +111,51 @@ class PhenotypeMatrixRenderer(CSVRenderer):
         headers.insert(0,'accession_id')
         return headers
 
+class PhenotypeMatrixJSONRenderer(renderers.JSONRenderer):
+    """
+    JSON renderer that converts a StudyMatrix to a list of objects (one per obs_unit)
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if hasattr(data, 'to_records'):
+            data = data.to_records()
+        return super(PhenotypeMatrixJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+
+class GeneValuesRenderer(CSVRenderer):
+    """
+    Renders the values of a gene across studies with one row per accession
+    and one column per rnaseq labelled with the study and growth conditions
+    """
+
+    def render(self, data, media_type=None, renderer_context={}, writer_opts=None):
+        if not isinstance(data, dict) or 'rnaseqs' not in data:
+            return super(GeneValuesRenderer, self).render(data, media_type, renderer_context, writer_opts)
+        writer_opts = renderer_context.get('writer_opts', self.writer_opts or {})
+        columns = []
+        for rnaseq in data['rnaseqs']:
+            label = '%s (%s' % (rnaseq['name'], rnaseq['study_name'])
+            if rnaseq['growth_conditions']:
+                label += ', %s' % rnaseq['growth_conditions']
+            columns.append(label + ')')
+        csv_buffer = BytesIO()
+        csv_writer = csv.writer(csv_buffer, encoding=settings.DEFAULT_CHARSET, **writer_opts)
+        csv_writer.writerow(['accession_id', 'accession_name'] + columns)
+        for i, accession_id in enumerate(data['accession_id']):
+            csv_writer.writerow([accession_id, data['accession_name'][i]] +
+                                ['' if values[i] is None else values[i] for values in data['values']])
+        return csv_buffer.getvalue()
+
+class PhenotypeMatrixColumnsJSONRenderer(renderers.JSONRenderer):
+    """
+    JSON renderer that converts a StudyMatrix to the obs_unit meta-information
+    and one list of values per phenotype (columnar layout)
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if hasattr(data, 'to_columns'):
+            data = data.to_columns()
+        return super(PhenotypeMatrixColumnsJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+
 class AccessionListRenderer(CSVRenderer):
     header = ['pk','name','country','latitude','longitude',
               'collector','collection_date','cs_number','species', 'genotypes', 'count_phenotypes']
@@ -104,6 +202,23 @@ class PLINKRenderer(renderers.BaseRenderer):
             plink += str(element['accession_id']) + " " + str(element['accession_id']) + " " + str(element['phenotype_value']) + "\n"
         return plink
 
+    def render_rows(self, rows, renderer_context={}):
+        """
+        Yields the PLINK lines for flat value rows that are ordered like the
+        PhenotypeValueRenderer header
+        """
+        name_ix = PhenotypeValueRenderer.header.index('phenotype_name')
+        accession_ix = PhenotypeValueRenderer.header.index('accession_id')
+        value_ix = PhenotypeValueRenderer.header.index('phenotype_value')
+        header_written = False
+        for row in rows:
+            if not header_written:
+                yield "FID IID \"" + row[name_ix].replace(' ','_') + "\"\n"
+                header_written = True
+            yield str(row[accession_ix]) + " " + str(row[accession_ix]) + " " + str(row[value_ix]) + "\n"
+        if not header_written:
+            yield "No Data Found"
+
 class IsaTabRenderer(CSVRenderer):
 
     def render(self, data, media_type=None, renderer_context={}, writer_opts=None):
@@ -1,5 +1,4 @@
-from django.http import HttpResponse
-from django.db.models import Q
+from django.http import HttpResponse, StreamingHttpResponse
 from django.db.models import Count
 from django.http import FileResponse
 from django.core.mail import EmailMessage
@@ -13,26 +12,35 @@ from rest_framework.renderers import JSONRenderer
 from rest_framework.parsers import JSONParser, FileUploadParser, MultiPartParser, FormParser
 from rest_framework.views import APIView
 
-from phenotypedb.models import Phenotype, Study, PhenotypeValue, Accession, Submission, OntologyTerm, OntologySource, RNASeq
+from phenotypedb.models import PUBLISHED, Phenotype, Study, PhenotypeValue, Accession, Submission, OntologySource, RNASeq
 from phenotypedb.serializers import PhenotypeListSerializer, StudyListSerializer, OntologyTermListSerializer
-from phenotypedb.serializers import PhenotypeValueSerializer, ReducedPhenotypeValueSerializer
+from phenotypedb.serializers import PhenotypeValueSerializer, ReducedPhenotypeValueSerializer, StatisticsSerializer
 from phenotypedb.serializers import AccessionListSerializer, SubmissionDetailSerializer, AccessionPhenotypesSerializer
 
 from phenotypedb.forms import UploadFileForm
 from phenotypedb.renderer import PhenotypeListRenderer, StudyListRenderer, PhenotypeValueRenderer, PhenotypeMatrixRenderer, IsaTabFileRenderer, AccessionListRenderer, ZipFileRenderer, TransformationRenderer
-from phenotypedb.renderer import PLINKRenderer, PLINKMatrixRenderer
+from phenotypedb.renderer import PLINKRenderer, PLINKMatrixRenderer, PhenotypeValueJSONRenderer, PhenotypeMatrixJSONRenderer, PhenotypeMatrixColumnsJSONRenderer, GeneValuesRenderer
 from phenotypedb.parsers import AccessionTextParser
-from utils.isa_tab import export_isatab
-from utils import calculate_phenotype_transformations
+from phenotypedb.conditional import conditional, data_validators, phenotype_validators, rnaseq_validators, study_validators
+from utils.isa_tab import stream_isatab
+from utils.isatab_cache import get_cached_archive
+from utils.matrix_cache import get_study_matrix
+from utils.gene_index import get_gene_values
+from utils.ontology import get_children, get_roots
+from utils.rnaseq_store import get_gene_matrix, get_value_rows
+from utils.association import METHODS, AssociationError, scan_association
+from utils.coexpression import MAX_NEIGHBOURS, get_coexpressed_genes
+from utils.correlation import AGGREGATES, PhenotypeNotFound, get_phenotype_correlations
+from utils import get_statistics, get_transformations
+from utils.statistics import HISTOGRAM_BINS
+from utils.summary import get_value_summary
+from utils.search import MAX_PAGE_SIZE, RankedResults, get_querysets, search as search_index
 from django.views.decorators.csrf import csrf_exempt
-import scipy as sp
-import scipy.stats as stats
 from django.conf import settings
 
 import re,os,array
-import tempfile
-import shutil
 import logging
+from collections import OrderedDict
 
 logger = logging.getLogger(__name__)
 
@@ -44,9 +52,18 @@ DOI_PATTERN_PHENOTYPE = re.compile(DOI_REGEX_PHENOTYPE)
 GENEID_REGEX = r"AT[1-5|M|C]G[\d]*(\.[\d]){0,1}"
 GENEID_PATTERN =  re.compile(GENEID_REGEX)
 
+# maximum number of genes of a batch query
+MAX_GENES = 500
+
+# value columns in the order of PhenotypeValueRenderer.header (without the leading phenotype_name)
+VALUE_ROW_FIELDS = ('obs_unit__accession_id', 'obs_unit__accession__name', 'obs_unit__accession__cs_number',
+                    'obs_unit__accession__longitude', 'obs_unit__accession__latitude',
+                    'obs_unit__accession__country', 'value', 'obs_unit_id')
+
 '''
 Search Endpoint
 '''
+@conditional(data_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 def search(request,query_term=None,format=None):
@@ -59,6 +76,16 @@ def search(request,query_term=None,format=None):
           required: true
           type: string
           paramType: path
+        - name: page
+          description: the page (starting at 1) of the ranked results of each type
+          required: false
+          type: integer
+          paramType: query
+        - name: page_size
+          description: number of results of each type per page (default 100, at most 1000)
+          required: false
+          type: integer
+          paramType: query
 
     serializer: PhenotypeListSerializer
     omit_serializer: false
@@ -68,31 +95,37 @@ def search(request,query_term=None,format=None):
         - application/json
     """
     if request.method == "GET":
-        if query_term==None:
-            studies = Study.objects.published().all()
-            phenotypes = Phenotype.objects.published().all()
-            accessions = Accession.objects.all()
-            ontologies = OntologyTerm.objects.all()
-        else:
-            studies = Study.objects.published().filter(name__icontains=query_term)
-            phenotypes = Phenotype.objects.published().filter(Q(name__icontains=query_term) |
-                                                  Q(to_term__id__icontains=query_term) |
-                                                  Q(to_term__name__icontains=query_term))
-            accessions = Accession.objects.filter(name__icontains=query_term)
-            ontologies = OntologyTerm.objects.filter(name__icontains=query_term)
-
-        study_serializer = StudyListSerializer(studies,many=True)
-        phenotype_serializer = PhenotypeListSerializer(phenotypes,many=True)
-        accession_serializer = AccessionListSerializer(accessions,many=True)
-        ontology_serializer = OntologyTermListSerializer(ontologies,many=True)
+        try:
+            page = int(request.query_params.get('page', 1))
+            page_size = min(int(request.query_params.get('page_size', 100)), MAX_PAGE_SIZE)
+        except ValueError:
+            return Response('page and page_size must be integers', status.HTTP_400_BAD_REQUEST)
+        if page < 1 or page_size < 1:
+            return Response('page and page_size must be positive', status.HTTP_400_BAD_REQUEST)
+        results = search_index(query_term)
+        querysets = get_querysets()
+        start = (page - 1) * page_size
+        pages = dict((entity, RankedResults(querysets[entity], pks)[start:start + page_size])
+                     for entity, pks in results.items())
+        study_serializer = StudyListSerializer(pages['study'],many=True)
+        phenotype_serializer = PhenotypeListSerializer(pages['phenotype'],many=True)
+        accession_serializer = AccessionListSerializer(pages['accession'],many=True)
+        ontology_serializer = OntologyTermListSerializer(pages['ontology'],many=True)
         return Response({'phenotype_search_results':phenotype_serializer.data,
                          'study_search_results':study_serializer.data,
                          'accession_search_results':accession_serializer.data,
-                         'ontology_search_results':ontology_serializer.data})
+                         'ontology_search_results':ontology_serializer.data,
+                         'phenotype_search_count':len(results['phenotype']),
+                         'study_search_count':len(results['study']),
+                         'accession_search_count':len(results['accession']),
+                         'ontology_search_count':len(results['ontology']),
+                         'page':page,
+                         'page_size':page_size})
 
 '''
 List all phenotypes
 '''
+@conditional(data_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((PhenotypeListRenderer,JSONRenderer))
@@ -116,6 +149,7 @@ def phenotype_list(request,format=None):
 '''
 List all similar phenotypes
 '''
+@conditional(data_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((PhenotypeListRenderer,JSONRenderer))
@@ -147,6 +181,7 @@ def phenotype_similar_list(request,q,format=None):
 '''
 Detail information about phenotype
 '''
+@conditional(phenotype_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((PhenotypeListRenderer,JSONRenderer))
@@ -185,9 +220,10 @@ def phenotype_detail(request,q,format=None):
 '''
 Get all phenotype values
 '''
+@conditional(phenotype_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
-@renderer_classes((PhenotypeValueRenderer,JSONRenderer,PLINKRenderer,))
+@renderer_classes((PhenotypeValueRenderer,PhenotypeValueJSONRenderer,PLINKRenderer,))
 def phenotype_value(request,q,format=None):
     """
     List of the phenotype values
@@ -198,6 +234,21 @@ def phenotype_value(request,q,format=None):
           required: true
           type: string
           paramType: path
+        - name: stream
+          description: stream the values row by row instead of serializing them in one go
+          required: false
+          type: boolean
+          paramType: query
+        - name: page
+          description: return only this page (starting at 1) of the values. The total number of values is sent in the X-Total-Count header
+          required: false
+          type: integer
+          paramType: query
+        - name: page_size
+          description: number of values per page (default 100, at most 1000)
+          required: false
+          type: integer
+          paramType: query
 
     serializer: PhenotypeValueSerializer
     omit_serializer: false
@@ -209,18 +260,29 @@ def phenotype_value(request,q,format=None):
     doi = _is_doi(DOI_PATTERN_PHENOTYPE, q)
     try:
         id = doi if doi else int(q)
-        phenotype = Phenotype.objects.published().get(pk=id)
+        # like the phenotype detail page, the values of unpublished phenotypes are served by id
+        phenotype = Phenotype.objects.get(pk=id)
     except:
         return HttpResponse(status=404)
 
     if request.method == "GET":
+        if _is_streaming(request):
+            return _stream_values(request, phenotype.name, phenotype.phenotypevalue_set)
         pheno_acc_infos = phenotype.phenotypevalue_set.prefetch_related('obs_unit__accession')
+        try:
+            pheno_acc_infos, total = _paginate(request, pheno_acc_infos)
+        except ValueError as err:
+            return Response(str(err), status.HTTP_400_BAD_REQUEST)
         value_serializer = PhenotypeValueSerializer(pheno_acc_infos,many=True)
-        return Response(value_serializer.data)
+        response = Response(value_serializer.data)
+        if total is not None:
+            response['X-Total-Count'] = total
+        return response
 
 '''
 Get all rnaseq values
 '''
+@conditional(study_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((PhenotypeValueRenderer,JSONRenderer,PLINKRenderer,))
@@ -255,6 +317,9 @@ def rnaseq_value_by_gene_id(request,study_id,gene_id,format=None):
         return HttpResponse(status=404)
 
     if request.method == "GET":
+        rows = get_value_rows(rnaseq)
+        if rows is not None:
+            return Response(_value_rows_data(rows))
         pheno_acc_infos = rnaseq.rnaseqvalue_set.prefetch_related('obs_unit__accession')
         value_serializer = PhenotypeValueSerializer(pheno_acc_infos,many=True)
         return Response(value_serializer.data)
@@ -262,9 +327,10 @@ def rnaseq_value_by_gene_id(request,study_id,gene_id,format=None):
 '''
 Get all rnaseq values
 '''
+@conditional(rnaseq_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
-@renderer_classes((PhenotypeValueRenderer,JSONRenderer,PLINKRenderer,))
+@renderer_classes((PhenotypeValueRenderer,PhenotypeValueJSONRenderer,PLINKRenderer,))
 def rnaseq_value(request,q,format=None):
     """
     List of the rnaseq values
@@ -275,6 +341,21 @@ def rnaseq_value(request,q,format=None):
           required: true
           type: string
           paramType: path
+        - name: stream
+          description: stream the values row by row instead of serializing them in one go
+          required: false
+          type: boolean
+          paramType: query
+        - name: page
+          description: return only this page (starting at 1) of the values. The total number of values is sent in the X-Total-Count header
+          required: false
+          type: integer
+          paramType: query
+        - name: page_size
+          description: number of values per page (default 100, at most 1000)
+          required: false
+          type: integer
+          paramType: query
 
     serializer: PhenotypeValueSerializer
     omit_serializer: false
@@ -291,13 +372,192 @@ def rnaseq_value(request,q,format=None):
         return HttpResponse(status=404)
 
     if request.method == "GET":
+        rows = get_value_rows(rnaseq)
+        if rows is not None:
+            # read from the stored RNASeq matrix
+            if _is_streaming(request):
+                return _stream_rows(request, rows)
+            try:
+                rows, total = _paginate(request, rows)
+            except ValueError as err:
+                return Response(str(err), status.HTTP_400_BAD_REQUEST)
+            response = Response(_value_rows_data(rows))
+            if total is not None:
+                response['X-Total-Count'] = total
+            return response
+        if _is_streaming(request):
+            return _stream_values(request, rnaseq.name, rnaseq.rnaseqvalue_set)
         pheno_acc_infos = rnaseq.rnaseqvalue_set.prefetch_related('obs_unit__accession')
+        try:
+            pheno_acc_infos, total = _paginate(request, pheno_acc_infos)
+        except ValueError as err:
+            return Response(str(err), status.HTTP_400_BAD_REQUEST)
         value_serializer = PhenotypeValueSerializer(pheno_acc_infos,many=True)
-        return Response(value_serializer.data)
+        response = Response(value_serializer.data)
+        if total is not None:
+            response['X-Total-Count'] = total
+        return response
+
+'''
+Get the rnaseq values of a gene in all studies
+'''
+@conditional(data_validators)
+@api_view(['GET'])
+@permission_classes((IsAuthenticatedOrReadOnly,))
+@renderer_classes((GeneValuesRenderer,JSONRenderer))
+def rnaseq_gene_values(request,gene_id,format=None):
+    """
+    Values of a gene in all RNASeq studies aligned by accession (values of replicates are averaged).
+    A gene id without isoform suffix also returns the values of its isoforms
+    ---
+    parameters:
+        - name: gene_id
+          description: the gene id, e.g. AT1G01010 or AT1G01010.1
+          required: true
+          type: string
+          paramType: path
+
+    produces:
+        - text/csv
+        - application/json
+    """
+    gene_id = _is_geneid(gene_id)
+    if gene_id is None:
+        return HttpResponse(status=404)
+
+    if request.method == "GET":
+        data = get_gene_values(gene_id)
+        if not data['rnaseqs']:
+            return HttpResponse(status=404)
+        return Response(data)
+
+'''
+Get the co-expressed genes of a gene
+'''
+@conditional(study_validators)
+@api_view(['GET'])
+@permission_classes((IsAuthenticatedOrReadOnly,))
+@renderer_classes((JSONRenderer,))
+def rnaseq_coexpression(request,study_id,gene_id,format=None):
+    """
+    The genes of the study with the highest Pearson correlation of their values with the values of the gene
+    ---
+    parameters:
+        - name: study_id
+          description: the id of the study
+          required: true
+          type: int
+          paramType: path
+        - name: gene_id
+          description: the gene_id of the rnaseq
+          required: true
+          type: string
+          paramType: path
+        - name: k
+          description: number of genes (default 20, at most 500)
+          required: false
+          type: integer
+          paramType: query
+        - name: growth_conditions
+          description: the growth conditions of the rnaseq if the study has several
+          required: false
+          type: string
+          paramType: query
+
+    produces:
+        - application/json
+    """
+    rnaseqs = RNASeq.objects.select_related('study').filter(study_id=int(study_id), study__submission__status=PUBLISHED,
+                                                          name=_is_geneid(gene_id))
+    growth_conditions = request.query_params.get('growth_conditions')
+    if growth_conditions:
+        rnaseqs = rnaseqs.filter(growth_conditions=growth_conditions)
+    rnaseq = rnaseqs.order_by('id').first()
+    if rnaseq is None:
+        return HttpResponse(status=404)
+    try:
+        k = int(request.query_params.get('k', 20))
+    except ValueError:
+        return Response({'message':'k must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    if k < 1:
+        return Response({'message':'k must be positive'}, status=status.HTTP_400_BAD_REQUEST)
+
+    if request.method == "GET":
+        return Response(get_coexpressed_genes(rnaseq, min(k, MAX_NEIGHBOURS)))
+
+'''
+Get the rnaseq values of multiple genes
+'''
+@conditional(study_validators)
+@api_view(['GET', 'POST'])
+@permission_classes((AllowAny,))
+@renderer_classes((PhenotypeMatrixRenderer,PhenotypeMatrixColumnsJSONRenderer,PLINKMatrixRenderer))
+@parser_classes((JSONParser,))
+def rnaseq_gene_matrix(request,study_id,format=None):
+    """
+    Matrix of the rnaseq values of multiple genes of a study (one column per gene and one row per accession).
+    The genes are passed as comma separated query parameter or POSTed as JSON list or as {"genes": [...], "growth_conditions": "..."}
+    ---
+    parameters:
+        - name: study_id
+          description: the id of the study
+          required: true
+          type: int
+          paramType: path
+        - name: genes
+          description: comma separated gene ids (at most 500)
+          required: true
+          type: string
+          paramType: query
+        - name: growth_conditions
+          description: only return the rnaseqs with these growth conditions
+          required: false
+          type: string
+          paramType: query
+
+    produces:
+        - text/csv
+        - application/json
+        - application/plink
+    """
+    try:
+        study = Study.objects.published().get(pk=int(study_id))
+    except:
+        return HttpResponse(status=404)
+
+    if request.method == "POST":
+        data = request.data
+        if isinstance(data, dict):
+            genes = data.get('genes') or []
+            growth_conditions = data.get('growth_conditions')
+        else:
+            genes = data
+            growth_conditions = None
+    else:
+        genes = request.query_params.get('genes', '').split(',')
+        growth_conditions = request.query_params.get('growth_conditions')
+    if not isinstance(genes, list):
+        return Response('genes must be a list of gene ids', status.HTTP_400_BAD_REQUEST)
+    genes = [('%s' % gene).strip() for gene in genes]
+    genes = [gene for gene in genes if gene]
+    invalid = [gene for gene in genes if _is_geneid(gene) != gene]
+    if invalid:
+        return Response('Invalid gene ids: %s' % ', '.join(invalid), status.HTTP_400_BAD_REQUEST)
+    if not genes or len(set(genes)) > MAX_GENES:
+        return Response('Between 1 and %s gene ids are required' % MAX_GENES, status.HTTP_400_BAD_REQUEST)
+
+    rnaseqs = RNASeq.objects.filter(study_id=study.id, name__in=set(genes))
+    if growth_conditions:
+        rnaseqs = rnaseqs.filter(growth_conditions=growth_conditions)
+    rnaseq_ids = list(rnaseqs.values_list('id', flat=True))
+    if not rnaseq_ids:
+        return HttpResponse(status=404)
+    return Response(get_gene_matrix(study, rnaseq_ids))
 
 '''
 List all studies
 '''
+@conditional(data_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((StudyListRenderer,JSONRenderer))
@@ -322,6 +582,7 @@ def study_list(request,format=None):
 '''
 Get detailed information about study
 '''
+@conditional(study_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((StudyListRenderer,JSONRenderer))
@@ -353,6 +614,7 @@ def study_detail(request,q,format=None):
 '''
 List all phenotypes for study id/doi
 '''
+@conditional(study_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((PhenotypeListRenderer,JSONRenderer,))
@@ -382,9 +644,10 @@ def study_all_pheno(request,q=None,format=None):
 '''
 List phenotype value matrix for entire study
 '''
+@conditional(study_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
-@renderer_classes((PhenotypeMatrixRenderer,PLINKMatrixRenderer,JSONRenderer))
+@renderer_classes((PhenotypeMatrixRenderer,PLINKMatrixRenderer,PhenotypeMatrixJSONRenderer))
 def study_phenotype_value_matrix(request,q,format=None):
     """
     Phenotype value matrix for entire study
@@ -409,10 +672,9 @@ def study_phenotype_value_matrix(request,q,format=None):
         return HttpResponse(status=404)
 
     if request.method == "GET":
-        df,df_pivot = study.get_matrix_and_accession_map()
-        data = _convert_dataframe_to_list(df,df_pivot)
-        return Response(data)
+        return Response(get_study_matrix(study))
 
+@conditional(phenotype_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((TransformationRenderer,JSONRenderer))
@@ -444,13 +706,160 @@ def transformations(request,q,transformation=None, format=None):
         return HttpResponse(status=404)
 
     if request.method == "GET":
-        data = calculate_phenotype_transformations(phenotype, transformation)
+        data = get_transformations(phenotype, transformation)
         return Response(data)
 
 
+'''
+Stored distribution statistics of a phenotype
+'''
+@conditional(phenotype_validators)
+@api_view(['GET'])
+@permission_classes((IsAuthenticatedOrReadOnly,))
+@renderer_classes((JSONRenderer,))
+def phenotype_statistics(request,q,format=None):
+    """
+    Distribution statistics of the phenotype values
+    ---
+    parameters:
+        - name: q
+          description: the id or doi of the phenotype
+          required: true
+          type: string
+          paramType: path
+
+    serializer: StatisticsSerializer
+    omit_serializer: false
+
+    produces:
+        - application/json
+    """
+    doi = _is_doi(DOI_PATTERN_PHENOTYPE, q)
+    try:
+        id = doi if doi else int(q)
+        phenotype = Phenotype.objects.published().select_related('study').get(pk=id)
+    except:
+        return HttpResponse(status=404)
+
+    if request.method == "GET":
+        serializer = StatisticsSerializer(get_statistics(phenotype),many=False)
+        return Response(serializer.data)
+
+
+'''
+Stored distribution statistics of a RNASeq
+'''
+@conditional(rnaseq_validators)
+@api_view(['GET'])
+@permission_classes((IsAuthenticatedOrReadOnly,))
+@renderer_classes((JSONRenderer,))
+def rnaseq_statistics(request,q,format=None):
+    """
+    Distribution statistics of the rnaseq values
+    ---
+    parameters:
+        - name: q
+          description: the id or doi of the rnaseq
+          required: true
+          type: string
+          paramType: path
+
+    serializer: StatisticsSerializer
+    omit_serializer: false
+
+    produces:
+        - application/json
+    """
+    doi = _is_doi(DOI_PATTERN_PHENOTYPE, q)
+    try:
+        id = doi if doi else int(q)
+        rnaseq = RNASeq.objects.select_related('study').get(pk=id)
+    except:
+        return HttpResponse(status=404)
+
+    if request.method == "GET":
+        serializer = StatisticsSerializer(get_statistics(rnaseq, rnaseq=True),many=False)
+        return Response(serializer.data)
+
+
+'''
+Pre-binned summary of the values of a phenotype
+'''
+@conditional(phenotype_validators)
+@api_view(['GET'])
+@permission_classes((IsAuthenticatedOrReadOnly,))
+@renderer_classes((JSONRenderer,))
+def phenotype_summary(request,q,format=None):
+    """
+    Histogram, quantiles and per country aggregates of the phenotype values
+    ---
+    parameters:
+        - name: q
+          description: the id or doi of the phenotype
+          required: true
+          type: string
+          paramType: path
+        - name: bins
+          description: the number of histogram bins (default 20, at most 200)
+          required: false
+          type: integer
+          paramType: query
+
+    produces:
+        - application/json
+    """
+    doi = _is_doi(DOI_PATTERN_PHENOTYPE, q)
+    try:
+        id = doi if doi else int(q)
+        phenotype = Phenotype.objects.published().get(pk=id)
+    except:
+        return HttpResponse(status=404)
+
+    if request.method == "GET":
+        return _summary_response(request, phenotype)
+
+
+'''
+Pre-binned summary of the values of a RNASeq
+'''
+@conditional(rnaseq_validators)
+@api_view(['GET'])
+@permission_classes((IsAuthenticatedOrReadOnly,))
+@renderer_classes((JSONRenderer,))
+def rnaseq_summary(request,q,format=None):
+    """
+    Histogram, quantiles and per country aggregates of the rnaseq values
+    ---
+    parameters:
+        - name: q
+          description: the id or doi of the rnaseq
+          required: true
+          type: string
+          paramType: path
+        - name: bins
+          description: the number of histogram bins (default 20, at most 200)
+          required: false
+          type: integer
+          paramType: query
+
+    produces:
+        - application/json
+    """
+    doi = _is_doi(DOI_PATTERN_PHENOTYPE, q)
+    try:
+        id = doi if doi else int(q)
+        rnaseq = RNASeq.objects.get(pk=id)
+    except:
+        return HttpResponse(status=404)
+
+    if request.method == "GET":
+        return _summary_response(request, rnaseq, rnaseq=True)
+
+
 '''
 Corrleation Matrix for selected phenotypes
 '''
+@conditional(data_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((JSONRenderer,))
@@ -458,87 +867,102 @@ def phenotype_correlations(request,q=None):
     """
     Return data for phenotype-phenotype correlations and between phenotype accession overlap
     ---
+    parameters:
+        - name: aggregate
+          description: how replicates of an accession are collapsed (mean or median, default mean)
+          required: false
+          type: string
+          paramType: query
 
     produces:
         - application/json
     """
     #id string to list
     pids = map(int,q.split(","))
-    pheno_dict = {}
-    for i,pid in enumerate(pids):
-        try:
-            phenotype = Phenotype.objects.published().get(pk=pid)
-        except:
-            return Response({'message':'FAILED','not_found':pid})
-        pheno_acc_infos = phenotype.phenotypevalue_set.prefetch_related('obs_unit__accession')
-        values = sp.array(pheno_acc_infos.values_list('value',flat=True))
-        samples = sp.array(pheno_acc_infos.values_list('obs_unit__accession__id',flat=True))
-        name = str(phenotype.name.replace("<i>","").replace("</i>","") + " (" + str(phenotype.study.name) + ")")
-        pheno_dict[str(phenotype.name) + "_" + str(phenotype.study.name) + "_" + str(i)] = {'samples':samples,
-                                                                                            'y':values,
-                                                                                            'name':name,
-                                                                                            'id':str(phenotype.id)}
-                                                                                            #str(phenotype.name) + "_" + str(phenotype.study.name) + "_" + str(i)}
-    #compute correlation matrix
-    corr_mat = sp.ones((len(pheno_dict),len(pheno_dict))) * sp.nan
-    spear_mat = sp.ones((len(pheno_dict),len(pheno_dict))) * sp.nan
-    pheno_keys = pheno_dict.keys()
-    axes_data = []
-    scatter_data = []
-    sample_data = []
-    slabels = {}
-    for i,pheno1 in enumerate(pheno_keys):
-        axes_data.append({"label":pheno_dict[pheno1]['name'],
-                          "index":str(i),
-                          "pheno_id":str(pheno_dict[pheno1]['id'])})
-        samples1 = pheno_dict[pheno1]['samples']
-        y1 = pheno_dict[pheno1]['y']
-        #store scatter data
-        scatter_data.append({"label":pheno_dict[pheno1]['name'],
-                             "pheno_id":str(pheno_dict[pheno1]['id']),
-                             "samples": samples1.tolist(),
-                             "values":y1.tolist()})
-
-        for j,pheno2 in enumerate(pheno_keys):
-            samples2 = pheno_dict[pheno2]['samples']
-            y2 = pheno_dict[pheno2]['y']
-            #match accessions
-            ind = (sp.reshape(samples1,(samples1.shape[0],1))==samples2).nonzero()
-            y_tmp = y1[ind[0]]
-            y2 = y2[ind[1]]
-            if y1.shape[0]>0 and y2.shape[0]>0:
-                corr_mat[i][j] = stats.pearsonr(y_tmp.flatten(),y2.flatten())[0]
-                spear_mat[i][j] = stats.spearmanr(y_tmp.flatten(),y2.flatten())[0]
-            #compute sample intersections
-            if pheno1==pheno2:
-                continue
-            if pheno1 + "_" + pheno2 in slabels:
-                continue
-            if pheno2 + "_" + pheno1 in slabels:
-                continue
-            slabels[pheno1 + "_" + pheno2] = True
-            A = samples1.shape[0]
-            B = samples2.shape[0]
-            C = sp.intersect1d(samples1,samples2).shape[0]
-            sample_data.append({"labelA":pheno_dict[pheno1]['name'],
-                                "labelA_id":pheno_dict[pheno1]['id'],
-                                "labelB":pheno_dict[pheno2]['name'],
-                                "labelB_id":pheno_dict[pheno2]['id'],
-                                "A":A, "B":B, "C":C})
-    data = {}
-    data['axes_data'] = axes_data
-    data['scatter_data'] = scatter_data
-    data['sample_data'] = sample_data
-    data['corr_mat'] = str(corr_mat.tolist()).replace("nan","NaN")
-    data['spear_mat'] = str(spear_mat.tolist()).replace("nan","NaN")
+    aggregate = request.query_params.get('aggregate', 'mean')
+    if aggregate not in AGGREGATES:
+        return Response({'message':'Aggregate %s not supported' % aggregate}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        data = get_phenotype_correlations(pids, aggregate)
+    except PhenotypeNotFound as err:
+        return Response({'message':'FAILED','not_found':err.phenotype_id})
+    if request.method == "GET":
+        return Response(data)
+
+
+'''
+Association scan of a phenotype against the genes of an RNASeq study
+'''
+@conditional(data_validators)
+@api_view(['GET'])
+@permission_classes((IsAuthenticatedOrReadOnly,))
+@renderer_classes((JSONRenderer,))
+def phenotype_rnaseq_association(request,q,study_id,format=None):
+    """
+    Correlations of the accession means of a phenotype with the expression of all genes of an RNASeq study.
+    Returns the genes with the lowest p-values (with Benjamini-Hochberg q-values) per growth condition
+    ---
+    parameters:
+        - name: q
+          description: the id or doi of the phenotype
+          required: true
+          type: string
+          paramType: path
+        - name: study_id
+          description: the id of the RNASeq study
+          required: true
+          type: int
+          paramType: path
+        - name: method
+          description: pearson or spearman (default pearson)
+          required: false
+          type: string
+          paramType: query
+        - name: growth_conditions
+          description: only scan the genes of these growth conditions
+          required: false
+          type: string
+          paramType: query
+        - name: top
+          description: number of genes per growth condition (default 50, at most 1000)
+          required: false
+          type: integer
+          paramType: query
 
+    produces:
+        - application/json
+    """
+    doi = _is_doi(DOI_PATTERN_PHENOTYPE, q)
+    try:
+        id = doi if doi else int(q)
+        phenotype = Phenotype.objects.published().get(pk=id)
+        study = Study.objects.published().get(pk=int(study_id))
+    except:
+        return HttpResponse(status=404)
+    if not study.rnaseq_set.exists():
+        return HttpResponse(status=404)
+
+    method = request.query_params.get('method', 'pearson')
+    if method not in METHODS:
+        return Response({'message':'Method %s not supported' % method}, status=status.HTTP_400_BAD_REQUEST)
+    try:
+        top = int(request.query_params.get('top', 50))
+    except ValueError:
+        return Response({'message':'top must be an integer'}, status=status.HTTP_400_BAD_REQUEST)
+    if top < 1:
+        return Response({'message':'top must be positive'}, status=status.HTTP_400_BAD_REQUEST)
     if request.method == "GET":
+        try:
+            data = scan_association(phenotype, study, method, request.query_params.get('growth_conditions'), min(top, 1000))
+        except AssociationError as err:
+            return Response({'message':str(err)}, status=status.HTTP_400_BAD_REQUEST)
         return Response(data)
 
 
 '''
 Returns ISA-TAB archive
 '''
+@conditional(study_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((IsaTabFileRenderer,JSONRenderer))
@@ -563,18 +987,21 @@ def study_isatab(request,q,format=None):
     except:
         return HttpResponse(status=404)
 
-    isa_tab_file = export_isatab(study)
-    zip_file = open(isa_tab_file, 'rb')
-    response = FileResponse(zip_file,content_type='application/zip')
-    #response = HttpResponse(FileWrapper(zip_file), content_type='application/zip',content_transfer_encoding='binary')
+    isa_tab_file = get_cached_archive(study)
+    if isa_tab_file is not None:
+        response = FileResponse(open(isa_tab_file, 'rb'),content_type='application/zip')
+        response['Content-Length'] = os.path.getsize(isa_tab_file)
+    else:
+        # the archive is sent while it is built and cached for the next downloads
+        response = StreamingHttpResponse(stream_isatab(study),content_type='application/zip')
     response.setdefault('Content-Transfer-Encoding','binary')
     response['Content-Disposition'] = 'attachment; filename="isatab_study_%s.zip"' % study.id
-    os.unlink(isa_tab_file)
     return response
 
 '''
 List all studies
 '''
+@conditional(data_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((AccessionListRenderer,JSONRenderer))
@@ -602,6 +1029,7 @@ def accession_list(request,format=None):
 '''
 Get detailed information about study
 '''
+@conditional(data_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((AccessionListRenderer,JSONRenderer))
@@ -625,6 +1053,7 @@ def accession_detail(request,pk,format=None):
         return Response(serializer.data)
 
 
+@conditional(data_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((PhenotypeListRenderer,JSONRenderer,))
@@ -672,6 +1101,7 @@ def accessions_phenotypes(request,format=None):
         return Response(serializer.data)
 
 
+@conditional(data_validators)
 @api_view(['GET'])
 @permission_classes((IsAuthenticatedOrReadOnly,))
 @renderer_classes((JSONRenderer,))
@@ -683,12 +1113,10 @@ def ontology_tree_data(request,acronym=None,term_id=None,format=None):
         - application/json
     """
     if term_id is not None:
-        term = OntologyTerm.objects.get(pk=term_id)
-        data = [{'text':t.name,'id':t.id, 'children': True if t.children.count() > 0 else False} for t in term.children.all()]
+        data = get_children(term_id)
     else:
         source = OntologySource.objects.get(acronym=acronym)
-        roots = source.ontologyterm_set.filter(parents=None)
-        data = [{'text':term.name,'id':term.id,'children':True if term.children.count() > 0 else False} for term in roots]
+        data = get_roots(source)
     return Response(data)
 
 
@@ -783,20 +1211,58 @@ def delete_submission(request,pk,format=None):
 
 
 
-def _convert_dataframe_to_list(df, df_pivot):
-    df_pivot = df_pivot.fillna('')
-    data = []
-    headers = df_pivot.columns.tolist()
-    for obs_unit_id,row in df_pivot.iterrows():
-        info = df.ix[obs_unit_id]
-        accession_id = info.accession_id
-        accession_name = info.accession_name
-        csv_row = {'obs_unit_id':obs_unit_id,'accession_id':accession_id,'accession_name':accession_name}
-        for i,value in enumerate(row.values):
-            csv_row[headers[i]] = value
-        data.append(csv_row)
-    return data
+def _is_streaming(request):
+    return request.query_params.get('stream', '').lower() in ('1', 'true', 'yes')
 
+def _paginate(request, value_set, default_size=100, max_size=1000):
+    """
+    Returns the requested page of the values (ordered by id) or of a list of value rows
+    and the total number of values or the unchanged value_set and None if no page is requested
+    """
+    page = request.query_params.get('page')
+    if page is None:
+        return value_set, None
+    try:
+        page = int(page)
+        page_size = int(request.query_params.get('page_size', default_size))
+    except ValueError:
+        raise ValueError('page and page_size must be integers')
+    if page < 1 or page_size < 1:
+        raise ValueError('page and page_size must be positive')
+    page_size = min(page_size, max_size)
+    start = (page - 1) * page_size
+    if isinstance(value_set, list):
+        return value_set[start:start + page_size], len(value_set)
+    return value_set.order_by('id')[start:start + page_size], value_set.count()
+
+def _summary_response(request, variable, rnaseq=False):
+    try:
+        bins = int(request.query_params.get('bins', HISTOGRAM_BINS))
+    except ValueError:
+        return Response('bins must be an integer', status.HTTP_400_BAD_REQUEST)
+    return Response(get_value_summary(variable, rnaseq, bins))
+
+def _iter_value_rows(name, value_set):
+    """
+    Yields flat value rows in the order of PhenotypeValueRenderer.header.
+    Uses a server-side cursor (where supported) instead of model instances
+    """
+    for row in value_set.values_list(*VALUE_ROW_FIELDS).iterator():
+        yield (name,) + row
+
+def _stream_values(request, name, value_set):
+    return _stream_rows(request, _iter_value_rows(name, value_set))
+
+def _stream_rows(request, rows):
+    renderer = request.accepted_renderer
+    content_type = renderer.media_type
+    if renderer.charset:
+        content_type = '%s; charset=%s' % (content_type, renderer.charset)
+    return StreamingHttpResponse(renderer.render_rows(rows), content_type=content_type)
+
+def _value_rows_data(rows):
+    """Returns flat value rows as the serialized data of the PhenotypeValueSerializer"""
+    return [OrderedDict(zip(PhenotypeValueRenderer.header, row)) for row in rows]
 
 
 def _is_doi(pattern, term):
@@ -812,71 +1278,3 @@ def _is_geneid(term):
         # can't use REGEX capture groups because "("" causes problems in Swagger
         return gene_id.group()
     return None
-
-def generate_database_dump():
-    """
-    Generate an archive of the full database
-    """
-    # create temorary folder
-    arapheno_filename = "database"
-    output_filename = os.path.join(settings.STATIC_ROOT, '%s.zip' % arapheno_filename)
-
-    folder = tempfile.mkdtemp()
-
-    # Get list of studies ids
-    studies = Study.objects.published().filter(rnaseq__isnull=True).all()
-    # Create subfolders
-    for study in studies:
-        os.makedirs(os.path.join(folder, str(study.id)))
-
-    # create the isatab files
-    _create_value_files(studies, folder, fmt='csv')
-    _create_value_files(studies, folder, fmt='plink')
-    _create_study_list_file(studies, folder)
-    _create_phenotypes_files(studies, folder)
-
-    # zip it
-    output_filename = shutil.make_archive(arapheno_filename,"zip",folder)
-    shutil.move(output_filename, os.path.join(settings.STATIC_ROOT, os.path.basename(output_filename)))
-
-    # remove temporary folder
-    shutil.rmtree(folder)
-    return output_filename
-
-
-def _create_value_files(studies, folder, fmt):
-    if fmt == 'csv':
-        renderer = PhenotypeMatrixRenderer()
-    elif fmt == 'plink':
-        renderer = PLINKMatrixRenderer()
-    else:
-        raise Warning('The format must be csv or plink.')
-
-    for study in studies:
-        logger.info("Creating value files for %s" % study)
-        df,df_pivot = study.get_matrix_and_accession_map()
-        data = _convert_dataframe_to_list(df,df_pivot)
-        content = renderer.render(data)
-        study_filename = os.path.join(folder,str(study.id),'study_%s_values.%s' % (study.id, fmt))
-        with open(study_filename,'w') as f:
-            f.write(content)
-    pass
-
-def _create_phenotypes_files(studies, folder):
-    renderer = PhenotypeListRenderer()
-    for study in studies:
-        serializer = PhenotypeListSerializer(study.phenotype_set.all(),many=True)
-        content = renderer.render(serializer.data)
-        study_filename = os.path.join(folder,str(study.id),'study_%s_phenotypes.csv' % study.id)
-        with open(study_filename,'w') as f:
-            f.write(content)
-    pass
-
-def _create_study_list_file(studies, folder):
-    renderer = StudyListRenderer()
-    serializer = StudyListSerializer(studies,many=True)
-    content = renderer.render(serializer.data)
-    study_list_filename = os.path.join(folder,'study_list.csv')
-    with open(study_list_filename,'w') as f:
-        f.write(content)
-    pass
\ No newline at end of file
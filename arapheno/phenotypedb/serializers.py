@@ -1,7 +1,10 @@
+import json
+
 from rest_framework import serializers
 
 from phenotypedb.models import Phenotype,PhenotypeValue,Study, Accession, OntologyTerm, OntologySource
 from phenotypedb.models import ObservationUnit, Submission, StudyCuration, PhenotypeCuration, Curation
+from phenotypedb.models import StatisticsResult
 
 '''
 Phenotype List Serializer Class (read-only: might be extended to also allow integration of new data)
@@ -176,6 +179,36 @@ class AccessionPhenotypesSerializer(serializers.Serializer):
         return data
 
 
+'''
+Stored Statistics Serializer Class
+'''
+class StatisticsSerializer(serializers.ModelSerializer):
+    shapiro_test_statistic = serializers.SerializerMethodField()
+    shapiro_p_value = serializers.SerializerMethodField()
+    histogram = serializers.SerializerMethodField()
+    value_counts = serializers.SerializerMethodField()
+
+    class Meta:
+        model = StatisticsResult
+        fields = ('count','mean','variance','minimum','first_quartile','median',
+                  'third_quartile','maximum','shapiro_test_statistic','shapiro_p_value',
+                  'histogram','value_counts')
+
+    def get_shapiro_test_statistic(self,obj):
+        return self._variable(obj).shapiro_test_statistic
+
+    def get_shapiro_p_value(self,obj):
+        return self._variable(obj).shapiro_p_value
+
+    def get_histogram(self,obj):
+        return json.loads(obj.histogram) if obj.histogram else None
+
+    def get_value_counts(self,obj):
+        return json.loads(obj.value_counts) if obj.value_counts else None
+
+    def _variable(self,obj):
+        return obj.phenotype if obj.phenotype_id else obj.rnaseq
+
 '''
 Phenotype Value Serializer Class
 '''
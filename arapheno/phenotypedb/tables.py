@@ -3,11 +3,22 @@ Tables for django-table2
 """
 from django.db.models import Count
 import django_tables2 as tables
+from django_tables2.data import TableListData
 from django_tables2.utils import A
 from django.utils.safestring import mark_safe
 import numpy as np
 
 
+class RankedTableData(TableListData):
+    """
+    Table data of ranked search results. The rows are not reordered
+    and only the rows of the displayed page are fetched
+    """
+
+    def order_by(self, aliases):
+        pass
+
+
 class ReducedPhenotypeTable(tables.Table):
     """
     Table that is displayed in the Study detail view
@@ -1,3 +1,665 @@
-from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+
+from home.autocomplete_light_registry import RNASeqGlobalSearchAutocomplete
+
+from phenotypedb.models import (PUBLISHED, SUBMITTED, Accession, ObservationUnit, OntologySource,
+                                OntologyTerm, OntologyTreeNode, Phenotype, PhenotypeValue, RNASeq, RNASeqGene,
+                                RNASeqValue, Species, StatisticsResult, Study, Submission)
+from utils import correlation, save_plink_or_csv
+from utils.association import fdr, pearson_columns, spearman_columns
+from utils.coexpression import nearest_rows
+from utils.dump import generate_database_dump, get_fingerprints
+from utils.gene_index import find_rnaseqs, rebuild_gene_index
+from utils.correlation import (CorrelationCache, aggregate_replicates, get_phenotype_correlations,
+                               pearson_matrix, spearman_matrix)
+from utils.matrix_cache import get_study_matrix
+from utils.ontology import build_tree
+from utils.precompute import precompute_study
+from utils.rnaseq_store import get_rnaseq_matrix, standardize, store_rnaseq_matrix
+from utils.search import DatabaseRanking, search
+from utils.statistics import BOX_COX_LAMBDAS, SUPPORTED_TRANSFORMATIONS, transform, transform_all
+
+
+def create_species():
+    # the importers use the species with pk 1
+    return Species.objects.create(pk=1, ncbi_id=3702, genus='Arabidopsis', species='thaliana')
+
+
+def create_accessions(species, count):
+    return [Accession.objects.create(pk=6000 + i, name='acc%s' % i, species=species) for i in range(count)]
+
+
+def create_study(name, species, status=PUBLISHED):
+    study = Study.objects.create(name=name, species=species)
+    Submission.objects.create(study=study, status=status, publisher='publisher',
+                              firstname='first', lastname='last', email='first@last.org')
+    return study
+
+
+def create_phenotype_study(name, species, accessions, values, status=PUBLISHED):
+    """Creates a study with one obs_unit per accession and one phenotype per column of values (NaN for missing)"""
+    study = create_study(name, species, status)
+    obs_units = [ObservationUnit.objects.create(study=study, accession=accession) for accession in accessions]
+    for column in range(values.shape[1]):
+        phenotype = Phenotype.objects.create(name='%s_%s' % (name, column), study=study, species=species)
+        for row, obs_unit in enumerate(obs_units):
+            if not np.isnan(values[row, column]):
+                PhenotypeValue.objects.create(value=values[row, column], phenotype=phenotype, obs_unit=obs_unit)
+    return study
+
+
+def create_rnaseq_study(name, species, accessions, values, growth_conditions=None, status=PUBLISHED):
+    """Creates a study with one obs_unit per accession and one rnaseq per column of values (NaN for missing)"""
+    study = create_study(name, species, status)
+    obs_units = [ObservationUnit.objects.create(study=study, accession=accession) for accession in accessions]
+    for column in range(values.shape[1]):
+        rnaseq = RNASeq.objects.create(name='AT1G%05d' % column, study=study, species=species,
+                                       growth_conditions=growth_conditions)
+        for row, obs_unit in enumerate(obs_units):
+            if not np.isnan(values[row, column]):
+                RNASeqValue.objects.create(value=values[row, column], rnaseq=rnaseq, obs_unit=obs_unit)
+    return study
+
+
+def random_matrix(rows, columns, missing=0.2, seed=0):
+    """Returns a random matrix with a fraction of missing values and some tied values"""
+    random = np.random.RandomState(seed)
+    values = np.round(random.randn(rows, columns), 1)
+    values[random.rand(rows, columns) < missing] = np.nan
+    return values
+
+
+class TemporaryDirectoryMixin(object):
+    """Creates a temporary directory (self.tmp_dir) that is removed after the test"""
+
+    def setUp(self):
+        super(TemporaryDirectoryMixin, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir, True)
+
+
+class SearchIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.species = create_species()
+        source = OntologySource.objects.create(acronym='TO', name='Trait Ontology')
+        self.term = OntologyTerm.objects.create(id='TO:0000001', name='flowering time', source=source)
+        self.accession = Accession.objects.create(name='Col-0', species=self.species)
+
+    def test_search_after_publishing_before_first_search(self):
+        """Publishing a study before the first search must not prevent the full build of the index"""
+        study = create_study('flowering study', self.species)
+        results = search('flowering')
+        self.assertEqual(results['ontology'], [self.term.pk])
+        self.assertEqual(results['study'], [study.pk])
+        self.assertEqual(search('col')['accession'], [self.accession.pk])
+
+    def test_renamed_objects_are_reindexed(self):
+        study = create_phenotype_study('rename', self.species, [self.accession], np.array([[1.0]]))
+        phenotype = study.phenotype_set.get()
+        phenotype.name = 'leaf length'
+        phenotype.to_term = self.term
+        phenotype.save()
+        self.assertEqual(search('leaf length')['phenotype'], [phenotype.pk])
+        self.assertEqual(search('flowering time')['phenotype'], [phenotype.pk])
+        study.name = 'leaf study'
+        study.save()
+        self.assertEqual(search('leaf study')['study'], [study.pk])
+        self.assertEqual(search('rename')['study'], [])
+
+    def test_database_ranking(self):
+        """The ranking in the database (used on PostgreSQL) equals the ranking of the in-memory index"""
+        for i, name in enumerate(['time of flowering', 'flowering', 'flowering time 2', 'days to flowering']):
+            OntologyTerm.objects.create(id='TO:100000%s' % i, name=name, source=self.term.source)
+        for query in ('flowering', 'FLOWER', 'ing', ''):
+            ranking = DatabaseRanking('ontology', query.lower())
+            expected = search(query)['ontology']
+            self.assertEqual(len(ranking), len(expected))
+            self.assertEqual(ranking[:], expected)
+            self.assertEqual(ranking[1:3], expected[1:3])
+
+
+class RNASeqAutocompleteTestCase(TestCase):
+
+    def test_rnaseqs_are_queried_by_name_prefix(self):
+        species = create_species()
+        study = create_study('rnaseq', species)
+        rnaseqs = [RNASeq.objects.create(name=name, species=species, study=study)
+                   for name in ('AT1G01020.1', 'AT1G01020', 'AT1G01010', 'XAT1G01020')]
+        request = RequestFactory().get('/', {'q': 'at1g0102'})
+        html = RNASeqGlobalSearchAutocomplete(request=request).autocomplete_html()
+        self.assertTrue(html.index('/rnaseq/%s\'' % rnaseqs[1].pk) < html.index('/rnaseq/%s\'' % rnaseqs[0].pk))
+        self.assertNotIn('/rnaseq/%s\'' % rnaseqs[2].pk, html)
+        self.assertNotIn('/rnaseq/%s\'' % rnaseqs[3].pk, html)
+
+
+class OntologyTreeTestCase(TransactionTestCase):
+    """The tree nodes are updated on commit, so the test runs without the transaction of TestCase"""
+
+    def setUp(self):
+        self.species = create_species()
+        source = OntologySource.objects.create(acronym='TO', name='Trait Ontology')
+        root, leaf, other = [OntologyTerm.objects.create(id='TO:000000%s' % i, name=name, source=source)
+                             for i, name in enumerate(['trait', 'flowering time', 'leaf length'])]
+        root.children.add(leaf, other)
+        self.terms = (root, leaf, other)
+        self.study = create_phenotype_study('ontology', self.species, create_accessions(self.species, 1),
+                                            np.array([[1.0, 2.0]]), status=SUBMITTED)
+        Phenotype.objects.filter(name='ontology_0').update(to_term=leaf)
+        Phenotype.objects.filter(name='ontology_1').update(to_term=leaf, eo_term=other)
+
+    def assert_tree_is_up_to_date(self, phenotype_counts):
+        nodes = list(OntologyTreeNode.objects.order_by('pk').values())
+        self.assertEqual([node['phenotype_count'] for node in nodes], phenotype_counts)
+        build_tree()
+        self.assertEqual(list(OntologyTreeNode.objects.order_by('pk').values()), nodes)
+
+    def test_phenotype_counts_are_updated(self):
+        self.assert_tree_is_up_to_date([0, 0, 0])
+        submission = self.study.submission
+        submission.status = PUBLISHED
+        submission.save()
+        self.assert_tree_is_up_to_date([3, 2, 1])
+        submission.status = SUBMITTED
+        submission.save()
+        self.assert_tree_is_up_to_date([0, 0, 0])
+        submission.status = PUBLISHED
+        submission.save()
+        # published studies are only deleted with querysets, e.g. in the admin
+        Study.objects.filter(pk=self.study.pk).delete()
+        self.assert_tree_is_up_to_date([0, 0, 0])
+
+    def test_renamed_term_is_updated(self):
+        leaf = self.terms[1]
+        leaf.name = 'days to flowering'
+        leaf.save()
+        self.assertIn('days to flowering', OntologyTreeNode.objects.get(pk=self.terms[0].pk).children)
+        self.assert_tree_is_up_to_date([0, 0, 0])
+
+
+class StudyMatrixCacheTestCase(TemporaryDirectoryMixin, TestCase):
+
+    def setUp(self):
+        super(StudyMatrixCacheTestCase, self).setUp()
+        settings = override_settings(STUDY_MATRIX_CACHE_DIR=self.tmp_dir, RNASEQ_MATRIX_DIR=None, ISATAB_CACHE_DIR=None)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        species = create_species()
+        self.study = create_phenotype_study('cache', species, create_accessions(species, 3),
+                                            np.array([[1.0, 2.0], [3.0, 4.0], [5.0, np.nan]]))
+
+    def test_matrix_is_cached(self):
+        matrix = get_study_matrix(self.study)
+        np.testing.assert_array_equal(matrix.values, [[1.0, 2.0], [3.0, 4.0], [5.0, np.nan]])
+        self.assertTrue(isinstance(get_study_matrix(self.study).values, np.memmap))
+
+    def test_matrix_is_invalidated_when_a_value_is_saved_or_deleted(self):
+        get_study_matrix(self.study)
+        value = PhenotypeValue.objects.get(phenotype__name='cache_0', obs_unit__accession__name='acc1')
+        value.value = 7.0
+        value.save()
+        np.testing.assert_array_equal(get_study_matrix(self.study).values[:, 0], [1.0, 7.0, 5.0])
+        value.delete()
+        np.testing.assert_array_equal(get_study_matrix(self.study).values[:, 0], [1.0, np.nan, 5.0])
+
+
+class RNASeqStoreTestCase(TemporaryDirectoryMixin, TestCase):
+
+    def setUp(self):
+        super(RNASeqStoreTestCase, self).setUp()
+        settings = override_settings(STUDY_MATRIX_CACHE_DIR=None, RNASEQ_MATRIX_DIR=self.tmp_dir, ISATAB_CACHE_DIR=None)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        species = create_species()
+        self.study = create_rnaseq_study('store', species, create_accessions(species, 4),
+                                         np.array([[0.1, 2.0], [np.nan, 4.0], [1.0 / 3, 6.0], [0.7, 1.0]]))
+
+    def get_values(self):
+        rnaseq = self.study.rnaseq_set.order_by('pk').first()
+        response = Client().get('/rest/rnaseq/%s/values.json' % rnaseq.pk)
+        self.assertEqual(response.status_code, 200)
+        return sorted((row['obs_unit_id'], row['phenotype_value']) for row in response.data)
+
+    def test_matrix_is_stored_on_precompute(self):
+        values = self.get_values()
+        # requests read the values from the database and do not build the matrix
+        self.assertIsNone(get_rnaseq_matrix(self.study))
+        precompute_study(self.study)
+        matrix = get_rnaseq_matrix(self.study)
+        self.assertEqual(matrix.values.shape, (2, 4))
+        self.assertEqual(self.get_values(), values)
+        self.assertEqual([value for _, value in values], [0.1, 1.0 / 3, 0.7])
+        # a changed study is read from the database until it is precomputed again
+        self.study.save()
+        self.assertIsNone(get_rnaseq_matrix(self.study))
+
+
+class GeneIndexTestCase(TestCase):
+
+    def setUp(self):
+        species = create_species()
+        accessions = create_accessions(species, 4)
+        values = np.array([[1.0], [2.0], [4.0], [3.0]])
+        self.published = create_rnaseq_study('published', species, accessions, values, 'control')
+        self.submitted = create_rnaseq_study('submitted', species, accessions, values, 'control', SUBMITTED)
+        self.phenotype = create_phenotype_study('phenotype', species, accessions, values).phenotype_set.get()
+
+    def test_only_published_studies_are_found(self):
+        self.assertEqual([entry.study_id for entry in find_rnaseqs('at1g00000')], [self.published.pk])
+        client = Client()
+        response = client.get('/rest/rnaseq/gene/AT1G00000/values/')
+        self.assertEqual([rnaseq['study_id'] for rnaseq in response.data['rnaseqs']], [self.published.pk])
+        for study, status_code in ((self.published, 200), (self.submitted, 404)):
+            self.assertEqual(client.get('/rest/rnaseq/%s/genes/values/' % study.pk,
+                                        {'genes': 'AT1G00000'}).status_code, status_code)
+            self.assertEqual(client.get('/rest/phenotype/%s/association/%s/' % (self.phenotype.pk, study.pk)).status_code,
+                             status_code)
+            self.assertEqual(client.get('/rest/rnaseq/%s/AT1G00000/coexpression/' % study.pk).status_code, status_code)
+
+    def test_rebuild_gene_index(self):
+        entries = sorted(RNASeqGene.objects.values_list('rnaseq_id', 'study_id', 'gene_id', 'locus_id'))
+        RNASeqGene.objects.all().delete()
+        self.assertEqual(rebuild_gene_index(), 2)
+        self.assertEqual(sorted(RNASeqGene.objects.values_list('rnaseq_id', 'study_id', 'gene_id', 'locus_id')), entries)
+
+
+class StatisticsTestCase(TestCase):
+
+    def setUp(self):
+        species = create_species()
+        self.study = create_phenotype_study('statistics', species, create_accessions(species, 4),
+                                            np.array([[1.0], [2.0], [4.0], [8.0]]))
+        self.phenotype = self.study.phenotype_set.get()
+
+    def test_statistics_are_not_stored_on_read(self):
+        response = Client().get('/rest/phenotype/%s/statistics/' % self.phenotype.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 4)
+        self.assertEqual(response.data['median'], 3.0)
+        self.assertFalse(StatisticsResult.objects.exists())
+
+    def test_statistics_are_stored_on_precompute(self):
+        precompute_study(self.study)
+        result = StatisticsResult.objects.get(phenotype=self.phenotype)
+        self.assertEqual((result.count, result.minimum, result.maximum), (4, 1.0, 8.0))
+        response = Client().get('/phenotype/%s/' % self.phenotype.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['summary']['count'], 4)
+
+
+class PhenotypeDetailTestCase(TestCase):
+
+    def setUp(self):
+        species = create_species()
+        self.study = create_phenotype_study('submitted', species, create_accessions(species, 2),
+                                            np.array([[1.5], [2.5]]), status=SUBMITTED)
+        self.phenotype = self.study.phenotype_set.get()
+
+    def test_values_of_unpublished_phenotype_page(self):
+        """The table of the detail page loads the values of any phenotype that the page shows"""
+        client = Client()
+        response = client.get('/phenotype/%s/' % self.phenotype.pk)
+        self.assertEqual(response.status_code, 200)
+        values_url = '/rest/phenotype/%s/values.json' % self.phenotype.pk
+        self.assertContains(response, values_url)
+        response = client.get(values_url, {'page': 1, 'page_size': 10})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(row['phenotype_value'] for row in response.data), [1.5, 2.5])
+
+
+def save_per_row(plink_data, name):
+    """The importer before the bulk import, which saved every object"""
+    pmatrix, accession_ids, names = plink_data
+    study = Study(name=name, species=Species.objects.get(pk=1))
+    study.save()
+    phenotypes = []
+    for phenotype_name in names:
+        phenotype = Phenotype(name=phenotype_name, scoring='', study=study, species=study.species)
+        phenotype.save()
+        phenotypes.append(phenotype)
+    for acc_ix, accession_id in enumerate(accession_ids):
+        obs_unit = ObservationUnit(study=study, accession=Accession.objects.get(pk=accession_id))
+        obs_unit.save()
+        for i in range(len(names)):
+            value = pmatrix[acc_ix][i]
+            if not np.isnan(value):
+                PhenotypeValue(value=value, phenotype=phenotypes[i], obs_unit=obs_unit).save()
+    return study
+
+
+class ImportTestCase(TestCase):
+
+    def setUp(self):
+        self.accessions = create_accessions(create_species(), 3)
+
+    def get_study(self, study):
+        phenotypes = list(study.phenotype_set.order_by('pk'))
+        obs_units = list(study.observationunit_set.order_by('pk'))
+        values = sorted((phenotypes.index(value.phenotype), obs_units.index(value.obs_unit), value.value)
+                        for value in PhenotypeValue.objects.filter(phenotype__study=study))
+        return ([(phenotype.name, phenotype.scoring, phenotype.species_id, phenotype.update_date is not None)
+                 for phenotype in phenotypes],
+                [obs_unit.accession_id for obs_unit in obs_units], values)
+
+    def test_bulk_import_equals_per_row_import(self):
+        # the first accession has a replicate
+        plink_data = ([[1.0, np.nan, 3.5], [2.0, 4.0, 0.0], [np.nan, 5.0, -1.0], [7.0, 8.0, 9.0]],
+                      ['6000', '6001', '6002', '6000'], ['height', 'width', 'weight'])
+        expected = self.get_study(save_per_row(plink_data, 'per row'))
+        study = save_plink_or_csv(plink_data, 'bulk')
+        self.assertEqual(self.get_study(study), expected)
+        self.assertEqual(set(study.phenotype_set.values_list('update_date', flat=True)),
+                         set(Study.objects.filter(pk=study.pk).values_list('update_date', flat=True)))
+
+    def test_unknown_accession(self):
+        with self.assertRaises(Accession.DoesNotExist) as context:
+            save_plink_or_csv(([[1.0], [2.0]], ['6000', '9999'], ['height']), 'unknown')
+        self.assertEqual(context.exception.args[-1], '9999')
+
+
+class CorrelationTestCase(TestCase):
+
+    def test_pearson_and_spearman_matrix(self):
+        values = random_matrix(40, 6)
+        values[:, 5] = np.nan
+        values[:3, 5] = [1.0, 2.0, 3.0]
+        corr, shared = pearson_matrix(values)
+        spear, _ = spearman_matrix(values)
+        present = ~np.isnan(values)
+        for i in range(values.shape[1]):
+            for j in range(values.shape[1]):
+                rows = present[:, i] & present[:, j]
+                self.assertEqual(shared[i, j], rows.sum())
+                if rows.sum() < 2:
+                    self.assertTrue(np.isnan(corr[i, j]))
+                    continue
+                self.assertAlmostEqual(corr[i, j], stats.pearsonr(values[rows, i], values[rows, j])[0])
+                self.assertAlmostEqual(spear[i, j], stats.spearmanr(values[rows, i], values[rows, j])[0])
+
+    def test_replicates_are_aggregated(self):
+        columns = np.array([0, 0, 0, 1, 1])
+        accession_ids = np.array([7, 5, 7, 5, 7])
+        values = np.array([1.0, 2.0, 4.0, 3.0, 5.0])
+        np.testing.assert_array_equal(aggregate_replicates(columns, accession_ids, values, 2, 'mean'),
+                                      [[2.0, 3.0], [2.5, 5.0]])
+        np.testing.assert_array_equal(aggregate_replicates(columns, accession_ids, values, 3, 'median'),
+                                      [[2.0, 3.0, np.nan], [2.5, 5.0, np.nan]])
+
+    def test_cache_evicts_the_least_recently_used_entries(self):
+        cache = CorrelationCache(max_bytes=100)
+        entry = type('Entry', (object,), {'nbytes': 40})
+        cache.set('a', entry)
+        cache.set('b', entry)
+        self.assertIs(cache.get('a'), entry)
+        cache.set('c', entry)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((len(cache), cache.size, cache.hits, cache.misses), (2, 80, 1, 1))
+
+    def test_reordered_phenotypes_are_served_from_the_cache(self):
+        cache = CorrelationCache(max_bytes=10 ** 6)
+        self.addCleanup(setattr, correlation, 'CACHE', correlation.CACHE)
+        correlation.CACHE = cache
+        species = create_species()
+        study = create_phenotype_study('correlation', species, create_accessions(species, 5),
+                                       np.array([[1.0, 2.0, 1.0], [2.0, 1.0, 3.0], [3.0, 5.0, 2.0],
+                                                 [4.0, 3.0, np.nan], [5.0, 4.0, 6.0]]))
+        ids = list(study.phenotype_set.order_by('pk').values_list('pk', flat=True))
+        data = get_phenotype_correlations(ids)
+        reordered = get_phenotype_correlations([ids[2], ids[0], ids[1]])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        corr = np.array(eval(data['corr_mat'].replace('NaN', 'nan'), {'nan': np.nan}))
+        reordered_corr = np.array(eval(reordered['corr_mat'].replace('NaN', 'nan'), {'nan': np.nan}))
+        np.testing.assert_array_equal(reordered_corr, corr[np.ix_([2, 0, 1], [2, 0, 1])])
+        self.assertEqual(reordered['scatter_data'][0], data['scatter_data'][2])
+        # a changed study is computed again
+        study.save()
+        get_phenotype_correlations(ids)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+
+class TransformationTestCase(TestCase):
+
+    def box_cox_per_lambda(self, values):
+        """The Box-Cox transformation before the batched search, with one Shapiro-Wilk test per lambda"""
+        a = np.array(values)
+        vals = (a - min(a)) + 0.1 * np.var(a)
+        p_values = []
+        for l in BOX_COX_LAMBDAS:
+            vs = np.log(vals) if l == 0 else ((vals ** l) - 1) / l
+            w, p_value = stats.shapiro(vs)
+            p_values.append(p_value if np.isfinite(w) else 0.0)
+        l = BOX_COX_LAMBDAS[np.argmax(p_values)]
+        return np.log(vals) if l == 0 else ((vals ** l) - 1) / l
+
+    def test_box_cox_equals_search_per_lambda(self):
+        random = np.random.RandomState(0)
+        for values in (random.lognormal(size=30), random.exponential(size=200), random.randn(1000) ** 2):
+            np.testing.assert_allclose(transform(values, 'box_cox'), self.box_cox_per_lambda(values))
+
+    def test_transform_all_equals_transform(self):
+        values = np.random.RandomState(1).uniform(0, 1, 50)
+        results = transform_all(values)
+        for transformation in SUPPORTED_TRANSFORMATIONS:
+            np.testing.assert_allclose(results[transformation], transform(values, transformation))
+
+
+class AssociationTestCase(TestCase):
+
+    def test_correlations_of_columns(self):
+        x = random_matrix(30, 8, seed=2)
+        x[:, 7] = np.nan
+        y = np.round(np.random.RandomState(3).randn(30), 1)
+        pearson, n = pearson_columns(y, x)
+        spearman, _ = spearman_columns(y, x)
+        for i in range(x.shape[1]):
+            rows = ~np.isnan(x[:, i])
+            self.assertEqual(n[i], rows.sum())
+            if rows.sum() < 2:
+                self.assertTrue(np.isnan(pearson[i]) and np.isnan(spearman[i]))
+                continue
+            self.assertAlmostEqual(pearson[i], stats.pearsonr(y[rows], x[rows, i])[0])
+            self.assertAlmostEqual(spearman[i], stats.spearmanr(y[rows], x[rows, i])[0])
+
+    def test_fdr(self):
+        p_values = np.array([0.01, np.nan, 0.04, 0.03, 0.5])
+        np.testing.assert_allclose(fdr(p_values), [0.04, np.nan, 0.04 * 4 / 3, 0.04 * 4 / 3, 0.5])
+
+
+class AssociationScanTestCase(TestCase):
+
+    def setUp(self):
+        species = create_species()
+        accessions = create_accessions(species, 5)
+        self.phenotype = create_phenotype_study('phenotype', species, accessions,
+                                                np.array([[1.0], [2.0], [3.0], [4.0], [5.0]])).phenotype_set.get()
+        self.study = create_rnaseq_study('rnaseq', species, accessions,
+                                         np.array([[1.0, 5.0], [2.0, 3.0], [3.0, 4.0], [4.0, 1.0], [5.0, 2.0]]))
+
+    def test_genes_without_growth_conditions(self):
+        response = Client().get('/rest/phenotype/%s/association/%s/' % (self.phenotype.pk, self.study.pk))
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results']
+        self.assertEqual([(result['growth_conditions'], result['n_genes']) for result in results], [(None, 2)])
+        self.assertEqual([gene['name'] for gene in results[0]['genes']], ['AT1G00000', 'AT1G00001'])
+        self.assertAlmostEqual(results[0]['genes'][0]['correlation'], 1.0)
+
+
+class CoexpressionTestCase(TestCase):
+
+    def test_nearest_rows_equal_the_correlation_matrix(self):
+        values = random_matrix(50, 20, missing=0, seed=4)
+        values[7] = 1.0
+        queries = [0, 7, 49]
+        indices, correlations = nearest_rows(standardize(values), queries, 5, block_size=8)
+        with np.errstate(invalid='ignore'):
+            corr = pd.DataFrame(values.T).corr().values
+        np.fill_diagonal(corr, -np.inf)
+        corr[np.isnan(corr)] = -np.inf
+        for query, query_indices, query_correlations in zip(queries, indices, correlations):
+            if query == 7:
+                # a constant row has no neighbours
+                self.assertTrue(np.isnan(query_correlations).all())
+                continue
+            expected = np.argsort(-corr[query], kind='mergesort')[:5]
+            self.assertEqual(sorted(query_indices.tolist()), sorted(expected.tolist()))
+            np.testing.assert_allclose(query_correlations, corr[query, expected], atol=1e-5)
+
+
+class IsatabCacheTestCase(TemporaryDirectoryMixin, TestCase):
+
+    def setUp(self):
+        super(IsatabCacheTestCase, self).setUp()
+        settings = override_settings(STUDY_MATRIX_CACHE_DIR=None, RNASEQ_MATRIX_DIR=None, ISATAB_CACHE_DIR=self.tmp_dir)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        species = create_species()
+        self.study = create_phenotype_study('isatab', species, create_accessions(species, 2),
+                                            np.array([[1.0, 2.0], [3.0, np.nan]]))
+
+    def download(self):
+        response = Client().get('/rest/study/%s/isatab/' % self.study.pk)
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+        archive = zipfile.ZipFile(io.BytesIO(content))
+        return response.__class__.__name__, dict((name, archive.read(name)) for name in archive.namelist())
+
+    def test_archive_is_cached_until_the_study_changes(self):
+        response_class, members = self.download()
+        self.assertEqual(response_class, 'StreamingHttpResponse')
+        self.assertEqual(self.download(), ('FileResponse', members))
+        # the archive contains the update date of the study
+        self.study.save()
+        self.assertEqual(self.download()[0], 'StreamingHttpResponse')
+        self.assertEqual(self.download()[0], 'FileResponse')
+
+
+class DatabaseDumpTestCase(TemporaryDirectoryMixin, TestCase):
+
+    def setUp(self):
+        super(DatabaseDumpTestCase, self).setUp()
+        settings = override_settings(STATIC_ROOT=self.tmp_dir, STUDY_MATRIX_CACHE_DIR=None,
+                                     RNASEQ_MATRIX_DIR=None, ISATAB_CACHE_DIR=None)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        species = create_species()
+        accessions = create_accessions(species, 2)
+        self.study = create_phenotype_study('dump', species, accessions, np.array([[1.0, 2.0], [3.0, np.nan]]))
+        self.other = create_phenotype_study('other', species, accessions, np.array([[5.0], [6.0]]))
+
+    def dump(self, force=False):
+        with zipfile.ZipFile(generate_database_dump(processes=1, force=force)) as archive:
+            return dict((name, archive.read(name)) for name in archive.namelist())
+
+    def get_fingerprint(self, study):
+        return get_fingerprints([Study.objects.get(pk=study.pk)])[study.pk]
+
+    def test_only_changed_studies_are_rendered_again(self):
+        members = self.dump()
+        name = '%s/study_%s_values.csv' % (self.study.pk, self.study.pk)
+        self.assertIn('3.0', members[name])
+        fingerprint = self.get_fingerprint(self.study)
+        other_fingerprint = self.get_fingerprint(self.other)
+        self.assertEqual(self.dump(), members)
+        # a value that is changed without the update_date of its study
+        PhenotypeValue.objects.filter(phenotype__study=self.study, value=3.0).update(value=4.0)
+        self.assertNotEqual(self.get_fingerprint(self.study), fingerprint)
+        self.assertEqual(self.get_fingerprint(self.other), other_fingerprint)
+        changed = self.dump()
+        self.assertIn('4.0', changed[name])
+        self.assertNotIn('3.0', changed[name])
+        for member in members:
+            if not member.startswith('%s/' % self.study.pk):
+                self.assertEqual(changed[member], members[member])
+
+    def test_studies_are_rendered_again_when_an_accession_is_renamed(self):
+        species = Species.objects.get(pk=1)
+        rnaseq_study = create_rnaseq_study('expression', species, Accession.objects.order_by('pk'),
+                                           np.array([[0.5, 1.5], [2.5, np.nan]]))
+        name = '%s/study_%s_accessions.csv' % (rnaseq_study.pk, rnaseq_study.pk)
+        self.assertIn('acc1', self.dump()[name])
+        fingerprint = self.get_fingerprint(rnaseq_study)
+        Accession.objects.filter(name='acc1').update(name='renamed')
+        self.assertNotEqual(self.get_fingerprint(rnaseq_study), fingerprint)
+        self.assertIn('renamed', self.dump()[name])
+
+
+    def test_rnaseq_values_are_exported_as_float64(self):
+        values = np.array([[1.0 / 3, 2.0], [np.nan, 4.0]])
+        study = create_rnaseq_study('expression', Species.objects.get(pk=1), Accession.objects.order_by('pk'), values)
+        prefix = '%s/study_%s' % (study.pk, study.pk)
+        # the blocks are queried from the database if the matrix is not stored
+        members = self.dump()
+        self.assertEqual(json.loads(members['%s_expression.json' % prefix])['dtype'], 'float64')
+        block = np.load(io.BytesIO(members['%s_expression/00000.npy' % prefix]))
+        self.assertEqual(block.dtype, np.float64)
+        np.testing.assert_array_equal(block, values.T)
+        settings = override_settings(RNASEQ_MATRIX_DIR=os.path.join(self.tmp_dir, 'rnaseq'))
+        settings.enable()
+        self.addCleanup(settings.disable)
+        store_rnaseq_matrix(study)
+        self.assertIsNotNone(get_rnaseq_matrix(study))
+        members = self.dump(force=True)
+        np.testing.assert_array_equal(np.load(io.BytesIO(members['%s_expression/00000.npy' % prefix])), values.T)
+
+
+class ConditionalRequestTestCase(TransactionTestCase):
+    # the study is updated only once per transaction, so the changes must not be part of the test transaction
+
+    def setUp(self):
+        species = create_species()
+        self.study = create_phenotype_study('conditional', species, create_accessions(species, 2),
+                                            np.array([[1.0, 2.0], [3.0, 4.0]]))
+        self.phenotype = self.study.phenotype_set.order_by('pk').first()
+
+    def assertModified(self, url, change):
+        """Asserts that the response is revalidated (304) until change is called and sent again (200) afterwards"""
+        client = Client()
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        change()
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def rename_phenotype(self):
+        self.phenotype.name = 'renamed'
+        self.phenotype.save()
+
+    def test_phenotype_list_changes_when_a_phenotype_is_renamed(self):
+        response = self.assertModified('/rest/phenotype/list.json', self.rename_phenotype)
+        self.assertIn('renamed', [phenotype['name'] for phenotype in response.data])
+
+    def test_study_changes_when_a_phenotype_is_renamed(self):
+        self.assertModified('/rest/study/%s.json' % self.study.pk, self.rename_phenotype)
+
+    def test_accession_changes_when_it_is_renamed(self):
+        accession = Accession.objects.get(name='acc0')
+
+        def rename():
+            accession.name = 'renamed'
+            accession.save()
+        response = self.assertModified('/rest/accession/%s.json' % accession.pk, rename)
+        self.assertEqual(response.data['name'], 'renamed')
+
+    def test_study_values_change_when_a_value_is_changed(self):
+        value = PhenotypeValue.objects.get(phenotype=self.phenotype, value=3.0)
+
+        def change():
+            value.value = 5.0
+            value.save()
+        response = self.assertModified('/rest/study/%s/values.csv' % self.study.pk, change)
+        self.assertIn('5.0', response.content)
+        self.assertNotIn('3.0', response.content)
@@ -10,10 +10,13 @@ from django.shortcuts import render
 from django.views.generic import DetailView
 from django.views.generic.edit import DeleteView, UpdateView
 from django.views.decorators.http import require_http_methods
+from django.utils.decorators import method_decorator
 from django.core.exceptions import PermissionDenied
 from django_tables2 import RequestConfig
 import django_tables2 as tables
 
+from phenotypedb.conditional import (conditional, data_validators, phenotype_validators,
+                                     rnaseq_validators, study_validators)
 from phenotypedb.forms import (CorrelationWizardForm, PhenotypeUpdateForm,
                                StudyUpdateForm, UploadFileForm, SubmitFeedbackForm,
                                TransformationWizardForm)
@@ -23,13 +26,15 @@ from phenotypedb.tables import (AccessionTable, CurationPhenotypeTable,
                                 PhenotypeTable, ReducedPhenotypeTable,
                                 StudyTable, AccessionPhenotypeTable,
                                 RNASeqTable, RNASeqStudyTable)
-from scipy.stats import shapiro
 import json, itertools
-from utils import calculate_phenotype_transformations, add_publication_to_study
+from utils import get_statistics, get_transformations, add_publication_to_study
+from utils.ontology import get_roots, get_tree_to_root
+from utils.summary import get_page_summary
 
 
 # Create your views here.
 
+@conditional(data_validators, private=True)
 def list_phenotypes(request):
     """
     Displays table of all published phenotypes
@@ -38,6 +43,7 @@ def list_phenotypes(request):
     RequestConfig(request, paginate={"per_page":20}).configure(table)
     return render(request, 'phenotypedb/phenotype_list.html', {"phenotype_table":table})
 
+@conditional(data_validators, private=True)
 def list_rnaseqs(request):
     """
     Displays table of all published RNASeq
@@ -46,6 +52,7 @@ def list_rnaseqs(request):
     RequestConfig(request, paginate={"per_page":50}).configure(table)
     return render(request, 'phenotypedb/rnaseq_data_list.html', {"rnaseq_table":table, 'is_rnaseq': True})
 
+@conditional(data_validators, private=True)
 def list_rnaseq_studies(request):
     """
     Displays table of all published RNASeq
@@ -58,6 +65,7 @@ def list_rnaseq_studies(request):
     RequestConfig(request, paginate={"per_page":50}).configure(table)
     return render(request, 'phenotypedb/rnaseq_study_list.html', {"study_table":table, 'is_rnaseq': True})
 
+@method_decorator(conditional(phenotype_validators, private=True), name='dispatch')
 class PhenotypeDetail(DetailView):
     """
     Detailed view for a single phenotype
@@ -66,12 +74,14 @@ class PhenotypeDetail(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(PhenotypeDetail, self).get_context_data(**kwargs)
-        context['pheno_acc_infos'] = self.object.phenotypevalue_set.select_related('obs_unit__accession')
-        context['geo_chart_data'] = Accession.objects.filter(observationunit__phenotypevalue__phenotype_id=self.object.pk).values('country').annotate(count=Count('country'))
-        context['values'] = self.object.phenotypevalue_set.all().values_list("value", flat=True)
-        context['shapiro'] = "%.2e"%shapiro(context['values'])[1]
+        # the raw values are loaded by the page from the REST api when the table is opened
+        context['statistics'] = get_statistics(self.object)
+        context['summary'] = get_page_summary(self.object, context['statistics'])
+        context['summary_json'] = _script_json(context['summary'])
+        context['shapiro'] = _format_pval(self.object.shapiro_p_value)
         return context
 
+@method_decorator(conditional(rnaseq_validators, private=True), name='dispatch')
 class RNASeqDetail(DetailView):
     """
     Detailed view for a single RNASeq
@@ -80,13 +90,23 @@ class RNASeqDetail(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(RNASeqDetail, self).get_context_data(**kwargs)
-        context['pheno_acc_infos'] = self.object.rnaseqvalue_set.select_related('obs_unit__accession')
-        context['geo_chart_data'] = Accession.objects.filter(observationunit__rnaseqvalue__rnaseq_id=self.object.pk).values('country').annotate(count=Count('country'))
-        context['values'] = self.object.rnaseqvalue_set.all().values_list("value", flat=True)
-        context['shapiro'] = "%.2e"%shapiro(context['values'])[1]
+        context['statistics'] = get_statistics(self.object, rnaseq=True)
+        context['summary'] = get_page_summary(self.object, context['statistics'], rnaseq=True)
+        context['summary_json'] = _script_json(context['summary'])
+        context['shapiro'] = _format_pval(self.object.shapiro_p_value)
         context['is_rnaseq'] = True
         return context
 
+def _script_json(data):
+    """JSON that can be embedded in a script tag"""
+    return json.dumps(data).replace('<', '\\u003c')
+
+def _format_pval(pval):
+    if pval is None:
+        return '-'
+    return "%.2e" % pval
+
+@conditional(data_validators, private=True)
 def list_studies(request):
     """
     Displays table of all published studies
@@ -98,6 +118,7 @@ def list_studies(request):
     return render(request, 'phenotypedb/study_list.html', {"study_table":table})
 
 
+@conditional(study_validators, private=True)
 def detail_study(request, pk=None):
     """
     Detailed view of a single study
@@ -131,6 +152,7 @@ def correlation_wizard(request):
         return HttpResponseRedirect("/correlation/" + query + "/")
     return render(request, 'phenotypedb/correlation_wizard.html', {"phenotype_wizard":wizard_form})
 
+@conditional(data_validators, private=True)
 def correlation_results(request, ids=None):
     """
     Shows the correlation result
@@ -148,25 +170,28 @@ def transformation_wizard(request):
         return HttpResponseRedirect("/phenotype/" + str(query[0]) + "/transformation/")
     return render(request, 'phenotypedb/transformation_wizard.html', {"transformation_wizard":wizard_form})
 
+@conditional(phenotype_validators, private=True)
 def transformation_results(request, pk):
     """
     SHow transformation result
     """
-    phenotype = Phenotype.objects.get(id=pk)
-    data = calculate_phenotype_transformations(phenotype)
+    phenotype = Phenotype.objects.select_related('study').get(id=pk)
+    data = get_transformations(phenotype)
     data['object'] = phenotype
     return render(request, 'phenotypedb/transformation_results.html', data)
 
+@conditional(rnaseq_validators, private=True)
 def rnaseq_transformation_results(request, pk):
     """
     SHow transformation result
     """
-    rnaseq = RNASeq.objects.get(id=pk)
-    data = calculate_phenotype_transformations(rnaseq, rnaseq=True)
+    rnaseq = RNASeq.objects.select_related('study').get(id=pk)
+    data = get_transformations(rnaseq, rnaseq=True)
     data['object'] = rnaseq
     data['is_rnaseq'] = True
     return render(request, 'phenotypedb/rnaseq_transformation_results.html', data)
 
+@conditional(data_validators, private=True)
 def list_accessions(request):
     """
     Displays table with all accessions
@@ -185,6 +210,7 @@ def list_accessions(request):
     return render(request, 'phenotypedb/accession_list.html', {"accession_table":table, "genotypes": genotypes, "filtered_genotypes": list(filtered_genotypes)})
 
 
+@conditional(data_validators, private=True)
 def detail_accession(request, pk=None):
     """
     Detailed view of a single accession
@@ -203,14 +229,6 @@ def detail_accession(request, pk=None):
     return render(request, 'phenotypedb/accession_detail.html', variable_dict)
 
 
-def _get_ontology_terms(term,ids = None):
-    if not ids:
-        ids = [term.id]
-    for t in term.children.all():
-        ids.append(t.id)
-        _get_ontology_terms(t,ids)
-    return ids
-
 def _get_db_field_from_source(source):
     if source.acronym == 'PECO':
         return 'eo_term'
@@ -222,29 +240,28 @@ def _get_db_field_from_source(source):
         raise Exception('term %s unknown' % source.acronym)
 
 
+@conditional(data_validators, private=True)
 def detail_ontology_term(request,pk=None):
     """
     Detailed view of Ontology
     """
     variable_dict = {}
-    phenotypes = []
+    phenotypes = Phenotype.objects.none()
     if pk is not None:
         term = OntologyTerm.objects.get(pk=pk)
         variable_dict["object"] = term
-        db_field = _get_db_field_from_source(term.source) + '_id__in'
-        ids = _get_ontology_terms(term)
-        #necessary because sqlite has a limit of 999 SQL variables
-        ids = [ ids[i:i+500] for i in range(0, len(ids), 500) ]
-        for sub in ids:
-            kwargs = {db_field:sub}
-            phenotypes.extend(Phenotype.objects.published().filter(**kwargs))
-    variable_dict['phenotype_count'] = len(phenotypes)
+        #phenotypes annotated with the term or any of its descendants in the closure table
+        db_field = _get_db_field_from_source(term.source) + '__ancestor_links__ancestor'
+        phenotypes = Phenotype.objects.published().filter(**{db_field:term})
+    variable_dict['phenotype_count'] = phenotypes.count()
+    phenotypes = phenotypes.select_related('study', 'to_term', 'eo_term', 'uo_term').annotate(num_values=Count('phenotypevalue'))
     phenotype_table = PhenotypeTable(phenotypes, order_by="-name")
     RequestConfig(request, paginate={"per_page":20}).configure(phenotype_table)
     variable_dict["phenotype_table"] = phenotype_table
     return render(request, 'phenotypedb/ontologyterm_detail.html', variable_dict)
 
 
+@conditional(data_validators, private=True)
 def list_ontology_sources(request):
     """
     Displays list of ontologies
@@ -252,6 +269,7 @@ def list_ontology_sources(request):
     return render(request, 'phenotypedb/ontologysource_list.html', {"objects":OntologySource.objects.all()})
 
 
+@conditional(data_validators, private=True)
 def detail_ontology_source(request,acronym,term_id=None):
     """
     Detailed view of OntologySource
@@ -259,43 +277,14 @@ def detail_ontology_source(request,acronym,term_id=None):
     variable_dict = {}
     source = OntologySource.objects.get(acronym=acronym)
     variable_dict['object']  = source
-    root_nodes = source.ontologyterm_set.filter(parents=None)
-    tree = None
     if term_id is not None:
-        tree = []
-        term = OntologyTerm.objects.get(pk=term_id)
-        tree = _get_tree_to_root(term,root_nodes)
+        tree = get_tree_to_root(term_id,source)
     else:
-        tree = [{'id':term.pk,'text':term.name,'children':True if term.children.count() > 0 else False} for term in root_nodes]
+        tree = get_roots(source)
     variable_dict['tree'] = json.dumps(tree)
     return render(request, 'phenotypedb/ontologysource_detail.html', variable_dict)
 
 
-def _get_tree_to_root(term,root_nodes):
-    tree = []
-    term_obj = {'id':term.id,'text':term.name,'state':{'selected':True},'children':True if term.children.count() > 0 else False}
-    parents = term.parents.all()
-
-    while len(parents) > 0:
-        parent = parents[0]
-        p_obj = {'id':parent.id,'text':parent.name,'children': [term_obj],'state':{'opened':True}}
-        for t in parent.children.all():
-            if t.id != term_obj['id']:
-                p_obj['children'].append({'id':t.id,'text':t.name,'children':True if term.children.count() > 0 else False})
-        parents = parent.parents.all()
-        term = parent
-        term_obj = p_obj
-
-    for t in root_nodes:
-        if t.id == term.id:
-            tree.append(term_obj)
-        else:
-            tree.append({'id':t.id,'text':t.name,'children':True if t.children.count() > 0 else False})
-    return tree
-
-
-
-
 class SubmissionStudyDeleteView(DeleteView):
     """
     Confirm view for deleting a submission
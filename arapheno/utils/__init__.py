@@ -7,7 +7,6 @@ import uuid
 import logging
 import zipfile
 import numpy as np
-import math
 import requests
 
 from django.db import transaction
@@ -17,6 +16,9 @@ from phenotypedb.models import (Accession, ObservationUnit, Phenotype,
 from utils.data_io import parse_plink_file, parse_csv_file, parse_meta_information_file
 from utils.isa_tab import parse_isatab, save_isatab
 from utils import statistics
+from utils.bulk import ImportTimer, bulk_insert, insert_rows, resolve_accessions
+from utils.matrix_cache import schedule_invalidation
+from utils.precompute import get_statistics, get_transformations, precompute_study
 logger = logging.getLogger(__name__)
 
 
@@ -34,6 +36,7 @@ def import_study(fhandle):
         study = import_csv(fhandle, name)
     else:
         raise Exception('Extension %s not supported' % extension)
+    precompute_study(study)
     return study
 
 def add_phenotype_ids(study, meta_information):
@@ -109,62 +112,26 @@ def save_plink_or_csv(plink_data, name):
     """
     # TODO don't harcode species
     pmatrix, accession_ids, names = plink_data
+    timer = ImportTimer(name)
+    accessions = resolve_accessions(accession_ids)
     study = Study(name=name, species=Species.objects.get(pk=1))
     study.save()
-    phenotypes = []
-    for name in names:
-        phenotype = Phenotype(name=name, scoring='', study=study, species=study.species)
-        phenotype.save()
-        phenotypes.append(phenotype)
-
-    for acc_ix, accession_id in enumerate(accession_ids):
-        try:
-            obs_unit = ObservationUnit(study=study, accession=Accession.objects.get(pk=accession_id))
-        except Accession.DoesNotExist as err:
-            err.args += (accession_id,)
-            raise err
-        obs_unit.save()
-        for i, name in enumerate(names):
-            value = pmatrix[acc_ix][i]
-            if not np.isnan(value):
-                phenotype_value = PhenotypeValue(value=value, phenotype=phenotypes[i], obs_unit=obs_unit)
-                phenotype_value.save()
+    # bulk_create bypasses Phenotype.save, which sets the update_date
+    phenotypes = bulk_insert([Phenotype(name=phenotype_name, scoring='', study=study, species=study.species,
+                                        update_date=study.update_date) for phenotype_name in names])
+    obs_units = bulk_insert([ObservationUnit(study=study, accession_id=accession) for accession in accessions])
+    # the values are inserted in the same order as saving them per accession and phenotype
+    pmatrix = np.asarray(pmatrix, dtype=np.float64).reshape(len(accession_ids), len(names))
+    acc_indices, phenotype_indices = np.nonzero(~np.isnan(pmatrix))
+    rows = ((float(pmatrix[acc_ix, i]), phenotypes[i].pk, obs_units[acc_ix].pk)
+            for acc_ix, i in zip(acc_indices.tolist(), phenotype_indices.tolist()))
+    count = insert_rows(PhenotypeValue, ('value', 'phenotype', 'obs_unit'), rows)
+    # the values were inserted without the post_save signals
+    schedule_invalidation(study.id)
+    timer.log(len(phenotypes) + len(obs_units) + count)
     return study
 
 
-def calculate_phenotype_transformations(phenotype, trans = None, rnaseq=False):
-    """
-    Calculates transformations for the phenotype
-    """
-    labels = []
-    accessions = []
-    values = []
-    if rnaseq:
-        iterator = phenotype.rnaseqvalue_set.all()
-    else:
-        iterator = phenotype.phenotypevalue_set.all()
-    for item in iterator:
-        accessions.append((item.obs_unit.accession.id, item.obs_unit.accession.name))
-        labels.append("%s(%s)" % (item.obs_unit.accession.name, item.id))
-        values.append(item.value)
-    data = {'accessions': accessions}
-    transformations = {}
-    for transformation in statistics.SUPPORTED_TRANSFORMATIONS:
-        if trans and trans != transformation:
-            continue
-        transformed_values = statistics.transform(values, transformation)
-        if transformed_values is not None:
-            if not np.any(np.iscomplex(transformed_values)):
-                sp_pval = statistics.calculate_sp_pval(transformed_values.tolist())
-                transformations[transformation] = {'values': zip(labels, transformed_values.tolist()), 'sp_pval': sp_pval}
-                if sp_pval < 1 and sp_pval > 0:
-                    transformations[transformation]['sp_score'] = -math.log10(sp_pval)
-            else:
-                transformations[transformation] = {'values': [], 'sp_pval':"not supported" }
-    data['transformations'] = transformations
-    return data
-
-
 def remove_publication_from_study(study_id, doi):
     """
     Removes a publication from a study
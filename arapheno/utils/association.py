@@ -0,0 +1,185 @@
+"""
+Association scan of a phenotype against all genes of an RNASeq study.
+The accession means of the phenotype are aligned with the accession means of the
+expression matrix and the Pearson or Spearman correlations of all genes are computed
+with matrix-vector products over blocks of genes
+"""
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from phenotypedb.models import PhenotypeValue, RNASeq
+from utils.matrix_cache import get_study_matrix
+
+METHODS = ('pearson', 'spearman')
+
+# genes that are correlated together
+BLOCK_SIZE = 2000
+
+# correlations of less accessions have no p-value
+MIN_ACCESSIONS = 3
+
+
+class AssociationError(Exception):
+    """Raised when the phenotype and the RNASeq study can not be associated"""
+
+
+def scan_association(phenotype, study, method='pearson', growth_conditions=None, top=50):
+    """
+    Returns the top genes of an RNASeq study by the p-value of their correlation
+    with the accession means of a phenotype, separately per growth condition
+    """
+    if method not in METHODS:
+        raise AssociationError('Method %s not supported' % method)
+    values = np.array(list(PhenotypeValue.objects.filter(phenotype_id=phenotype.pk)
+                           .values_list('obs_unit__accession_id', 'value')), dtype=np.float64).reshape(-1, 2)
+    phenotype_accessions, phenotype_means = accession_means(values[:, 0].astype(np.int64), values[:, 1])
+
+    matrix = get_study_matrix(study, 'rnaseq')
+    conditions = dict(RNASeq.objects.filter(study_id=study.pk).values_list('id', 'growth_conditions'))
+    gene_conditions = np.array([conditions.get(rnaseq_id) for rnaseq_id in matrix.phenotype_ids.tolist()], dtype=object)
+    if growth_conditions is not None:
+        groups = [growth_conditions]
+    else:
+        groups = sorted(set(gene_conditions.tolist()), key=lambda condition: (condition is not None, condition))
+
+    results = []
+    for condition in groups:
+        # compared element-wise, numpy compares an object array with None as a whole
+        columns = np.flatnonzero(np.array([gene_condition == condition for gene_condition in gene_conditions],
+                                          dtype=bool))
+        corr, counts, accessions = scan_columns(phenotype_accessions, phenotype_means, matrix, columns, method)
+        p_values = correlation_p_values(corr, counts)
+        q_values = fdr(p_values)
+        # best p-value first, stronger correlations first among equal p-values
+        order = np.lexsort((-np.abs(np.nan_to_num(corr)), np.where(np.isnan(p_values), np.inf, p_values)))[:top]
+        genes = []
+        for i in order.tolist():
+            genes.append(OrderedDict([('rnaseq_id', int(matrix.phenotype_ids[columns[i]])),
+                                      ('name', matrix.phenotype_names[columns[i]]),
+                                      ('correlation', _to_json(corr[i])),
+                                      ('p_value', _to_json(p_values[i])),
+                                      ('q_value', _to_json(q_values[i])),
+                                      ('n', int(counts[i]))]))
+        results.append(OrderedDict([('growth_conditions', condition),
+                                    ('n_genes', len(columns)),
+                                    ('n_tested', int(np.count_nonzero(~np.isnan(p_values)))),
+                                    ('n_accessions', accessions),
+                                    ('genes', genes)]))
+    return OrderedDict([('phenotype_id', phenotype.pk),
+                        ('study_id', study.pk),
+                        ('method', method),
+                        ('results', results)])
+
+
+def accession_means(accession_ids, values):
+    """Returns the sorted accession ids and the mean of the values of each accession"""
+    accessions, rows = np.unique(accession_ids, return_inverse=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.bincount(rows, values, len(accessions)) / np.bincount(rows, minlength=len(accessions))
+    return accessions, means
+
+
+def scan_columns(accessions, means, matrix, columns, method='pearson', block_size=BLOCK_SIZE):
+    """
+    Correlates the accession means of a phenotype with the accession means of the
+    columns of an obs_unit x gene StudyMatrix. Returns the correlations, the numbers
+    of accessions of each correlation and the number of shared accessions
+    """
+    shared = np.intersect1d(accessions, matrix.accession_ids)
+    if len(shared) < MIN_ACCESSIONS:
+        raise AssociationError('The phenotype and the RNASeq study share %s accessions' % len(shared))
+    y = means[np.searchsorted(accessions, shared)]
+    # obs_units of the shared accessions grouped by accession
+    rows = np.flatnonzero(np.in1d(matrix.accession_ids, shared))
+    rows = rows[np.argsort(matrix.accession_ids[rows], kind='mergesort')]
+    starts = np.flatnonzero(np.r_[True, np.diff(matrix.accession_ids[rows]) != 0])
+    replicates = len(starts) < len(rows)
+
+    corr = np.empty(len(columns))
+    counts = np.empty(len(columns), dtype=np.int64)
+    for start in range(0, len(columns), block_size):
+        block = columns[start:start + block_size]
+        x = matrix.values[:, block][rows].astype(np.float64)
+        if replicates:
+            present = ~np.isnan(x)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                x = (np.add.reduceat(np.where(present, x, 0), starts, axis=0) /
+                     np.add.reduceat(present, starts, axis=0))
+        if method == 'spearman':
+            corr[start:start + len(block)], counts[start:start + len(block)] = spearman_columns(y, x)
+        else:
+            corr[start:start + len(block)], counts[start:start + len(block)] = pearson_columns(y, x)
+    return corr, counts, len(shared)
+
+
+def pearson_columns(y, x):
+    """
+    Returns the Pearson correlations of the vector y with each column of x
+    on the rows where the column is not NaN and the number of these rows
+    """
+    present = ~np.isnan(x)
+    mask = present.astype(np.float64)
+    n = mask.sum(axis=0)
+    # centering does not change the correlation but reduces the cancellation error
+    y = y - y.mean()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x = np.where(present, x - np.where(present, x, 0).sum(axis=0) / n, 0)
+        sum_y = np.dot(y, mask)
+        cov = np.dot(y, x) - x.sum(axis=0) * sum_y / n
+        var_x = (x ** 2).sum(axis=0) - x.sum(axis=0) ** 2 / n
+        var_y = np.dot(y ** 2, mask) - sum_y ** 2 / n
+        corr = np.clip(cov / np.sqrt(var_x * var_y), -1, 1)
+    corr[n < 2] = np.nan
+    return corr, n.astype(np.int64)
+
+
+def spearman_columns(y, x):
+    """
+    Returns the Spearman correlations of the vector y with each column of x
+    on the rows where the column is not NaN and the number of these rows.
+    Ties are averaged
+    """
+    present = ~np.isnan(x)
+    complete = present.all(axis=0)
+    ranks = pd.DataFrame(x).rank(axis=0, method='average').values
+    corr, n = pearson_columns(_rank(y), ranks)
+    # y is ranked again on the rows of the columns with missing values
+    for i in np.flatnonzero(~complete).tolist():
+        rows = present[:, i]
+        if rows.sum() >= 2:
+            corr[i] = pearson_columns(_rank(y[rows]), ranks[rows, i:i + 1])[0][0]
+    return corr, n
+
+
+def correlation_p_values(corr, n):
+    """Returns the two-sided p-values of the correlations with the t-distribution"""
+    df = n - 2.0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.abs(corr) * np.sqrt(df / np.maximum(1 - corr ** 2, 0))
+        p_values = 2 * stats.t.sf(t, df)
+    p_values[(n < MIN_ACCESSIONS) | np.isnan(corr)] = np.nan
+    return p_values
+
+
+def fdr(p_values):
+    """Returns the Benjamini-Hochberg adjusted p-values. NaN p-values are not counted as tests"""
+    q_values = np.empty(len(p_values))
+    q_values.fill(np.nan)
+    tested = np.flatnonzero(~np.isnan(p_values))
+    if len(tested) == 0:
+        return q_values
+    order = tested[np.argsort(p_values[tested], kind='mergesort')]
+    adjusted = p_values[order] * len(order) / np.arange(1, len(order) + 1)
+    q_values[order] = np.minimum(np.minimum.accumulate(adjusted[::-1])[::-1], 1)
+    return q_values
+
+
+def _rank(values):
+    return pd.Series(values).rank(method='average').values
+
+
+def _to_json(value):
+    return None if value != value else float(value)
@@ -0,0 +1,135 @@
+"""
+In-memory prefix index for the global search autocompletes.
+Every worker process builds the index of an autocomplete once from its querysets
+and keeps it until the global data version changes, e.g. after an import or a
+publication. Suggestions are ranked by exact name, name prefix, word prefix and name length
+"""
+import heapq
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict, namedtuple
+
+from phenotypedb.models import DataVersion
+from utils.search import EXACT, PREFIX, SUBSTRING, WORD_PREFIX, InvertedIndex
+
+logger = logging.getLogger(__name__)
+
+# seconds between two checks of the data version
+VERSION_CHECK_INTERVAL = 5
+
+# suggestions of queries up to this length are memoized because they match many entries
+MEMOIZE_LENGTH = 2
+
+Suggestion = namedtuple('Suggestion', ['entity', 'name', 'html'])
+
+
+class PrefixIndex(object):
+    """
+    Sorted list of the word starting suffixes of the searchable fields of the entries
+    for prefix lookups with a trigram index for the substring matches
+    """
+
+    def __init__(self, entries, entities):
+        """
+        entries is a list of (entity, name, fields, html) tuples and
+        entities the order of the entities in the suggestions
+        """
+        self.entities = entities
+        self.suggestions = []
+        keys = []
+        rows = []
+        for position, (entity, name, fields, html) in enumerate(entries):
+            name = _normalize(name)
+            fields = [_normalize(field) for field in fields]
+            self.suggestions.append(Suggestion(entity, name, html))
+            for field in fields:
+                keys.extend((field[start:], position) for start in _word_starts(field))
+            rows.append((entity, position, name, '\n'.join(fields)))
+        keys.sort()
+        self.keys = [key for key, _ in keys]
+        self.positions = [position for _, position in keys]
+        self.substrings = InvertedIndex(rows)
+        self.memo = {}
+
+    def __len__(self):
+        return len(self.suggestions)
+
+    def suggest(self, query, limit):
+        """
+        Returns the top ranked suggestions of the entries whose searchable fields contain the query.
+        The limit is divided among the entities like in AutocompleteGenericBase
+        """
+        query = _normalize(query)
+        if not query:
+            return []
+        if len(query) <= MEMOIZE_LENGTH and (query, limit) in self.memo:
+            return self.memo[(query, limit)]
+        start = bisect_left(self.keys, query)
+        end = bisect_left(self.keys, query + u'\uffff', start)
+        ranks = defaultdict(dict)
+        for position in self.positions[start:end]:
+            suggestion = self.suggestions[position]
+            ranks[suggestion.entity][position] = _rank(query, suggestion.name)
+        if any(len(ranks[entity]) < limit for entity in self.entities):
+            # only the substring matches that are not word prefixes are missing
+            for entity, position, _, _ in self.substrings.search(query):
+                ranks[entity].setdefault(position, SUBSTRING)
+        suggestions = []
+        entities_left = len(self.entities)
+        for entity in self.entities:
+            entity_limit = (limit - len(suggestions)) // entities_left
+            entity_ranks = ranks[entity]
+            top = heapq.nsmallest(entity_limit, entity_ranks,
+                                  key=lambda position: (entity_ranks[position],
+                                                        len(self.suggestions[position].name),
+                                                        self.suggestions[position].name))
+            suggestions.extend(self.suggestions[position] for position in top)
+            entities_left -= 1
+        if len(query) <= MEMOIZE_LENGTH:
+            self.memo[(query, limit)] = suggestions
+        return suggestions
+
+
+_INDEXES = {}
+_INDEX_LOCK = threading.Lock()
+
+
+def get_index(name, build):
+    """
+    Returns the in-memory index of the worker with the name. It is built by calling
+    build() the first time and rebuilt when the data version has changed.
+    The data version is checked at most every VERSION_CHECK_INTERVAL seconds
+    """
+    now = time.time()
+    cached = _INDEXES.get(name)
+    if cached is not None and now - cached['checked'] < VERSION_CHECK_INTERVAL:
+        return cached['index']
+    version = DataVersion.get_version(DataVersion.DATA)
+    with _INDEX_LOCK:
+        cached = _INDEXES.get(name)
+        if cached is None or cached['version'] != version:
+            index = build()
+            logger.debug('Built autocomplete index %s version %s with %s entries', name, version, len(index))
+            cached = {'index': index, 'version': version}
+            _INDEXES[name] = cached
+        cached['checked'] = now
+        return cached['index']
+
+
+def _rank(query, name):
+    if name == query:
+        return EXACT
+    if name.startswith(query):
+        return PREFIX
+    return WORD_PREFIX
+
+
+def _word_starts(text):
+    """Returns the positions of the words in the text"""
+    return [i for i, char in enumerate(text) if i == 0 or (char.isalnum() and not text[i - 1].isalnum())]
+
+
+def _normalize(text):
+    return (u'%s' % (text or '')).strip().lower()
@@ -0,0 +1,314 @@
+"""
+Micro-benchmarks for the data processing code paths.
+Each benchmark runs in a separate process so that the peak memory
+of one run does not influence the others
+"""
+import multiprocessing
+import resource
+import time
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+from phenotypedb.renderer import IsaTabAssayRenderer, IsaTabDerivedDataFileRenderer, IsaTabStudyRenderer
+from utils import statistics
+from utils.association import correlation_p_values, scan_columns
+from utils.correlation import aggregate_replicates, pearson_matrix, spearman_matrix
+from utils.isa_tab import write_assay_table, write_data_table, write_study_table
+from utils.matrix import StudyMatrix, matrix_from_cursor
+
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """Registers a benchmark function under the name"""
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def measure(func, *args):
+    """
+    Runs func(*args) in a child process and returns the wall time in seconds
+    and the increase of the peak resident memory in MB
+    """
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure_child, args=(queue, func, args))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def _measure_child(queue, func, args):
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    func(*args)
+    elapsed = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((elapsed, (peak_rss - start_rss) / 1024.0))
+
+
+def run(name):
+    """Runs the benchmark and returns a list of (label, seconds, peak MB) rows"""
+    return BENCHMARKS[name]()
+
+
+class SyntheticValueCursor(object):
+    """
+    Cursor-like object that generates (obs_unit_id, phenotype_id, value) rows
+    of a synthetic study
+    """
+
+    def __init__(self, n_obs_units, n_phenotypes, missing=0.1, seed=42):
+        self.n_obs_units = n_obs_units
+        self.n_phenotypes = n_phenotypes
+        self.missing = missing
+        self.seed = seed
+        self._rows = self._generate()
+
+    def _generate(self):
+        rnd = np.random.RandomState(self.seed)
+        for obs_unit_id in range(1, self.n_obs_units + 1):
+            values = rnd.normal(size=self.n_phenotypes)
+            present = rnd.uniform(size=self.n_phenotypes) >= self.missing
+            for phenotype_id in np.flatnonzero(present).tolist():
+                yield (obs_unit_id, phenotype_id + 1, float(values[phenotype_id]))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def fetchmany(self, size):
+        rows = []
+        for row in self._rows:
+            rows.append(row)
+            if len(rows) == size:
+                break
+        return rows
+
+    @property
+    def obs_units(self):
+        return [(i, (i + 1) // 2, 'acc%s' % ((i + 1) // 2)) for i in range(1, self.n_obs_units + 1)]
+
+    @property
+    def phenotypes(self):
+        return [(i, 'phenotype %s' % i) for i in range(1, self.n_phenotypes + 1)]
+
+
+def _legacy_study_matrix(n_obs_units, n_phenotypes):
+    """fetchall + DataFrame + pivot + iterrows as done by Study.get_matrix_and_accession_map"""
+    cursor = SyntheticValueCursor(n_obs_units, n_phenotypes)
+    accessions = dict((obs_unit[0], obs_unit[1:]) for obs_unit in cursor.obs_units)
+    names = dict(cursor.phenotypes)
+    rows = [(i, obs_unit_id, accessions[obs_unit_id][0], accessions[obs_unit_id][1], 3702,
+             phenotype_id, names[phenotype_id], value)
+            for i, (obs_unit_id, phenotype_id, value) in enumerate(cursor.fetchall())]
+    data = pd.DataFrame(rows, columns=['id', 'obs_unit_id', 'accession_id', 'accession_name',
+                                       'ncbi_id', 'phenotype_id', 'phenotype_name',
+                                       'value']).set_index(['id'])
+    data.set_index(['obs_unit_id'], inplace=True)
+    df_pivot = data.pivot(columns='phenotype_name', values='value')
+    data.drop(['value', 'phenotype_id', 'phenotype_name'], axis=1, inplace=True)
+    data = data[~data.index.duplicated(keep='first')]
+    df_pivot = df_pivot.fillna('')
+    records = []
+    headers = df_pivot.columns.tolist()
+    for obs_unit_id, row in df_pivot.iterrows():
+        info = data.ix[obs_unit_id]
+        csv_row = {'obs_unit_id': obs_unit_id, 'accession_id': info.accession_id,
+                   'accession_name': info.accession_name}
+        for i, value in enumerate(row.values):
+            csv_row[headers[i]] = value
+        records.append(csv_row)
+    return records
+
+
+def _columnar_study_matrix(n_obs_units, n_phenotypes):
+    cursor = SyntheticValueCursor(n_obs_units, n_phenotypes)
+    return matrix_from_cursor(cursor, cursor.obs_units, cursor.phenotypes)
+
+
+@benchmark('study_matrix')
+def benchmark_study_matrix(n_obs_units=2000, n_phenotypes=500):
+    """Legacy pivot path vs. columnar matrix builder on a synthetic study"""
+    results = []
+    for label, func in (('legacy pivot', _legacy_study_matrix),
+                        ('columnar matrix', _columnar_study_matrix)):
+        elapsed, peak = measure(func, n_obs_units, n_phenotypes)
+        results.append(('%s (%s x %s)' % (label, n_obs_units, n_phenotypes), elapsed, peak))
+    return results
+
+
+def _synthetic_phenotype_values(n_accessions, n_phenotypes, replicates=2, seed=42):
+    """Returns (phenotype, accession, value) arrays with replicates and missing accessions"""
+    rnd = np.random.RandomState(seed)
+    columns = []
+    accessions = []
+    for phenotype in range(n_phenotypes):
+        measured = np.flatnonzero(rnd.uniform(size=n_accessions) >= rnd.uniform(0, 0.5))
+        measured = np.repeat(measured, replicates)
+        columns.append(np.repeat(phenotype, len(measured)))
+        accessions.append(measured)
+    columns = np.concatenate(columns)
+    accessions = np.concatenate(accessions)
+    return columns, accessions, rnd.normal(size=len(columns))
+
+
+def _legacy_correlations(n_accessions, n_phenotypes):
+    """per pair accession matching by broadcasting as done by rest.phenotype_correlations"""
+    columns, accessions, values = _synthetic_phenotype_values(n_accessions, n_phenotypes)
+    bounds = np.searchsorted(columns, np.arange(n_phenotypes + 1))
+    for i in range(n_phenotypes):
+        samples1 = accessions[bounds[i]:bounds[i + 1]]
+        y1 = values[bounds[i]:bounds[i + 1]]
+        for j in range(n_phenotypes):
+            samples2 = accessions[bounds[j]:bounds[j + 1]]
+            ind = (np.reshape(samples1, (samples1.shape[0], 1)) == samples2).nonzero()
+            stats.pearsonr(y1[ind[0]], values[bounds[j]:bounds[j + 1]][ind[1]])
+            stats.spearmanr(y1[ind[0]], values[bounds[j]:bounds[j + 1]][ind[1]])
+            np.intersect1d(samples1, samples2)
+
+
+def _vectorised_correlations(n_accessions, n_phenotypes):
+    columns, accessions, values = _synthetic_phenotype_values(n_accessions, n_phenotypes)
+    matrix = aggregate_replicates(columns, accessions, values, n_phenotypes)
+    pearson_matrix(matrix)
+    spearman_matrix(matrix)
+
+
+@benchmark('correlation')
+def benchmark_correlation(n_accessions=1000, n_phenotypes=200):
+    """Legacy per pair correlations vs. the vectorised pairwise-complete matrices"""
+    results = []
+    for label, func in (('legacy pairwise', _legacy_correlations),
+                        ('vectorised matrix', _vectorised_correlations)):
+        elapsed, peak = measure(func, n_accessions, n_phenotypes)
+        results.append(('%s (%s x %s)' % (label, n_accessions, n_phenotypes), elapsed, peak))
+    return results
+
+
+def _legacy_box_cox(vals):
+    """one stats.shapiro call per lambda as done by statistics._box_cox_transform"""
+    sw_pvals = []
+    for l in statistics.BOX_COX_LAMBDAS:
+        vs = ((vals ** l) - 1) / l
+        r = stats.shapiro(vs)
+        sw_pvals.append(r[1] if np.isfinite(r[0]) else 0.0)
+    l = statistics.BOX_COX_LAMBDAS[np.argmax(sw_pvals)]
+    return ((vals ** l) - 1) / l
+
+
+def _legacy_transformations(n_values, repeat):
+    values = np.random.RandomState(42).gamma(2, size=n_values).tolist()
+    for _ in range(repeat):
+        for transformation in statistics.SUPPORTED_TRANSFORMATIONS:
+            if transformation == 'box_cox':
+                a = np.array(values)
+                _legacy_box_cox((a - min(a)) + 0.1 * np.var(a))
+            else:
+                statistics.transform(values, transformation)
+
+
+def _batched_transformations(n_values, repeat):
+    values = np.random.RandomState(42).gamma(2, size=n_values).tolist()
+    for _ in range(repeat):
+        statistics.transform_all(values)
+
+
+@benchmark('transformations')
+def benchmark_transformations(sizes=(100, 1000, 10000), repeat=100):
+    """Per lambda Shapiro-Wilk Box-Cox vs. the batched transformation pipeline"""
+    results = []
+    for n_values in sizes:
+        for label, func in (('legacy transformations', _legacy_transformations),
+                            ('batched transformations', _batched_transformations)):
+            elapsed, peak = measure(func, n_values, repeat)
+            results.append(('%s (%s values, %s runs)' % (label, n_values, repeat), elapsed, peak))
+    return results
+
+
+def _synthetic_expression(n_accessions, n_genes, seed=42):
+    """Returns the accession means of a phenotype and an obs_unit x gene float32 expression matrix"""
+    rnd = np.random.RandomState(seed)
+    accessions = np.arange(1, n_accessions + 1)
+    means = rnd.normal(size=n_accessions)
+    values = rnd.lognormal(size=(n_genes, n_accessions)).astype(np.float32)
+    # a few genes follow the phenotype
+    values[:10] += np.abs(means).astype(np.float32)
+    matrix = StudyMatrix(accessions, accessions, ['acc%s' % i for i in accessions],
+                         np.arange(1, n_genes + 1), ['gene %s' % i for i in range(n_genes)], values.T)
+    return accessions, means, matrix
+
+
+def _legacy_association(n_accessions, n_genes):
+    """one scipy.stats call per gene as done by clients looping over the rnaseq values"""
+    _, means, matrix = _synthetic_expression(n_accessions, n_genes)
+    for i in range(n_genes):
+        gene = matrix.values[:, i].astype(np.float64)
+        stats.pearsonr(means, gene)
+        stats.spearmanr(means, gene)
+
+
+def _vectorised_association(n_accessions, n_genes):
+    accessions, means, matrix = _synthetic_expression(n_accessions, n_genes)
+    columns = np.arange(n_genes)
+    for method in ('pearson', 'spearman'):
+        corr, counts, _ = scan_columns(accessions, means, matrix, columns, method)
+        correlation_p_values(corr, counts)
+
+
+@benchmark('association')
+def benchmark_association(n_accessions=700, n_genes=30000):
+    """Per gene scipy correlations vs. the blocked phenotype-transcriptome scan"""
+    results = []
+    for label, func in (('legacy per gene', _legacy_association),
+                        ('vectorised scan', _vectorised_association)):
+        elapsed, peak = measure(func, n_accessions, n_genes)
+        results.append(('%s (%s genes x %s accessions)' % (label, n_genes, n_accessions), elapsed, peak))
+    return results
+
+
+def _legacy_isatab_tables(n_obs_units, n_phenotypes):
+    """one dict per obs_unit rendered through the CSV renderers as done by the ISA-TAB export"""
+    matrix = _columnar_study_matrix(n_obs_units, n_phenotypes)
+    study_rows = []
+    assay_rows = []
+    for obs_unit_id, accession_id, accession_name in zip(matrix.obs_unit_ids.tolist(), matrix.accession_ids.tolist(),
+                                                         matrix.accession_names):
+        study_rows.append({'source': 'source%s' % accession_id, 'organism': 'Arabidopsis thaliana',
+                           'organism_ref': 'NCBITaxon', 'ncbi_id': 3702, 'accession_name': accession_name,
+                           'accession_ref': 'GMI_accessions', 'accession_id': accession_id,
+                           'sample': 'sample%s' % obs_unit_id})
+        assay_rows.append({'sample': 'sample%s' % obs_unit_id, 'assay': 'assay%s' % obs_unit_id,
+                           'protocol_ref': 'Data transformation', 'trait_def_file': 'tdf.txt',
+                           'derived_data_file': 'd_data.txt'})
+    IsaTabStudyRenderer().render(study_rows)
+    IsaTabAssayRenderer().render(assay_rows)
+    data_rows = []
+    headers = [str(column) for column in matrix.get_columns('phenotype_id')[0]]
+    for obs_unit_id, accession_id, accession_name, values in matrix.iter_rows('phenotype_id'):
+        row = {'assay': 'assay%s' % obs_unit_id}
+        for i, value in enumerate(values):
+            row[headers[i]] = value
+        data_rows.append(row)
+    IsaTabDerivedDataFileRenderer().render(data_rows)
+
+
+def _vectorised_isatab_tables(n_obs_units, n_phenotypes):
+    matrix = _columnar_study_matrix(n_obs_units, n_phenotypes)
+    write_study_table(matrix, 'Arabidopsis thaliana', 3702)
+    write_assay_table(matrix)
+    write_data_table(matrix)
+
+
+@benchmark('isatab')
+def benchmark_isatab(n_obs_units=1000, n_phenotypes=300):
+    """Per obs_unit dicts and CSV renderers vs. the column-wise ISA-TAB table writers"""
+    results = []
+    for label, func in (('legacy renderers', _legacy_isatab_tables),
+                        ('vectorised writers', _vectorised_isatab_tables)):
+        elapsed, peak = measure(func, n_obs_units, n_phenotypes)
+        results.append(('%s (%s x %s)' % (label, n_obs_units, n_phenotypes), elapsed, peak))
+    return results
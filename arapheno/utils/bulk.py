@@ -0,0 +1,99 @@
+"""
+Bulk writing of imported studies. The rows are inserted in batches instead of
+one save() per object, and the values with COPY on PostgreSQL
+"""
+import logging
+import time
+from cStringIO import StringIO
+
+from django.db import connection
+from django.db.models import AutoField
+from phenotypedb.models import Accession
+
+logger = logging.getLogger(__name__)
+
+# rows per COPY or executemany call
+CHUNK_SIZE = 50000
+
+
+def resolve_accessions(accession_ids):
+    """
+    Returns the primary keys of the accessions in the order of the ids with one query.
+    Raises Accession.DoesNotExist with the first unknown id as last argument
+    """
+    pks = [int(accession_id) for accession_id in accession_ids]
+    existing = set(Accession.objects.filter(pk__in=set(pks)).values_list('pk', flat=True))
+    for accession_id, pk in zip(accession_ids, pks):
+        if pk not in existing:
+            raise Accession.DoesNotExist('Accession matching query does not exist.', accession_id)
+    return pks
+
+
+def bulk_insert(objs):
+    """
+    Inserts the objects with batched inserts and sets their primary keys.
+    Databases that do not return the primary keys of batched inserts (only PostgreSQL does)
+    insert one row per statement and read the key of each row from the cursor
+    """
+    if not objs:
+        return objs
+    model = type(objs[0])
+    if connection.features.can_return_ids_from_bulk_insert:
+        return model.objects.bulk_create(objs)
+    # the keys of the last rows of the table may belong to rows inserted concurrently
+    fields = [field for field in model._meta.concrete_fields if not isinstance(field, AutoField)]
+    for obj in objs:
+        obj.pk = model._base_manager._insert([obj], fields=fields, return_id=True)
+        obj._state.adding = False
+        obj._state.db = connection.alias
+    return objs
+
+
+def insert_rows(model, fields, rows):
+    """
+    Inserts the rows of values of the fields without creating model instances
+    and returns the number of rows. PostgreSQL loads them with COPY
+    """
+    columns = [model._meta.get_field(field).column for field in fields]
+    count = 0
+    chunk = []
+    with connection.cursor() as cursor:
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == CHUNK_SIZE:
+                count += _insert_chunk(cursor, model._meta.db_table, columns, chunk)
+                chunk = []
+        if chunk:
+            count += _insert_chunk(cursor, model._meta.db_table, columns, chunk)
+    return count
+
+
+class ImportTimer(object):
+    """Measures the time of an import and logs the inserted rows per second"""
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+
+    def log(self, rows):
+        elapsed = max(time.time() - self.start, 1e-6)
+        logger.info('Imported %s rows of %s in %.2f s (%.0f rows/s)', rows, self.name, elapsed, rows / elapsed)
+        return rows / elapsed
+
+
+def _insert_chunk(cursor, table, columns, rows):
+    if connection.vendor == 'postgresql':
+        data = StringIO()
+        for row in rows:
+            data.write('\t'.join(repr(value) if isinstance(value, float) else str(value) for value in row))
+            data.write('\n')
+        data.seek(0)
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (connection.ops.quote_name(table),
+                                                       ', '.join(connection.ops.quote_name(column) for column in columns)),
+                           data)
+    else:
+        cursor.executemany('INSERT INTO %s (%s) VALUES (%s)' % (connection.ops.quote_name(table),
+                                                               ', '.join(connection.ops.quote_name(column) for column in columns),
+                                                               ', '.join(['%s'] * len(columns))),
+                           rows)
+    return len(rows)
@@ -0,0 +1,117 @@
+"""
+Co-expression neighbours of a gene within an RNASeq study.
+The rnaseqs of the study are standardized once (see rnaseq_store.standardize), so that the
+Pearson correlations of a gene with all other genes are the products with its standardized row.
+The products are computed over blocks of rnaseqs and only the best k of each block are kept,
+so the rnaseq x rnaseq correlation matrix is never built
+"""
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from django.conf import settings
+from phenotypedb.models import RNASeq
+from utils.correlation import CorrelationCache
+from utils.matrix_cache import get_study_matrix
+from utils.rnaseq_store import get_standardized_values, standardize
+
+logger = logging.getLogger(__name__)
+
+# rnaseqs whose correlations are computed together
+BLOCK_SIZE = 4096
+
+MAX_NEIGHBOURS = 500
+
+CACHE = CorrelationCache(getattr(settings, 'COEXPRESSION_CACHE_MAX_BYTES', 0))
+
+
+class CoexpressionResult(object):
+    """Indices and correlations of the nearest rnaseqs of a set of query rnaseqs"""
+
+    def __init__(self, indices, correlations):
+        self.indices = indices
+        self.correlations = correlations
+
+    @property
+    def nbytes(self):
+        return self.indices.nbytes + self.correlations.nbytes
+
+
+def nearest_rows(standardized, queries, k, block_size=BLOCK_SIZE):
+    """
+    Returns the indices and correlations of the k rows of a standardized matrix
+    with the highest correlation to each query row (excluding the query itself),
+    ordered by decreasing correlation. Rows without variance have no neighbours
+    and are no neighbours, their correlations are NaN
+    """
+    queries = np.asarray(queries, dtype=np.int64)
+    query_values = np.asarray(standardized[queries], dtype=np.float32)
+    best_indices = np.zeros((len(queries), 0), dtype=np.int64)
+    best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+    for start in range(0, len(standardized), block_size):
+        block = np.asarray(standardized[start:start + block_size])
+        scores = np.dot(query_values, block.T)
+        # constant rows are all zero and the query is not its own neighbour
+        scores[:, ~block.any(axis=1)] = -np.inf
+        own = (queries >= start) & (queries < start + len(block))
+        scores[own, queries[own] - start] = -np.inf
+        indices = np.arange(start, start + len(block))
+        if len(block) > k:
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            scores = scores[np.arange(len(queries))[:, np.newaxis], top]
+            indices = indices[top]
+        else:
+            indices = np.repeat(indices[np.newaxis], len(queries), axis=0)
+        best_indices = np.hstack((best_indices, indices))
+        best_scores = np.hstack((best_scores, scores))
+        if best_scores.shape[1] > k:
+            top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+            best_scores = best_scores[np.arange(len(queries))[:, np.newaxis], top]
+            best_indices = best_indices[np.arange(len(queries))[:, np.newaxis], top]
+    order = np.argsort(-best_scores, axis=1, kind='mergesort')
+    rows = np.arange(len(queries))[:, np.newaxis]
+    best_scores = best_scores[rows, order]
+    best_indices = best_indices[rows, order]
+    # fewer than k rows with variance or a query without variance
+    best_scores[np.isinf(best_scores)] = np.nan
+    best_scores[~query_values.any(axis=1)] = np.nan
+    return best_indices, best_scores
+
+
+def get_coexpressed_genes(rnaseq, k=20):
+    """
+    Returns the k rnaseqs of the study of the rnaseq with the highest Pearson correlation
+    of their values. Results are cached per rnaseq, k and update_date of the study
+    """
+    study = rnaseq.study
+    key = (study.pk, study.update_date, rnaseq.pk, k)
+    matrix = get_study_matrix(study, 'rnaseq')
+    rnaseq_ids = matrix.phenotype_ids
+    position = np.searchsorted(rnaseq_ids, rnaseq.pk)
+    if position >= len(rnaseq_ids) or rnaseq_ids[position] != rnaseq.pk:
+        return _coexpression_data(rnaseq, [], [], matrix)
+
+    result = CACHE.get(key)
+    if result is None:
+        standardized = get_standardized_values(study)
+        if standardized is None:
+            standardized = standardize(matrix.values.T)
+        indices, correlations = nearest_rows(standardized, [position], k)
+        result = CoexpressionResult(indices[0], correlations[0])
+        CACHE.set(key, result)
+    logger.debug('Co-expression cache: %s hits, %s misses, %s entries', CACHE.hits, CACHE.misses, len(CACHE))
+    present = ~np.isnan(result.correlations)
+    return _coexpression_data(rnaseq, result.indices[present], result.correlations[present], matrix)
+
+
+def _coexpression_data(rnaseq, indices, correlations, matrix):
+    rnaseq_ids = [int(rnaseq_id) for rnaseq_id in matrix.phenotype_ids[indices]]
+    conditions = dict(RNASeq.objects.filter(pk__in=rnaseq_ids).values_list('id', 'growth_conditions'))
+    neighbours = []
+    for rnaseq_id, name, correlation in zip(rnaseq_ids, matrix.phenotype_names[indices], correlations):
+        neighbours.append(OrderedDict([('rnaseq_id', rnaseq_id), ('name', name),
+                                       ('growth_conditions', conditions.get(rnaseq_id)),
+                                       ('correlation', float(correlation))]))
+    return OrderedDict([('rnaseq_id', rnaseq.pk), ('name', rnaseq.name), ('study_id', rnaseq.study_id),
+                        ('growth_conditions', rnaseq.growth_conditions), ('neighbours', neighbours)])
@@ -0,0 +1,277 @@
+"""
+Pairwise phenotype correlations on an accession aligned value matrix
+"""
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from django.conf import settings
+from phenotypedb.models import Phenotype, PhenotypeValue
+
+logger = logging.getLogger(__name__)
+
+AGGREGATES = ('mean', 'median')
+
+
+class PhenotypeNotFound(Exception):
+    """Raised when a requested phenotype does not exist or is not published"""
+
+    def __init__(self, phenotype_id):
+        super(PhenotypeNotFound, self).__init__('Phenotype %s not found' % phenotype_id)
+        self.phenotype_id = phenotype_id
+
+
+class CorrelationCache(object):
+    """
+    In-process LRU cache of computed correlations bounded by the size of the cached arrays
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Returns the cached entry or None and counts the hit or miss"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries[key] = entry
+        self.hits += 1
+        return entry
+
+    def set(self, key, entry):
+        """Stores the entry and evicts the least recently used entries if the cache is full"""
+        if entry.nbytes > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= old.nbytes
+        self._entries[key] = entry
+        self.size += entry.nbytes
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+CACHE = CorrelationCache(getattr(settings, 'CORRELATION_CACHE_MAX_BYTES', 0))
+
+
+class CorrelationResult(object):
+    """
+    Correlations and scatter data of a set of phenotypes in ascending id order
+    """
+
+    def __init__(self, labels, bounds, accession_ids, values, corr, spear, shared):
+        self.labels = labels
+        self.bounds = bounds
+        self.accession_ids = accession_ids
+        self.values = values
+        self.corr = corr
+        self.spear = spear
+        self.shared = shared
+
+    @property
+    def nbytes(self):
+        """Approximate size of the result in bytes"""
+        return (self.accession_ids.nbytes + self.values.nbytes + self.corr.nbytes +
+                self.spear.nbytes + self.shared.nbytes + sum(len(label) for label in self.labels))
+
+
+def get_phenotype_correlations(phenotype_ids, aggregate='mean'):
+    """
+    Returns the axes, scatter and sample overlap data and the Pearson and Spearman
+    correlation matrices of the phenotypes in the order of phenotype_ids.
+    Replicates of an accession are collapsed with the aggregate before correlating.
+    Results are cached per set of phenotypes and the update dates of their studies
+    """
+    if aggregate not in AGGREGATES:
+        raise ValueError('Aggregate %s not supported' % aggregate)
+    unique_ids = sorted(set(phenotype_ids))
+    phenotypes = dict((row[0], row[1:]) for row in Phenotype.objects.published()
+                      .filter(pk__in=unique_ids).values_list('id', 'name', 'study__name', 'study__update_date'))
+    for phenotype_id in phenotype_ids:
+        if phenotype_id not in phenotypes:
+            raise PhenotypeNotFound(phenotype_id)
+
+    key = (tuple(unique_ids), aggregate, tuple(phenotypes[pid][2] for pid in unique_ids))
+    result = CACHE.get(key)
+    if result is None:
+        result = _compute_correlations(unique_ids, phenotypes, aggregate)
+        CACHE.set(key, result)
+    logger.debug('Correlation cache: %s hits, %s misses, %s entries', CACHE.hits, CACHE.misses, len(CACHE))
+
+    # the positions of the requested (possibly repeated or reordered) phenotypes in the result
+    positions = np.searchsorted(unique_ids, phenotype_ids)
+    grid = np.ix_(positions, positions)
+    corr_mat = result.corr[grid]
+    spear_mat = result.spear[grid]
+    shared = result.shared[grid]
+
+    axes_data = []
+    scatter_data = []
+    labels = []
+    for i, phenotype_id in enumerate(phenotype_ids):
+        label = result.labels[positions[i]]
+        start, end = result.bounds[positions[i]], result.bounds[positions[i] + 1]
+        labels.append(label)
+        axes_data.append({'label': label, 'index': str(i), 'pheno_id': str(phenotype_id)})
+        scatter_data.append({'label': label, 'pheno_id': str(phenotype_id),
+                             'samples': result.accession_ids[start:end].tolist(),
+                             'values': result.values[start:end].tolist()})
+
+    # overlap counts: A and B are the number of values, C the number of shared accessions
+    counts = np.diff(result.bounds)[positions]
+    sample_data = []
+    for i, j in zip(*np.triu_indices(len(phenotype_ids), 1)):
+        sample_data.append({'labelA': labels[i], 'labelA_id': str(phenotype_ids[i]),
+                            'labelB': labels[j], 'labelB_id': str(phenotype_ids[j]),
+                            'A': int(counts[i]), 'B': int(counts[j]), 'C': int(shared[i, j])})
+
+    data = {}
+    data['axes_data'] = axes_data
+    data['scatter_data'] = scatter_data
+    data['sample_data'] = sample_data
+    data['corr_mat'] = str(corr_mat.tolist()).replace('nan', 'NaN')
+    data['spear_mat'] = str(spear_mat.tolist()).replace('nan', 'NaN')
+    return data
+
+
+def _compute_correlations(unique_ids, phenotypes, aggregate):
+    values = np.array(list(PhenotypeValue.objects.filter(phenotype_id__in=unique_ids)
+                           .order_by('phenotype_id', 'id')
+                           .values_list('phenotype_id', 'obs_unit__accession_id', 'value')),
+                      dtype=np.float64).reshape(-1, 3)
+    columns = np.searchsorted(unique_ids, values[:, 0])
+    accession_ids = values[:, 1].astype(np.int64)
+    matrix = aggregate_replicates(columns, accession_ids, values[:, 2], len(unique_ids), aggregate)
+    corr, shared = pearson_matrix(matrix)
+    spear, _ = spearman_matrix(matrix)
+    labels = []
+    for phenotype_id in unique_ids:
+        name, study_name, _ = phenotypes[phenotype_id]
+        labels.append(u'%s (%s)' % (name.replace('<i>', '').replace('</i>', ''), study_name))
+    bounds = np.searchsorted(columns, np.arange(len(unique_ids) + 1))
+    return CorrelationResult(labels, bounds, accession_ids, values[:, 2].copy(), corr, spear, shared)
+
+
+def aggregate_replicates(columns, accession_ids, values, n_columns, aggregate='mean'):
+    """
+    Returns an accessions x columns matrix with the values of the replicates
+    of an accession collapsed by the aggregate. Missing values are NaN
+    """
+    rows = np.unique(accession_ids)
+    if len(values) == 0:
+        return np.empty((0, n_columns), dtype=np.float64)
+    cells = np.searchsorted(rows, accession_ids) * n_columns + columns
+    if aggregate == 'mean':
+        size = len(rows) * n_columns
+        with np.errstate(invalid='ignore', divide='ignore'):
+            matrix = np.bincount(cells, values, size) / np.bincount(cells, minlength=size)
+        return matrix.reshape(len(rows), n_columns)
+    grouped = pd.Series(values).groupby(cells).agg(aggregate)
+    matrix = np.empty(len(rows) * n_columns, dtype=np.float64)
+    matrix.fill(np.nan)
+    matrix[grouped.index.values] = grouped.values
+    return matrix.reshape(len(rows), n_columns)
+
+
+def pearson_matrix(matrix):
+    """
+    Returns the pairwise-complete Pearson correlations between the columns of
+    a matrix with NaN for missing values and the number of overlapping rows.
+    Correlations of less than two overlapping rows are NaN
+    """
+    present = ~np.isnan(matrix)
+    mask = present.astype(np.float64)
+    filled = np.where(present, matrix, 0)
+    # centering does not change the correlation but reduces the cancellation error
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = filled.sum(axis=0) / mask.sum(axis=0)
+    centered = np.where(present, filled - means, 0)
+    n = np.dot(mask.T, mask)
+    sums = np.dot(centered.T, mask)
+    squares = np.dot((centered ** 2).T, mask)
+    products = np.dot(centered.T, centered)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cov = products - sums * sums.T / n
+        var = squares - sums ** 2 / n
+        corr = cov / np.sqrt(var * var.T)
+    return _finish(corr, n), n
+
+
+def spearman_matrix(matrix):
+    """
+    Returns the pairwise-complete Spearman correlations between the columns of
+    a matrix with NaN for missing values and the number of overlapping rows.
+    Columns are ranked on the overlapping rows of each pair with ties averaged
+    """
+    present = ~np.isnan(matrix)
+    mask = present.astype(np.float64)
+    n = np.dot(mask.T, mask)
+    corr, _ = pearson_matrix(_rank_columns(matrix))
+    # columns with the same missing values share all their rows and are correlated
+    # on the ranks of the whole columns above. Pairs of columns with different rows
+    # are ranked again on the rows of the first column's group
+    _, groups = np.unique(np.packbits(present, axis=0).T.copy().view(
+        np.dtype((np.void, (present.shape[0] + 7) // 8))), return_inverse=True)
+    for group in range(groups.max() + 1 if len(groups) else 0):
+        columns = np.flatnonzero(groups == group)
+        others = np.flatnonzero(groups > group)
+        rows = np.flatnonzero(present[:, columns[0]])
+        if len(others) == 0 or len(rows) == 0:
+            continue
+        ranks_others = _rank_columns(matrix[np.ix_(rows, others)])
+        ranks_others[np.isnan(ranks_others)] = 0
+        overlap = mask[np.ix_(rows, others)]
+        # ranks within an overlap of m rows always have the mean (m + 1) / 2
+        size = overlap.sum(axis=0)
+        offset = size * ((size + 1) / 2.0) ** 2
+        squares_others = (ranks_others ** 2).sum(axis=0) - offset
+        for i in columns:
+            order = np.argsort(matrix[rows, i], kind='mergesort')
+            sorted_overlap = overlap[order]
+            ranks_i = _rank_sorted(matrix[rows[order], i], sorted_overlap)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                corr[i, others] = corr[others, i] = (
+                    ((ranks_i * ranks_others[order]).sum(axis=0) - offset) /
+                    np.sqrt(((ranks_i ** 2 * sorted_overlap).sum(axis=0) - offset) * squares_others))
+    return _finish(corr, n), n
+
+
+def _rank_columns(matrix):
+    """Ranks the non-NaN values of each column with ties averaged"""
+    return pd.DataFrame(matrix).rank(axis=0, method='average').values
+
+
+def _rank_sorted(sorted_values, overlap):
+    """
+    Ranks the sorted values of one column separately within the rows
+    that are present in each column of overlap. Ties are averaged
+    """
+    positions = np.cumsum(overlap, axis=0)
+    # first and last row of each group of tied values
+    starts = np.flatnonzero(np.r_[True, sorted_values[1:] != sorted_values[:-1]])
+    ends = np.r_[starts[1:], len(sorted_values)] - 1
+    before = np.where((starts > 0)[:, None], positions[np.maximum(starts - 1, 0)], 0)
+    ranks = (before + positions[ends] + 1) / 2.0
+    return ranks[np.repeat(np.arange(len(starts)), ends - starts + 1)]
+
+
+def _finish(corr, n):
+    with np.errstate(invalid='ignore'):
+        corr = np.clip(corr, -1, 1)
+    corr[n < 2] = np.nan
+    return corr
@@ -0,0 +1,339 @@
+"""
+Incremental archive of the published studies for download (STATIC_ROOT/database.zip).
+A manifest next to the archive stores the update_date, a fingerprint of the metadata and
+of the number and sum of the values and the SHA-1 of every file of each study. Only the
+studies whose fingerprint changed are rendered again (in a pool of processes), the files
+of the other studies are copied from the previous archive without recompressing them.
+The new archive is written to a temporary file and moved into place, so the download
+is never incomplete.
+
+The values of RNASeq studies are exported as a float64 rnaseq x obs_unit matrix split
+into blocks of rows, so that they are written and read with bounded memory:
+
+    <study_id>/study_<study_id>_expression.json (shape, block size and block files)
+              /study_<study_id>_expression/<block>.npy
+              /study_<study_id>_genes.csv (rows of the matrix)
+              /study_<study_id>_accessions.csv (columns of the matrix)
+"""
+import copy
+import csv
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zipfile
+from collections import OrderedDict
+from cStringIO import StringIO
+
+import numpy as np
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count, Max, Sum
+from phenotypedb.models import ObservationUnit, Phenotype, PhenotypeValue, RNASeq, RNASeqValue, Study
+from phenotypedb.renderer import PhenotypeListRenderer, PhenotypeMatrixRenderer, PLINKMatrixRenderer, StudyListRenderer
+from phenotypedb.serializers import PhenotypeListSerializer, StudyListSerializer
+from utils.matrix import build_study_matrix, get_value_kind
+from utils.matrix_cache import get_study_matrix
+from utils.rnaseq_store import get_rnaseq_matrix
+
+logger = logging.getLogger(__name__)
+
+DUMP_NAME = 'database'
+
+MANIFEST_VERSION = 1
+
+# bytes copied at once from one archive to the other
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# rnaseqs per block of the exported expression matrices
+RNASEQ_BLOCK_SIZE = 500
+
+
+def generate_database_dump(processes=None, force=False):
+    """
+    Updates the archive of the published studies and returns its path.
+    Changed studies are rendered with a pool of processes (all in this process if processes is 1).
+    With force all studies are rendered again
+    """
+    output_filename = os.path.join(settings.STATIC_ROOT, '%s.zip' % DUMP_NAME)
+    manifest_filename = os.path.join(settings.STATIC_ROOT, '%s.manifest.json' % DUMP_NAME)
+    manifest = {} if force else _load_manifest(manifest_filename, output_filename)
+
+    studies = list(Study.objects.published().order_by('id'))
+    fingerprints = get_fingerprints(studies)
+    entries = OrderedDict()
+    changed = []
+    for study in studies:
+        entry = manifest.get('studies', {}).get(str(study.id))
+        if entry is None or entry['fingerprint'] != fingerprints[study.id]:
+            changed.append(study.id)
+        else:
+            entries[study.id] = entry
+    logger.info('Rendering %s of %s studies of the database dump', len(changed), len(studies))
+
+    folder = tempfile.mkdtemp()
+    try:
+        rendered = dict((study_id, (path, members)) for study_id, path, members in
+                        _render_studies(changed, folder, processes))
+        for study in studies:
+            if study.id in rendered:
+                entries[study.id] = {'update_date': _format_date(study.update_date),
+                                     'fingerprint': fingerprints[study.id],
+                                     'members': rendered[study.id][1]}
+        fhandle, tmp_filename = tempfile.mkstemp(prefix='.%s-' % DUMP_NAME, suffix='.zip', dir=settings.STATIC_ROOT)
+        os.close(fhandle)
+        try:
+            previous = zipfile.ZipFile(output_filename) if entries and os.path.exists(output_filename) else None
+            try:
+                with zipfile.ZipFile(tmp_filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+                    archive.writestr(_zip_info('study_list.csv'), render_study_list(studies))
+                    for study in studies:
+                        if study.id in rendered:
+                            with zipfile.ZipFile(rendered[study.id][0]) as source:
+                                for info in source.infolist():
+                                    copy_member(source, info, archive)
+                        else:
+                            for name in entries[study.id]['members']:
+                                copy_member(previous, previous.getinfo(name), archive)
+            finally:
+                if previous is not None:
+                    previous.close()
+            os.chmod(tmp_filename, 0o644)
+            os.rename(tmp_filename, output_filename)
+        except Exception:
+            os.remove(tmp_filename)
+            raise
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    stat = os.stat(output_filename)
+    _write_json(manifest_filename, {'version': MANIFEST_VERSION,
+                                    'archive_size': stat.st_size,
+                                    'archive_mtime': int(stat.st_mtime),
+                                    'studies': dict((str(study_id), entry) for study_id, entry in entries.items())})
+    return output_filename
+
+
+def get_fingerprints(studies):
+    """
+    Returns the SHA-1 of the update_date and the fields of each study, the fields of its phenotypes,
+    the accessions of its obs_units and the number, last id and sum of its rnaseqs and values.
+    The rnaseqs and values are only counted with aggregate queries, so that a value that is
+    changed without the update_date of its study still changes the fingerprint
+    """
+    study_fields = [field.attname for field in Study._meta.concrete_fields]
+    study_ids = [study.id for study in studies]
+    content = dict((study.id, OrderedDict([('study', [getattr(study, field) for field in study_fields]),
+                                           ('phenotypes', []), ('accessions', [])])) for study in studies)
+    fields = [field.attname for field in Phenotype._meta.concrete_fields]
+    for row in Phenotype.objects.filter(study_id__in=study_ids).order_by('id').values_list(*fields):
+        content[row[fields.index('study_id')]]['phenotypes'].append(row)
+    obs_units = ObservationUnit.objects.filter(study_id__in=study_ids).order_by('id')
+    for study_id, accession_id, accession_name in obs_units.values_list('study_id', 'accession_id', 'accession__name'):
+        content[study_id]['accessions'].append((accession_id, accession_name))
+    for key, model, study_field, aggregates in (
+            ('rnaseqs', RNASeq, 'study_id', [Count('id'), Max('id')]),
+            ('phenotype_values', PhenotypeValue, 'phenotype__study_id', [Count('id'), Max('id'), Sum('value')]),
+            ('rnaseq_values', RNASeqValue, 'rnaseq__study_id', [Count('id'), Max('id'), Sum('value')])):
+        aggregates = OrderedDict(('aggregate_%s' % i, aggregate) for i, aggregate in enumerate(aggregates))
+        rows = (model.objects.filter(**{'%s__in' % study_field: study_ids}).order_by()
+                .values(study_field).annotate(**aggregates))
+        for row in rows:
+            # the sums are rounded, so that the order of the summation does not change them
+            content[row[study_field]][key] = [_format_aggregate(row[name]) for name in aggregates]
+    fingerprints = {}
+    for study in studies:
+        fingerprints[study.id] = hashlib.sha1(json.dumps(content[study.id], default=_format_date)).hexdigest()
+    return fingerprints
+
+
+def render_study(study_id):
+    """Yields the names and contents of the files of a study in the archive"""
+    study = Study.objects.get(pk=study_id)
+    if get_value_kind(study) == 'rnaseq':
+        for member in render_rnaseq_study(study):
+            yield member
+        return
+    matrix = get_study_matrix(study)
+    for fmt, renderer in (('csv', PhenotypeMatrixRenderer()), ('plink', PLINKMatrixRenderer())):
+        yield '%s/study_%s_values.%s' % (study.id, study.id, fmt), renderer.render(matrix)
+    serializer = PhenotypeListSerializer(study.phenotype_set.all(), many=True)
+    yield '%s/study_%s_phenotypes.csv' % (study.id, study.id), PhenotypeListRenderer().render(serializer.data)
+
+
+def render_rnaseq_study(study, block_size=RNASEQ_BLOCK_SIZE):
+    """
+    Yields the names and contents of the files of an RNASeq study in the archive.
+    Only one block of rows of the expression matrix is held in memory at a time.
+    The rows are all rnaseqs and the columns all obs_units of the study ordered by id
+    """
+    prefix = '%s/study_%s' % (study.id, study.id)
+    rnaseqs = list(RNASeq.objects.filter(study_id=study.id).order_by('id')
+                   .values_list('id', 'name', 'gene_index__gene_id', 'growth_conditions'))
+    obs_units = list(ObservationUnit.objects.filter(study_id=study.id).order_by('id')
+                     .values_list('id', 'accession_id', 'accession__name'))
+    rnaseq_ids = np.array([rnaseq[0] for rnaseq in rnaseqs], dtype=np.int64)
+    obs_unit_ids = np.array([obs_unit[0] for obs_unit in obs_units], dtype=np.int64)
+    starts = range(0, len(rnaseq_ids), block_size)
+    blocks = ['%s_expression/%05d.npy' % (prefix, number) for number in range(len(starts))]
+
+    yield '%s_expression.json' % prefix, json.dumps(OrderedDict([
+        ('dtype', 'float64'),
+        ('shape', [len(rnaseq_ids), len(obs_unit_ids)]),
+        ('block_size', block_size),
+        ('blocks', [os.path.basename(block) for block in blocks]),
+        ('rows', os.path.basename('%s_genes.csv' % prefix)),
+        ('columns', os.path.basename('%s_accessions.csv' % prefix))]), indent=1)
+    yield '%s_genes.csv' % prefix, _render_csv(('row', 'rnaseq_id', 'name', 'gene_id', 'growth_conditions'),
+                                               [(row,) + rnaseq for row, rnaseq in enumerate(rnaseqs)])
+    yield '%s_accessions.csv' % prefix, _render_csv(('column', 'obs_unit_id', 'accession_id', 'accession_name'),
+                                                    [(column,) + obs_unit for column, obs_unit in enumerate(obs_units)])
+    stored = get_rnaseq_matrix(study)
+    for name, start in zip(blocks, starts):
+        values = _expression_block(study, stored, rnaseq_ids[start:start + block_size], obs_unit_ids)
+        content = io.BytesIO()
+        np.save(content, values)
+        yield name, content.getvalue()
+
+
+def render_study_list(studies):
+    """Returns the content of the list of the studies in the archive"""
+    return StudyListRenderer().render(StudyListSerializer(studies, many=True).data)
+
+
+def copy_member(source, info, target):
+    """
+    Copies the compressed data of a member of the source ZipFile to the target
+    ZipFile (opened for writing) without decompressing and compressing it again
+    """
+    source.fp.seek(info.header_offset)
+    header = struct.unpack(zipfile.structFileHeader, source.fp.read(zipfile.sizeFileHeader))
+    source.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+    member = copy.copy(info)
+    # the sizes and CRC are known, so they are written to the header instead of a data descriptor
+    member.flag_bits &= ~0x08
+    member.header_offset = target.fp.tell()
+    target.fp.write(member.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = source.fp.read(min(remaining, COPY_CHUNK_SIZE))
+        if not chunk:
+            raise zipfile.BadZipfile('Member %s of %s is truncated' % (info.filename, source.filename))
+        target.fp.write(chunk)
+        remaining -= len(chunk)
+    # register the member like ZipFile.write does, so that close() writes the central directory
+    target.filelist.append(member)
+    target.NameToInfo[member.filename] = member
+    target._didModify = True
+    if hasattr(target, 'start_dir'):
+        target.start_dir = target.fp.tell()
+
+
+def _render_studies(study_ids, folder, processes=None):
+    """Yields (study_id, archive path, member hashes) of the studies rendered to an archive per study"""
+    tasks = [(study_id, folder) for study_id in study_ids]
+    if processes == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield _render_task(task)
+        return
+    # the forked processes must not share the database connection of the parent
+    connections.close_all()
+    pool = multiprocessing.Pool(processes)
+    try:
+        for result in pool.imap_unordered(_render_task, tasks):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _render_task(task):
+    study_id, folder = task
+    try:
+        members = OrderedDict()
+        path = os.path.join(folder, '%s.zip' % study_id)
+        # the files are compressed in the worker, the archive only copies them
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for name, content in render_study(study_id):
+                archive.writestr(_zip_info(name), content)
+                members[name] = hashlib.sha1(content).hexdigest()
+        logger.info('Rendered study %s of the database dump', study_id)
+        return study_id, path, members
+    except Exception as err:
+        # database exceptions can not be pickled and sent to the parent process
+        raise Exception('%s: %s' % (type(err).__name__, str(err)))
+    finally:
+        if multiprocessing.current_process().name != 'MainProcess':
+            connections.close_all()
+
+
+def _load_manifest(manifest_filename, output_filename):
+    """Returns the manifest if it describes the current archive and an empty manifest otherwise"""
+    try:
+        with open(manifest_filename) as fhandle:
+            manifest = json.load(fhandle, object_pairs_hook=OrderedDict)
+        stat = os.stat(output_filename)
+    except (IOError, OSError, ValueError):
+        return {}
+    if (manifest.get('version') != MANIFEST_VERSION or manifest.get('archive_size') != stat.st_size or
+            manifest.get('archive_mtime') != int(stat.st_mtime)):
+        logger.warn('The manifest %s does not match %s, all studies are rendered', manifest_filename, output_filename)
+        return {}
+    return manifest
+
+
+def _write_json(filename, data):
+    fhandle, tmp_filename = tempfile.mkstemp(prefix='.tmp', dir=os.path.dirname(filename))
+    with os.fdopen(fhandle, 'w') as tmp_file:
+        json.dump(data, tmp_file, indent=1)
+    os.chmod(tmp_filename, 0o644)
+    os.rename(tmp_filename, filename)
+
+
+def _expression_block(study, stored, rnaseq_ids, obs_unit_ids):
+    """
+    Returns the float64 values of the rnaseqs per obs_unit from the stored matrix
+    or with one query for the block if it is not stored. Missing values are NaN
+    """
+    values = np.empty((len(rnaseq_ids), len(obs_unit_ids)), dtype=np.float64)
+    values.fill(np.nan)
+    if stored is None:
+        matrix = build_study_matrix(study, 'rnaseq', variable_ids=rnaseq_ids.tolist())
+        rows, columns, block = matrix.phenotype_ids, matrix.obs_unit_ids, matrix.values.T
+    else:
+        ix = np.flatnonzero(np.in1d(stored.rnaseq_ids, rnaseq_ids))
+        rows, columns, block = stored.rnaseq_ids[ix], stored.obs_unit_ids, stored.values[ix]
+    if len(rows) and len(columns):
+        values[np.ix_(np.searchsorted(rnaseq_ids, rows), np.searchsorted(obs_unit_ids, columns))] = block
+    return values
+
+
+def _render_csv(header, rows):
+    content = StringIO()
+    writer = csv.writer(content)
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value for value in row])
+    return content.getvalue()
+
+
+def _zip_info(name):
+    info = zipfile.ZipInfo(name, time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o644 << 16
+    return info
+
+
+def _format_aggregate(value):
+    return '%.10g' % value if isinstance(value, float) else value
+
+
+def _format_date(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
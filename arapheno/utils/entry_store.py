@@ -0,0 +1,145 @@
+"""
+Per-study entries of the on-disk caches (study matrices, RNASeq matrices and ISA-TAB archives).
+Every entry is named by the update_date of its study, so a changed study never reads an
+outdated entry. Entries are written to a temporary path and renamed into place, so that
+readers never see a partial entry:
+
+    <cache dir>/<study_id>/<update_date><suffix>
+    <cache dir>/<study_id>.lock
+"""
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+TMP_PREFIX = '.tmp'
+
+
+class EntryStore(object):
+    """
+    Entries of the studies under the directory of a setting.
+    The store is disabled if the setting is empty
+    """
+
+    def __init__(self, setting, description):
+        self.setting = setting
+        self.description = description
+
+    @property
+    def root(self):
+        """Returns the directory of the store or None if it is disabled"""
+        return getattr(settings, self.setting, None) or None
+
+    def get_study_dir(self, study_id):
+        return os.path.join(self.root, str(study_id))
+
+    def get_path(self, study, suffix=''):
+        """Returns the path of the entry of a study or None if the store is disabled"""
+        if self.root is None:
+            return None
+        return os.path.join(self.get_study_dir(study.id), get_stamp(study) + suffix)
+
+    @contextmanager
+    def lock(self, study_id):
+        """Locks the entries of a study, so that only one process builds an entry and the others wait"""
+        makedirs(self.get_study_dir(study_id))
+        with open(os.path.join(self.root, '%s.lock' % study_id), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def store_dir(self, path, write):
+        """
+        Calls write with a temporary directory and moves it to the path of the entry.
+        Returns whether the entry was stored
+        """
+        try:
+            makedirs(os.path.dirname(path))
+            tmp_dir = tempfile.mkdtemp(prefix=TMP_PREFIX, dir=os.path.dirname(path))
+        except OSError as err:
+            logger.warn('Could not store %s in %s. Reason: %s', self.description, path, str(err))
+            return False
+        try:
+            write(tmp_dir)
+        except (IOError, OSError) as err:
+            logger.warn('Could not store %s in %s. Reason: %s', self.description, path, str(err))
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return False
+        return self.move_into_place(tmp_dir, path)
+
+    def open_tmp_file(self, path, suffix=''):
+        """Returns a temporary file next to the path of an entry or None if it can not be created"""
+        try:
+            makedirs(os.path.dirname(path))
+            fhandle, tmp_path = tempfile.mkstemp(prefix=TMP_PREFIX, suffix=suffix, dir=os.path.dirname(path))
+        except OSError as err:
+            logger.warn('Could not store %s in %s. Reason: %s', self.description, path, str(err))
+            return None
+        os.close(fhandle)
+        os.chmod(tmp_path, 0o644)
+        return open(tmp_path, 'wb')
+
+    def move_into_place(self, tmp_path, path):
+        """Renames a temporary file or directory to the path of an entry. Returns whether it was moved"""
+        try:
+            os.rename(tmp_path, path)
+            return True
+        except OSError as err:
+            # the study was invalidated while the entry was built
+            logger.warn('Could not store %s in %s. Reason: %s', self.description, path, str(err))
+            _remove(tmp_path)
+            return False
+
+    def remove_outdated(self, path):
+        """Removes the other entries of the study of an entry, e.g. of earlier update_dates"""
+        study_dir = os.path.dirname(path)
+        try:
+            entries = os.listdir(study_dir)
+        except OSError:
+            return
+        for entry in entries:
+            if entry != os.path.basename(path) and not entry.startswith(TMP_PREFIX):
+                _remove(os.path.join(study_dir, entry))
+
+    def remove(self, study_id):
+        """Removes all entries of a study"""
+        if self.root is None:
+            return
+        study_dir = self.get_study_dir(study_id)
+        if os.path.isdir(study_dir):
+            shutil.rmtree(study_dir, ignore_errors=True)
+
+
+def get_stamp(study):
+    """Returns the name of the entries of the current update_date of a study"""
+    if study.update_date is None:
+        return 'none'
+    return study.update_date.strftime('%Y%m%d%H%M%S%f')
+
+
+def makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+
+def _remove(path):
+    # processes that still have the files of an entry open or mapped keep reading the unlinked files
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,110 @@
+"""
+Index of the RNASeqs of all studies by gene id.
+The entries are created when the RNASeqs are imported, so that the values of a gene
+in every RNASeq study are found with one indexed query and aligned by accession
+"""
+import re
+from collections import OrderedDict
+from itertools import groupby
+
+import numpy as np
+
+from django.db import transaction
+from phenotypedb.models import PUBLISHED, RNASeq, RNASeqGene
+from utils.rnaseq_store import get_gene_matrix
+
+ISOFORM_PATTERN = re.compile(r'^(.+?)\.\d+$')
+
+# entries that are inserted together when the index is rebuilt
+CHUNK_SIZE = 10000
+
+
+def normalize_gene_id(name):
+    """Returns the normalized gene id of a rnaseq name and the gene id without isoform suffix"""
+    gene_id = (name or '').strip().upper()
+    isoform = ISOFORM_PATTERN.match(gene_id)
+    return gene_id, isoform.group(1) if isoform else gene_id
+
+
+def index_rnaseqs(rnaseqs):
+    """Adds or replaces the index entries of the rnaseqs"""
+    entries = [_entry(rnaseq.pk, rnaseq.name, rnaseq.study_id, rnaseq.growth_conditions) for rnaseq in rnaseqs]
+    with transaction.atomic():
+        RNASeqGene.objects.filter(rnaseq_id__in=[entry.rnaseq_id for entry in entries]).delete()
+        RNASeqGene.objects.bulk_create(entries)
+    return len(entries)
+
+
+def rebuild_gene_index():
+    """Rebuilds the index of all rnaseqs in chunks and returns the number of entries"""
+    rows = RNASeq.objects.order_by('id').values_list('id', 'name', 'study_id', 'growth_conditions')
+    count = 0
+    entries = []
+    with transaction.atomic():
+        RNASeqGene.objects.all().delete()
+        for row in rows.iterator():
+            entries.append(_entry(*row))
+            if len(entries) == CHUNK_SIZE:
+                RNASeqGene.objects.bulk_create(entries)
+                count += len(entries)
+                entries = []
+        RNASeqGene.objects.bulk_create(entries)
+    return count + len(entries)
+
+
+def find_rnaseqs(gene_id):
+    """
+    Returns the index entries of a gene in the published studies. A gene id without
+    isoform suffix also matches the rnaseqs of all its isoforms
+    """
+    gene_id, locus_id = normalize_gene_id(gene_id)
+    entries = RNASeqGene.objects.filter(study__submission__status=PUBLISHED)
+    if gene_id == locus_id:
+        entries = entries.filter(locus_id=locus_id)
+    else:
+        entries = entries.filter(gene_id=gene_id)
+    return entries.select_related('rnaseq', 'study').order_by('study_id', 'gene_id', 'rnaseq_id')
+
+
+def _entry(rnaseq_id, name, study_id, growth_conditions):
+    gene_id, locus_id = normalize_gene_id(name)
+    return RNASeqGene(rnaseq_id=rnaseq_id, study_id=study_id, gene_id=gene_id,
+                      locus_id=locus_id, growth_conditions=growth_conditions)
+
+
+def get_gene_values(gene_id):
+    """
+    Returns the values of a gene in all published RNASeq studies as columns aligned by accession.
+    Values of replicates of an accession within a study are averaged
+    """
+    entries = list(find_rnaseqs(gene_id))
+    matrices = []
+    for _, study_entries in groupby(entries, key=lambda entry: entry.study_id):
+        study_entries = list(study_entries)
+        matrix = get_gene_matrix(study_entries[0].study, [entry.rnaseq_id for entry in study_entries])
+        matrices.append(matrix)
+    accession_ids = np.unique(np.concatenate([matrix.accession_ids for matrix in matrices] or [np.zeros(0, dtype=np.int64)]))
+    accession_names = {}
+    columns = dict((entry.rnaseq_id, None) for entry in entries)
+    for matrix in matrices:
+        accession_names.update(zip(matrix.accession_ids.tolist(), matrix.accession_names.tolist()))
+        rows = np.searchsorted(accession_ids, matrix.accession_ids)
+        values = matrix.values
+        for i, rnaseq_id in enumerate(matrix.phenotype_ids.tolist()):
+            present = ~np.isnan(values[:, i])
+            sums = np.bincount(rows[present], values[present, i], minlength=len(accession_ids))
+            counts = np.bincount(rows[present], minlength=len(accession_ids))
+            column = np.empty(len(accession_ids))
+            column.fill(np.nan)
+            column[counts > 0] = sums[counts > 0] / counts[counts > 0]
+            columns[rnaseq_id] = [None if value != value else value for value in column.tolist()]
+    empty = [None] * len(accession_ids)
+    return OrderedDict([
+        ('gene_id', normalize_gene_id(gene_id)[0]),
+        ('rnaseqs', [OrderedDict([('id', entry.rnaseq_id), ('name', entry.rnaseq.name),
+                                  ('study_id', entry.study_id), ('study_name', entry.study.name),
+                                  ('growth_conditions', entry.growth_conditions)]) for entry in entries]),
+        ('accession_id', accession_ids.tolist()),
+        ('accession_name', [accession_names[accession_id] for accession_id in accession_ids.tolist()]),
+        ('values', [columns[entry.rnaseq_id] or empty for entry in entries]),
+    ])
@@ -9,8 +9,13 @@ from phenotypedb.models import Study,Phenotype,PhenotypeValue,Publication, Acces
 from django.db import transaction
 import datetime
 import codecs
+from io import BytesIO
+
+import numpy as np
 
 from phenotypedb.renderer import IsaTabStudyRenderer, IsaTabAssayRenderer,IsaTabDerivedDataFileRenderer,IsaTabTraitDefinitionRenderer
+from utils.matrix_cache import get_study_matrix
+from utils.isatab_cache import get_archive_path, stream_archive
 
 logger = logging.getLogger(__name__)
 
@@ -211,16 +216,31 @@ def export_isatab(study):
     return output_filename
 
 
+def stream_isatab(study):
+    """
+    Yields the bytes of the ISA-TAB archive of a study while its files are rendered
+    and stores the archive in the ISA-TAB cache once it is complete
+    """
+    return stream_archive(render_isatab_files(study), get_archive_path(study))
+
+
+def render_isatab_files(study):
+    """Yields the names and contents of the ISA-TAB files of a study"""
+    yield 'i_investigation.txt', _render_investigation_file(study)
+    # the investigation file is sent while the matrix is loaded
+    matrix = get_study_matrix(study)
+    yield 's_study%s.txt' % study.id, _render_study_file(study,matrix)
+    yield 'a_study%s.txt' % study.id, _render_assay_file(study,matrix)
+    yield 'tdf.txt', _render_tdf_file(study)
+    yield 'd_data.txt', _render_data_file(matrix)
+
+
 def _create_isatab_files(study,folder):
-    df,df_pivot = study.get_matrix_and_accession_map(column='phenotype_id')
-    _create_investigation_file(study,folder)
-    _create_study_file(study,df,df_pivot,folder)
-    _create_assay_file(study,df,folder)
-    _create_tdf_file(study,folder)
-    _create_data_file(df_pivot,folder)
-    pass
+    for filename, content in render_isatab_files(study):
+        with open(os.path.join(folder,filename),'w') as f:
+            f.write(content)
 
-def _create_investigation_file(study,folder):
+def _render_investigation_file(study):
 
     ontology_reference = """ONTOLOGY SOURCE REFERENCE
 Term Source Name	OBI	EFO	UO	NCBITaxon	PO	GMI_accessions
@@ -358,50 +378,19 @@ Study Person Roles Term Source REF
 """ % {'study_id':study.id}
 
     investigation_content = ontology_reference + investigation + investigation_publications + investigation_contacts + study_info + study_publications + assays
-    investigation_filename = os.path.join(folder,'i_investigation.txt')
-    with open(investigation_filename,'w') as f:
-        f.write(investigation_content.encode('utf-8'))
-    return investigation_filename
+    return investigation_content.encode('utf-8')
 
 
-def _create_study_file(study,df,df_pivot,folder):
-    renderer = IsaTabStudyRenderer()
+def _render_study_file(study,matrix):
     organism = '%s %s' % (study.species.genus,study.species.species)
-    ncbi_id = study.species.ncbi_id
+    return write_study_table(matrix,organism,study.species.ncbi_id)
 
-    data = []
-    for obs_unit_id,row in df_pivot.iterrows():
-        info = df.ix[obs_unit_id]
-        accession_id = info.accession_id
-        accession_name = info.accession_name
-        csv_row = {'source':'source%s' % accession_id ,'organism':organism,'organism_ref':'NCBITaxon','ncbi_id':ncbi_id,
-        'accession_name':accession_name,'accession_ref':'GMI_accessions','accession_id':accession_id,
-        'sample':'sample%s' % obs_unit_id}
-        data.append(csv_row)
-    content = renderer.render(data)
-
-    study_filename = os.path.join(folder,'s_study%s.txt' % study.id)
-    with open(study_filename,'w') as f:
-        f.write(content)
-    return study_filename
-
-def _create_assay_file(study,df,folder):
-    renderer = IsaTabAssayRenderer()
-    data = []
-    for obs_unit_id,row in df.iterrows():
-        csv_row = {'sample':'sample%s' % obs_unit_id ,'assay':'assay%s' % obs_unit_id,
-        'protocol_ref':'Data transformation','trait_def_file':'tdf.txt','derived_data_file':'d_data.txt'}
-        data.append(csv_row)
-    content = renderer.render(data)
-
-    assay_filename = os.path.join(folder,'a_study%s.txt' % study.id)
-    with open(assay_filename,'w') as f:
-        f.write(content)
-    return assay_filename
+def _render_assay_file(study,matrix):
+    return write_assay_table(matrix)
 
 
 
-def _create_tdf_file(study,folder):
+def _render_tdf_file(study):
     renderer = IsaTabTraitDefinitionRenderer()
     data = []
     for phenotype in study.phenotype_set.all():
@@ -416,27 +405,76 @@ def _create_tdf_file(study,folder):
 
         data.append(row)
 
-    content = renderer.render(data)
-
-    tdf_filename = os.path.join(folder,'tdf.txt')
-    with open(tdf_filename,'w') as f:
-        f.write(content)
-    return tdf_filename
-
-def _create_data_file(df_pivot,folder):
-    df_empty = df_pivot.fillna('')
-    renderer = IsaTabDerivedDataFileRenderer()
-    data = []
-    headers = map(str,df_empty.columns.tolist())
-    for obs_unit_id,row in df_empty.iterrows():
-        csv_row = {'assay':'assay%s'% obs_unit_id}
-        for i,value in enumerate(row.values):
-            csv_row[headers[i]] = value
-        data.append(csv_row)
-
-    content = renderer.render(data)
-
-    data_filename = os.path.join(folder,'d_data.txt')
-    with open(data_filename,'w') as f:
-        f.write(content)
-    return data_filename
+    return renderer.render(data)
+
+def _render_data_file(matrix):
+    return write_data_table(matrix)
+
+
+def write_study_table(matrix,organism,ncbi_id):
+    """
+    Returns the s_ file of a StudyMatrix with one source per accession and
+    one sample per obs_unit in the header order of IsaTabStudyRenderer
+    """
+    columns = {'source':_prefix('source',matrix.accession_ids),'organism':_encode(organism),
+               'organism_ref':'NCBITaxon','ncbi_id':ncbi_id,'accession_name':_encode(matrix.accession_names),
+               'accession_ref':'GMI_accessions','accession_id':matrix.accession_ids,
+               'sample':_prefix('sample',matrix.obs_unit_ids)}
+    return _write_table(IsaTabStudyRenderer,columns,len(matrix.obs_unit_ids))
+
+
+def write_assay_table(matrix):
+    """Returns the a_ file of a StudyMatrix with one assay per obs_unit in the header order of IsaTabAssayRenderer"""
+    columns = {'sample':_prefix('sample',matrix.obs_unit_ids),'assay':_prefix('assay',matrix.obs_unit_ids),
+               'protocol_ref':'Data transformation','trait_def_file':'tdf.txt','derived_data_file':'d_data.txt'}
+    return _write_table(IsaTabAssayRenderer,columns,len(matrix.obs_unit_ids))
+
+
+def write_data_table(matrix):
+    """
+    Returns the d_ file of a StudyMatrix with one row per assay and one column
+    per phenotype ordered by id. Missing values are blank
+    """
+    labels, order = matrix.get_columns('phenotype_id')
+    values = matrix.values[:,order]
+    table = np.empty((len(matrix.obs_unit_ids),len(labels) + 1),dtype=object)
+    table[:,0] = _prefix('assay',matrix.obs_unit_ids)
+    # the floats are formatted by the csv writer, so only the blank cells are replaced
+    table[:,1:] = values
+    table[:,1:][np.isnan(values)] = ''
+    header = [IsaTabDerivedDataFileRenderer.labels['assay']] + [str(label) for label in labels]
+    return _write_rows(header,table)
+
+
+def _write_table(renderer_class,columns,n_rows):
+    """
+    Returns the tab separated table of the columns (scalars or arrays of n_rows values)
+    in the header order of the renderer class. Columns that are not given are blank
+    """
+    table = np.empty((n_rows,len(renderer_class.header)),dtype=object)
+    table.fill('')
+    for i, key in enumerate(renderer_class.header):
+        if key in columns:
+            table[:,i] = columns[key]
+    header = [renderer_class.labels.get(key,key) for key in renderer_class.header]
+    return _write_rows(header,table)
+
+
+def _write_rows(header,table):
+    content = BytesIO()
+    writer = csv.writer(content,delimiter='\t')
+    writer.writerow(header)
+    writer.writerows(table.tolist())
+    return content.getvalue()
+
+
+def _prefix(prefix,ids):
+    return np.char.add(prefix,np.asarray(ids).astype(str))
+
+
+def _encode(values):
+    if isinstance(values,unicode):
+        return values.encode('utf-8')
+    if isinstance(values,np.ndarray):
+        return np.char.encode(values.astype(unicode),'utf-8')
+    return values
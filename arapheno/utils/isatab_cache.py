@@ -0,0 +1,110 @@
+"""
+On-disk cache of the ISA-TAB archives of the studies.
+An archive is stored per study and update_date under settings.ISATAB_CACHE_DIR
+and served from there until the study changes:
+
+    <cache dir>/<study_id>/<update_date>.zip
+
+On a miss the archive is streamed while its files are rendered, so the first
+bytes are sent before the whole archive is built, and it is stored once complete
+"""
+import logging
+import os
+import time
+import zipfile
+
+from utils.entry_store import EntryStore
+
+logger = logging.getLogger(__name__)
+
+STORE = EntryStore('ISATAB_CACHE_DIR', 'ISA-TAB archive')
+
+
+class ZipStream(object):
+    """
+    Write-only file for a ZipFile that keeps the written bytes until they are
+    taken with pop() and copies them to an optional file. The copy is given up
+    (copy_file is set to None) if it can not be written
+    """
+
+    def __init__(self, copy_file=None):
+        self.copy_file = copy_file
+        self.offset = 0
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.offset += len(data)
+        if self.copy_file is not None:
+            try:
+                self.copy_file.write(data)
+            except (IOError, OSError) as err:
+                logger.warn('Could not cache ISA-TAB archive in %s. Reason: %s', self.copy_file.name, str(err))
+                self.copy_file = None
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def get_archive_path(study):
+    """Returns the path of the cached archive of a study or None if the cache is disabled"""
+    return STORE.get_path(study, '.zip')
+
+
+def get_cached_archive(study):
+    """Returns the path of the cached archive of a study or None if it is not cached"""
+    path = get_archive_path(study)
+    if path is None or not os.path.isfile(path):
+        return None
+    return path
+
+
+def stream_archive(members, path=None):
+    """
+    Yields the bytes of a zip archive of the (name, content) members as they are
+    rendered and stores the archive at path if it is completed
+    """
+    tmp_file = STORE.open_tmp_file(path, '.zip') if path is not None else None
+    stream = ZipStream(tmp_file)
+    try:
+        archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        for name, content in members:
+            info = zipfile.ZipInfo(name, time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            archive.writestr(info, content)
+            yield stream.pop()
+        archive.close()
+        yield stream.pop()
+        if stream.copy_file is not None:
+            tmp_file.close()
+            if STORE.move_into_place(tmp_file.name, path):
+                # the archives of earlier update_dates are outdated
+                STORE.remove_outdated(path)
+            tmp_file = None
+    finally:
+        # the client disconnected or the rendering failed
+        if tmp_file is not None:
+            stream.copy_file = None
+            tmp_file.close()
+            _remove(tmp_file.name)
+
+
+def remove_archives(study_id):
+    """Removes the cached archives of a study"""
+    STORE.remove(study_id)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
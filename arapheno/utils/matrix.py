@@ -0,0 +1,200 @@
+"""
+Columnar obs_unit x phenotype value matrix of a study
+"""
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from django.db import connection
+from phenotypedb.models import ObservationUnit, Phenotype, RNASeq
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 50000
+
+VALUE_TABLES = {
+    'phenotype': ('phenotypedb_phenotypevalue', 'phenotypedb_phenotype', 'phenotype_id'),
+    'rnaseq': ('phenotypedb_rnaseqvalue', 'phenotypedb_rnaseq', 'rnaseq_id'),
+}
+
+
+class StudyMatrix(object):
+    """
+    Values of a study as a dense float matrix (obs_units x phenotypes)
+    with the row and column meta-information as arrays.
+    Missing values are stored as NaN
+    """
+
+    def __init__(self, obs_unit_ids, accession_ids, accession_names, phenotype_ids, phenotype_names, values):
+        self.obs_unit_ids = np.asarray(obs_unit_ids, dtype=np.int64)
+        self.accession_ids = np.asarray(accession_ids, dtype=np.int64)
+        self.accession_names = np.asarray(accession_names, dtype=object)
+        self.phenotype_ids = np.asarray(phenotype_ids, dtype=np.int64)
+        self.phenotype_names = np.asarray(phenotype_names, dtype=object)
+        self.values = values
+
+    @property
+    def shape(self):
+        """Returns the number of obs_units and phenotypes"""
+        return self.values.shape
+
+    def get_columns(self, column='phenotype_name'):
+        """
+        Returns the column labels and the order of the columns.
+        Columns are sorted by the label. Names that occur more than once
+        (e.g. a gene under two growth conditions) are labelled with the id
+        """
+        if column == 'phenotype_id':
+            labels = self.phenotype_ids
+        elif column == 'phenotype_name':
+            labels = self.phenotype_names
+            names, counts = np.unique(labels, return_counts=True)
+            duplicated = np.in1d(labels, names[counts > 1])
+            if duplicated.any():
+                labels = labels.copy()
+                labels[duplicated] = ['%s (%s)' % (name, pk) for name, pk in
+                                      zip(labels[duplicated], self.phenotype_ids[duplicated].tolist())]
+        else:
+            raise ValueError('Column %s not supported' % column)
+        order = np.argsort(labels, kind='mergesort')
+        return labels[order].tolist(), order
+
+    def iter_rows(self, column='phenotype_name', missing=''):
+        """
+        Yields (obs_unit_id, accession_id, accession_name, values) per obs_unit
+        with the values in the order of get_columns and missing values replaced
+        """
+        _, order = self.get_columns(column)
+        obs_unit_ids = self.obs_unit_ids.tolist()
+        accession_ids = self.accession_ids.tolist()
+        for i in range(len(obs_unit_ids)):
+            row = self.values[i, order]
+            yield (obs_unit_ids[i], accession_ids[i], self.accession_names[i],
+                   [missing if value != value else value for value in row.tolist()])
+
+    def to_records(self, column='phenotype_name'):
+        """
+        Returns a list of dictionaries (one per obs_unit) keyed by the column labels
+        """
+        labels, _ = self.get_columns(column)
+        records = []
+        for obs_unit_id, accession_id, accession_name, values in self.iter_rows(column):
+            record = dict(zip(labels, values))
+            record.update({'obs_unit_id': obs_unit_id, 'accession_id': accession_id,
+                           'accession_name': accession_name})
+            records.append(record)
+        return records
+
+    def to_columns(self, column='phenotype_name'):
+        """
+        Returns the obs_unit meta-information and the values per column label
+        (in the order of get_columns) as lists with None for missing values
+        """
+        labels, order = self.get_columns(column)
+        values = self.values[:, order]
+        columns = OrderedDict()
+        for i, label in enumerate(labels):
+            columns[label] = [None if value != value else value for value in values[:, i].tolist()]
+        return OrderedDict([('obs_unit_id', self.obs_unit_ids.tolist()),
+                            ('accession_id', self.accession_ids.tolist()),
+                            ('accession_name', self.accession_names.tolist()),
+                            ('values', columns)])
+
+
+def get_value_kind(study):
+    """Returns whether the study contains phenotype or rnaseq values"""
+    if study.phenotype_set.count() == 0 and study.rnaseq_set.count() > 0:
+        return 'rnaseq'
+    return 'phenotype'
+
+
+def build_study_matrix(study, kind=None, chunk_size=CHUNK_SIZE, variable_ids=None):
+    """
+    Builds the StudyMatrix for a study straight from the database cursor.
+    If variable_ids is given only the values of these phenotypes or rnaseqs are fetched
+    """
+    if kind is None:
+        kind = get_value_kind(study)
+    value_table, variable_table, variable_column = VALUE_TABLES[kind]
+    variable_model = RNASeq if kind == 'rnaseq' else Phenotype
+
+    obs_units = list(ObservationUnit.objects.filter(study_id=study.id).order_by('id')
+                     .values_list('id', 'accession_id', 'accession__name'))
+    variables = variable_model.objects.filter(study_id=study.id)
+    sql = """
+        SELECT v.obs_unit_id, v.%s, v.value
+        FROM %s as v
+        INNER JOIN %s as p ON p.id = v.%s
+        WHERE p.study_id = %%s""" % (variable_column, value_table, variable_table, variable_column)
+    params = [study.id]
+    if variable_ids is not None:
+        variable_ids = sorted(set(variable_ids))
+        variables = variables.filter(id__in=variable_ids)
+        sql += " AND v.%s IN (%s)" % (variable_column, ', '.join(['%s'] * len(variable_ids)))
+        params.extend(variable_ids)
+    variables = list(variables.order_by('id').values_list('id', 'name'))
+
+    cursor = connection.cursor()
+    cursor.execute(sql, params)
+    try:
+        return matrix_from_cursor(cursor, obs_units, variables, chunk_size)
+    finally:
+        cursor.close()
+
+
+def matrix_from_cursor(cursor, obs_units, variables, chunk_size=CHUNK_SIZE):
+    """
+    Fills a StudyMatrix from a cursor that returns (obs_unit_id, variable_id, value) rows.
+    obs_units are (id, accession_id, accession_name) and variables (id, name) tuples.
+    Rows and columns without any values are dropped
+    """
+    obs_unit_ids = np.array([obs_unit[0] for obs_unit in obs_units], dtype=np.int64)
+    variable_ids = np.array([variable[0] for variable in variables], dtype=np.int64)
+    row_order = np.argsort(obs_unit_ids, kind='mergesort')
+    column_order = np.argsort(variable_ids, kind='mergesort')
+    sorted_rows = obs_unit_ids[row_order]
+    sorted_columns = variable_ids[column_order]
+
+    values = np.empty((len(obs_unit_ids), len(variable_ids)), dtype=np.float64)
+    values.fill(np.nan)
+    row_seen = np.zeros(len(obs_unit_ids), dtype=bool)
+    column_seen = np.zeros(len(variable_ids), dtype=bool)
+    skipped = 0
+    while True:
+        chunk = cursor.fetchmany(chunk_size)
+        if not chunk:
+            break
+        chunk = np.array(chunk, dtype=np.float64)
+        rows = _lookup(sorted_rows, chunk[:, 0])
+        columns = _lookup(sorted_columns, chunk[:, 1])
+        found = (rows >= 0) & (columns >= 0)
+        skipped += len(found) - np.count_nonzero(found)
+        rows = row_order[rows[found]]
+        columns = column_order[columns[found]]
+        values[rows, columns] = chunk[found, 2]
+        row_seen[rows] = True
+        column_seen[columns] = True
+    if skipped > 0:
+        logger.warn('%s values do not belong to the obs_units or variables of the study', skipped)
+
+    rows = np.flatnonzero(row_seen)
+    columns = np.flatnonzero(column_seen)
+    if len(rows) < len(row_seen) or len(columns) < len(column_seen):
+        values = values[np.ix_(rows, columns)]
+    return StudyMatrix([obs_units[i][0] for i in rows],
+                       [obs_units[i][1] for i in rows],
+                       [obs_units[i][2] for i in rows],
+                       [variables[i][0] for i in columns],
+                       [variables[i][1] for i in columns],
+                       values)
+
+
+def _lookup(sorted_ids, ids):
+    """Returns the index of ids in sorted_ids or -1 if not found"""
+    if len(sorted_ids) == 0:
+        return np.zeros(len(ids), dtype=np.int64) - 1
+    ix = np.searchsorted(sorted_ids, ids)
+    ix[ix >= len(sorted_ids)] = 0
+    ix[sorted_ids[ix] != ids] = -1
+    return ix
@@ -0,0 +1,173 @@
+"""
+On-disk cache of built study matrices.
+Entries are stored per study and update_date as NumPy files under
+settings.STUDY_MATRIX_CACHE_DIR and the values are loaded memory-mapped,
+so all worker processes on a host share the same pages:
+
+    <cache dir>/<study_id>/<update_date>-<kind>/values.npy
+                                               /rows.npy
+                                               /columns.npy
+                                               /labels.json
+"""
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from django.conf import settings
+from django.db import transaction
+
+from utils.entry_store import TMP_PREFIX, EntryStore
+from utils.isatab_cache import remove_archives
+from utils.matrix import StudyMatrix, build_study_matrix, get_value_kind
+from utils.rnaseq_store import get_rnaseq_matrix, remove_rnaseq_matrix
+
+logger = logging.getLogger(__name__)
+
+# study ids of phenotypes and rnaseqs kept per worker process
+MAX_CACHED_STUDY_IDS = 100000
+
+_VARIABLE_STUDY_IDS = {}
+
+STORE = EntryStore('STUDY_MATRIX_CACHE_DIR', 'matrix')
+
+
+def get_study_matrix(study, kind=None):
+    """
+    Returns the StudyMatrix of a study from the cache and builds
+    and stores it if it is not cached yet
+    """
+    if kind is None:
+        kind = get_value_kind(study)
+    if kind == 'rnaseq':
+        # RNASeq studies are read from their stored matrix if the storage is enabled
+        matrix = get_rnaseq_matrix(study)
+        if matrix is not None:
+            return matrix.to_study_matrix()
+    entry_dir = STORE.get_path(study, '-%s' % kind)
+    if entry_dir is None:
+        return build_study_matrix(study, kind)
+    matrix = _load_entry(entry_dir)
+    if matrix is not None:
+        return matrix
+    with STORE.lock(study.id):
+        matrix = _load_entry(entry_dir)
+        if matrix is not None:
+            return matrix
+        matrix = build_study_matrix(study, kind)
+        STORE.store_dir(entry_dir, lambda tmp_dir: _write_entry(tmp_dir, matrix))
+    _evict(STORE.root, getattr(settings, 'STUDY_MATRIX_CACHE_MAX_BYTES', 0))
+    return matrix
+
+
+def invalidate_study(study_id):
+    """Removes all cached and stored RNASeq matrices and the cached ISA-TAB archives of a study"""
+    remove_rnaseq_matrix(study_id)
+    remove_archives(study_id)
+    STORE.remove(study_id)
+
+
+class _Invalidation(object):
+    """on_commit callback that invalidates the cached matrices of a study"""
+
+    def __init__(self, study_id):
+        self.study_id = study_id
+
+    def __call__(self):
+        invalidate_study(self.study_id)
+
+
+def schedule_invalidation(study_id):
+    """
+    Invalidates the cached matrices of a study now and again when the current
+    transaction commits, so that a matrix built from the old data in the meantime
+    does not survive. The callback is registered only once per study and transaction
+    """
+    invalidate_study(study_id)
+    conn = transaction.get_connection()
+    if not conn.in_atomic_block:
+        return
+    for _, func in conn.run_on_commit:
+        if isinstance(func, _Invalidation) and func.study_id == study_id:
+            return
+    transaction.on_commit(_Invalidation(study_id))
+
+
+def schedule_variable_invalidation(model, variable_id):
+    """
+    Invalidates the cached matrices of the study of a phenotype or rnaseq (see schedule_invalidation)
+    when one of its values is saved or deleted and returns the id of the study (None if the value is
+    deleted together with its variable). The study of a phenotype or rnaseq never changes,
+    so it is looked up once per worker process and not per value
+    """
+    key = (model.__name__, variable_id)
+    study_id = _VARIABLE_STUDY_IDS.get(key)
+    if study_id is None:
+        study_ids = list(model.objects.filter(pk=variable_id).values_list('study_id', flat=True))
+        if not study_ids:
+            # the value is deleted together with its phenotype or rnaseq
+            return None
+        if len(_VARIABLE_STUDY_IDS) >= MAX_CACHED_STUDY_IDS:
+            _VARIABLE_STUDY_IDS.clear()
+        study_id = _VARIABLE_STUDY_IDS[key] = study_ids[0]
+    schedule_invalidation(study_id)
+    return study_id
+
+
+def _load_entry(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, 'labels.json')) as fhandle:
+            labels = json.load(fhandle)
+        rows = np.load(os.path.join(entry_dir, 'rows.npy'))
+        columns = np.load(os.path.join(entry_dir, 'columns.npy'))
+        values = np.load(os.path.join(entry_dir, 'values.npy'), mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        # the mtime of the entry is used as the last access time for the LRU eviction
+        os.utime(entry_dir, None)
+    except OSError:
+        pass
+    return StudyMatrix(rows[:, 0], rows[:, 1], labels['accession_names'],
+                       columns, labels['phenotype_names'], values)
+
+
+def _write_entry(entry_dir, matrix):
+    np.save(os.path.join(entry_dir, 'values.npy'), matrix.values)
+    np.save(os.path.join(entry_dir, 'rows.npy'),
+            np.column_stack((matrix.obs_unit_ids, matrix.accession_ids)).reshape(-1, 2))
+    np.save(os.path.join(entry_dir, 'columns.npy'), matrix.phenotype_ids)
+    with open(os.path.join(entry_dir, 'labels.json'), 'w') as fhandle:
+        json.dump({'accession_names': matrix.accession_names.tolist(),
+                   'phenotype_names': matrix.phenotype_names.tolist()}, fhandle)
+
+
+def _evict(cache_dir, max_bytes):
+    """Removes the least recently used entries until the cache fits into max_bytes"""
+    if not max_bytes:
+        return
+    entries = []
+    total = 0
+    for study_dir in os.listdir(cache_dir):
+        study_path = os.path.join(cache_dir, study_dir)
+        if not os.path.isdir(study_path):
+            continue
+        for entry in os.listdir(study_path):
+            entry_path = os.path.join(study_path, entry)
+            if entry.startswith(TMP_PREFIX):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry_path, filename))
+                           for filename in os.listdir(entry_path))
+                entries.append((os.path.getmtime(entry_path), size, entry_path))
+            except OSError:
+                continue
+            total += size
+    for _, size, entry_path in sorted(entries):
+        if total <= max_bytes:
+            break
+        # processes that still have the values mapped keep reading the unlinked file
+        shutil.rmtree(entry_path, ignore_errors=True)
+        total -= size
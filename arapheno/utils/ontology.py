@@ -0,0 +1,258 @@
+"""
+Closure table and tree of the ontology term hierarchies. Every term is stored with all its
+descendants, so that the phenotypes annotated with a term or any of its descendants
+can be retrieved with a single join. The tree nodes store the child counts, the path to
+the root and the jsTree data of the children, so that the ontology browser does not walk the hierarchy.
+When a study is published or deleted only the phenotype counts of the terms of its phenotypes are updated
+"""
+import json
+import logging
+from collections import Counter, defaultdict, deque
+
+from django.db import transaction
+from django.db.models import Count
+from phenotypedb.models import OntologyTerm, OntologyTermClosure, OntologyTreeNode, Phenotype
+
+logger = logging.getLogger(__name__)
+
+# foreign keys of the phenotypes to the ontology terms
+PHENOTYPE_TERM_FIELDS = ('to_term_id', 'eo_term_id', 'uo_term_id')
+
+
+def compute_closure(term_ids, edges):
+    """
+    Returns the (ancestor, descendant, depth) triples of the terms and the (parent, child) edges
+    with the length of the shortest path between them. Every term is its own descendant with depth 0
+    """
+    children = defaultdict(list)
+    for parent, child in edges:
+        children[parent].append(child)
+    closure = []
+    for term_id in term_ids:
+        depths = {term_id: 0}
+        queue = deque([term_id])
+        while queue:
+            current = queue.popleft()
+            for child in children[current]:
+                # terms that were already visited are skipped, so cycles do not loop forever
+                if child not in depths:
+                    depths[child] = depths[current] + 1
+                    queue.append(child)
+        closure.extend((term_id, descendant, depth) for descendant, depth in depths.items())
+    return closure
+
+
+def compute_tree(terms, edges, closure, phenotype_counts):
+    """
+    Returns the fields of the tree node of every term by id. terms are (id, name) pairs, closure
+    the (ancestor, descendant, depth) triples and phenotype_counts the number of phenotypes by term id
+    """
+    names = dict(terms)
+    children = defaultdict(list)
+    parents = defaultdict(list)
+    for parent, child in edges:
+        children[parent].append(child)
+        parents[child].append(parent)
+    descendant_counts = Counter()
+    for ancestor, descendant, _ in closure:
+        descendant_counts[ancestor] += phenotype_counts.get(descendant, 0)
+    nodes = {}
+    for term_id, _ in terms:
+        # the path follows the first parent of every term like the ontology browser
+        path = []
+        current = term_id
+        while parents[current] and min(parents[current]) not in path and min(parents[current]) != term_id:
+            current = min(parents[current])
+            path.append(current)
+        path.reverse()
+        nodes[term_id] = {'is_root': not parents[term_id],
+                          'child_count': len(children[term_id]),
+                          'phenotype_count': descendant_counts[term_id],
+                          'root_path': json.dumps(path),
+                          'children': json.dumps([tree_fragment(child, names[child], len(children[child]),
+                                                                descendant_counts[child])
+                                                  for child in sorted(children[term_id])])}
+    return nodes
+
+
+def tree_fragment(term_id, name, child_count, phenotype_count):
+    """Returns the jsTree data of a term whose children are loaded on demand"""
+    return {'id': term_id, 'text': name, 'children': child_count > 0,
+            'data': {'phenotype_count': phenotype_count}}
+
+
+def build_closure():
+    """Rebuilds the closure table and the tree of all ontology terms and returns the number of pairs"""
+    term_ids = list(OntologyTerm.objects.values_list('pk', flat=True))
+    closure = compute_closure(term_ids, _get_edges())
+    with transaction.atomic():
+        OntologyTermClosure.objects.all().delete()
+        OntologyTermClosure.objects.bulk_create(
+            OntologyTermClosure(ancestor_id=ancestor, descendant_id=descendant, depth=depth)
+            for ancestor, descendant, depth in closure)
+        build_tree(closure)
+    logger.debug('Built ontology closure of %s terms with %s pairs', len(term_ids), len(closure))
+    return len(closure)
+
+
+def build_tree(closure=None):
+    """Rebuilds the tree nodes of all ontology terms from the stored or the given closure"""
+    if closure is None:
+        closure = OntologyTermClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth')
+    phenotype_counts = Counter()
+    for term_ids in Phenotype.objects.published().values_list(*PHENOTYPE_TERM_FIELDS).iterator():
+        phenotype_counts.update(term_id for term_id in term_ids if term_id)
+    nodes = compute_tree(list(OntologyTerm.objects.values_list('pk', 'name')), _get_edges(),
+                         closure, phenotype_counts)
+    with transaction.atomic():
+        OntologyTreeNode.objects.all().delete()
+        OntologyTreeNode.objects.bulk_create(OntologyTreeNode(term_id=term_id, **fields)
+                                             for term_id, fields in nodes.items())
+    return len(nodes)
+
+
+def update_phenotype_counts(term_ids):
+    """
+    Recounts the published phenotypes of the terms and their ancestors and updates the stored
+    children of their parents, e.g. after a study is published or deleted. Returns the number of changed nodes
+    """
+    ancestor_ids = set(OntologyTermClosure.objects.filter(descendant_id__in=list(term_ids))
+                       .values_list('ancestor_id', flat=True))
+    if not ancestor_ids:
+        return 0
+    phenotypes = Phenotype.objects.published().order_by()
+    counts = Counter()
+    for field in PHENOTYPE_TERM_FIELDS:
+        # e.g. to_term__ancestor_links__ancestor_id
+        lookup = field.replace('_id', '__ancestor_links__ancestor_id')
+        counts.update(dict(phenotypes.filter(**{'%s__in' % lookup: ancestor_ids})
+                           .values_list(lookup).annotate(Count('id'))))
+    changed = [term_id for term_id, count in OntologyTreeNode.objects.filter(pk__in=ancestor_ids)
+               .values_list('pk', 'phenotype_count') if counts[term_id] != count]
+    with transaction.atomic():
+        for term_id in changed:
+            OntologyTreeNode.objects.filter(pk=term_id).update(phenotype_count=counts[term_id])
+        _update_children(_get_parents(changed))
+    return len(changed)
+
+
+def update_term(term_id):
+    """Updates the stored children of the parents of a term after it was renamed"""
+    _update_children(_get_parents([term_id]))
+
+
+def get_roots(source):
+    """Returns the jsTree data of the root terms of an ontology source"""
+    nodes = OntologyTreeNode.objects.filter(term__source=source, is_root=True).select_related('term')
+    return [_node_fragment(node) for node in nodes.order_by('term_id')]
+
+
+def get_children(term_id):
+    """Returns the stored jsTree data of the children of a term"""
+    return json.loads(OntologyTreeNode.objects.values_list('children', flat=True).get(pk=term_id))
+
+
+def get_tree_to_root(term_id, source):
+    """
+    Returns the jsTree data of the root terms of an ontology source with the
+    path from the root to the selected term and the siblings on the path opened
+    """
+    node = OntologyTreeNode.objects.select_related('term').get(pk=term_id)
+    path = json.loads(node.root_path)
+    ancestors = OntologyTreeNode.objects.select_related('term').in_bulk(path)
+    term_obj = _node_fragment(node)
+    term_obj['state'] = {'selected': True}
+    for ancestor_id in reversed(path):
+        ancestor = ancestors[ancestor_id]
+        children = [term_obj if child['id'] == term_obj['id'] else child
+                    for child in json.loads(ancestor.children)]
+        term_obj = _node_fragment(ancestor)
+        term_obj.update({'children': children, 'state': {'opened': True}})
+    return [term_obj if root['id'] == term_obj['id'] else root for root in get_roots(source)]
+
+
+class _Rebuild(object):
+    """
+    Callback that rebuilds the closure table and the tree or only updates the
+    phenotype counts of the terms of some studies when the transaction commits
+    """
+
+    def __init__(self, closure=False, study_ids=(), term_ids=()):
+        self.closure = closure
+        self.study_ids = set(study_ids)
+        self.term_ids = set(term_ids)
+
+    def merge(self, other):
+        self.closure = self.closure or other.closure
+        self.study_ids.update(other.study_ids)
+        self.term_ids.update(other.term_ids)
+
+    def __call__(self):
+        if self.closure:
+            build_closure()
+        else:
+            update_phenotype_counts(self.term_ids | get_study_term_ids(self.study_ids))
+
+
+def schedule_rebuild():
+    """
+    Rebuilds the closure table and the tree now or, inside a transaction, once
+    when it commits, so that loading an ontology fixture rebuilds them only once
+    """
+    _schedule(_Rebuild(closure=True))
+
+
+def schedule_count_update(study_ids=(), term_ids=()):
+    """
+    Updates the phenotype counts of the terms of the phenotypes of the studies and of the
+    given terms now or, inside a transaction, when it commits
+    """
+    _schedule(_Rebuild(study_ids=study_ids, term_ids=term_ids))
+
+
+def get_study_term_ids(study_ids):
+    """Returns the ids of the terms of the phenotypes of the studies"""
+    term_ids = set()
+    if study_ids:
+        for row in Phenotype.objects.filter(study_id__in=list(study_ids)).values_list(*PHENOTYPE_TERM_FIELDS).distinct():
+            term_ids.update(term_id for term_id in row if term_id)
+    return term_ids
+
+
+def _schedule(rebuild):
+    conn = transaction.get_connection()
+    if not conn.in_atomic_block:
+        rebuild()
+        return
+    for _, func in conn.run_on_commit:
+        if isinstance(func, _Rebuild):
+            func.merge(rebuild)
+            return
+    transaction.on_commit(rebuild)
+
+
+def _get_parents(term_ids):
+    return set(OntologyTerm.children.through.objects.filter(to_ontologyterm_id__in=list(term_ids))
+               .values_list('from_ontologyterm_id', flat=True))
+
+
+def _update_children(parent_ids):
+    """Renders the stored jsTree data of the children of the parents from the tree nodes of the children"""
+    children = defaultdict(list)
+    for parent, child in OntologyTerm.children.through.objects.filter(from_ontologyterm_id__in=list(parent_ids)) \
+            .values_list('from_ontologyterm_id', 'to_ontologyterm_id'):
+        children[parent].append(child)
+    child_ids = [child for parent_children in children.values() for child in parent_children]
+    nodes = dict((node[0], node) for node in OntologyTreeNode.objects.filter(pk__in=child_ids)
+                 .values_list('term_id', 'term__name', 'child_count', 'phenotype_count'))
+    for parent_id in parent_ids:
+        data = [tree_fragment(*nodes[child]) for child in sorted(children[parent_id]) if child in nodes]
+        OntologyTreeNode.objects.filter(pk=parent_id).update(children=json.dumps(data))
+
+
+def _get_edges():
+    return list(OntologyTerm.children.through.objects.values_list('from_ontologyterm_id', 'to_ontologyterm_id'))
+
+
+def _node_fragment(node):
+    return tree_fragment(node.term_id, node.term.name, node.child_count, node.phenotype_count)
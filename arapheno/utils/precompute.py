@@ -0,0 +1,225 @@
+"""
+Per phenotype and RNASeq results that are computed once when a study is
+imported or published and stored in the database. The matrix of the
+RNASeq values is stored at the same time (see utils.rnaseq_store)
+"""
+import json
+import logging
+import math
+import multiprocessing
+
+import numpy as np
+
+from django.db import IntegrityError, connections
+from phenotypedb.models import Phenotype, RNASeq, StatisticsResult, TransformationResult
+from utils import statistics
+from utils.rnaseq_store import store_rnaseq_matrix
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 200
+
+
+def calculate_phenotype_transformations(phenotype, trans=None, rnaseq=False):
+    """
+    Calculates transformations for the phenotype
+    """
+    if rnaseq:
+        value_set = phenotype.rnaseqvalue_set
+    else:
+        value_set = phenotype.phenotypevalue_set
+    rows = list(value_set.order_by('id').values_list('obs_unit__accession_id', 'obs_unit__accession__name',
+                                                    'id', 'value'))
+    accessions = [(accession_id, accession_name) for accession_id, accession_name, _, _ in rows]
+    labels = ["%s(%s)" % (accession_name, value_id) for _, accession_name, value_id, _ in rows]
+    values = [value for _, _, _, value in rows]
+    data = {'accessions': accessions}
+    transformations = {}
+    supported = [transformation for transformation in statistics.SUPPORTED_TRANSFORMATIONS
+                 if not trans or trans == transformation]
+    for transformation, transformed_values in statistics.transform_all(values, supported).items():
+        if transformed_values is not None:
+            if not np.any(np.iscomplex(transformed_values)):
+                sp_pval = statistics.calculate_sp_pval(transformed_values.tolist())
+                transformations[transformation] = {'values': zip(labels, transformed_values.tolist()), 'sp_pval': sp_pval}
+                if sp_pval < 1 and sp_pval > 0:
+                    transformations[transformation]['sp_score'] = -math.log10(sp_pval)
+            else:
+                transformations[transformation] = {'values': [], 'sp_pval':"not supported" }
+    data['transformations'] = transformations
+    return data
+
+
+def get_transformations(phenotype, trans=None, rnaseq=False):
+    """
+    Returns the stored transformations of a phenotype or RNASeq.
+    They are calculated and stored if they are missing or outdated
+    """
+    try:
+        result = TransformationResult.objects.get(**_variable_filter(phenotype, rnaseq))
+        if result.study_update_date != phenotype.study.update_date:
+            result = None
+    except TransformationResult.DoesNotExist:
+        result = None
+    if result is None:
+        data = store_transformations(phenotype, rnaseq)
+    else:
+        data = json.loads(result.data)
+    if trans:
+        transformations = data['transformations']
+        data['transformations'] = {trans: transformations[trans]} if trans in transformations else {}
+    return data
+
+
+def store_transformations(phenotype, rnaseq=False):
+    """
+    Calculates and stores the transformations of a phenotype or RNASeq
+    """
+    data = json.dumps(calculate_phenotype_transformations(phenotype, rnaseq=rnaseq))
+    try:
+        TransformationResult.objects.update_or_create(
+            defaults={'study_update_date': phenotype.study.update_date, 'data': data},
+            **_variable_filter(phenotype, rnaseq))
+    except IntegrityError:
+        # another process stored the result in the meantime
+        logger.debug('Transformations of %s already stored', phenotype)
+    return json.loads(data)
+
+
+def get_statistics(phenotype, rnaseq=False):
+    """
+    Returns the stored StatisticsResult of a phenotype or RNASeq. The results are stored when
+    a study is imported, published or precomputed. If it is missing or outdated it is calculated
+    without storing it, so that reading the statistics never writes to the database
+    """
+    try:
+        result = StatisticsResult.objects.get(**_variable_filter(phenotype, rnaseq))
+        if result.study_update_date == phenotype.study.update_date:
+            return result
+    except StatisticsResult.DoesNotExist:
+        pass
+    defaults, shapiro = calculate_statistics(phenotype, rnaseq)
+    for field, value in shapiro.items():
+        setattr(phenotype, field, value)
+    return StatisticsResult(**dict(defaults, **_variable_filter(phenotype, rnaseq)))
+
+
+def calculate_statistics(phenotype, rnaseq=False):
+    """
+    Calculates the distribution statistics of a phenotype or RNASeq and returns
+    the fields of its StatisticsResult and of the Shapiro-Wilk test
+    """
+    if rnaseq:
+        value_set = phenotype.rnaseqvalue_set
+    else:
+        value_set = phenotype.phenotypevalue_set
+    data = statistics.describe(list(value_set.values_list('value', flat=True)))
+    shapiro = {'shapiro_test_statistic': data['shapiro_test_statistic'],
+               'shapiro_p_value': data['shapiro_p_value']}
+    quantiles = data['quantiles'] or [None] * 5
+    defaults = {'study_update_date': phenotype.study.update_date,
+                'count': data['count'], 'mean': data['mean'], 'variance': data['variance'],
+                'minimum': quantiles[0], 'first_quartile': quantiles[1], 'median': quantiles[2],
+                'third_quartile': quantiles[3], 'maximum': quantiles[4],
+                'histogram': json.dumps(data['histogram']),
+                'value_counts': json.dumps(data['value_counts']) if data['value_counts'] is not None else None}
+    return defaults, shapiro
+
+
+def store_statistics(phenotype, rnaseq=False):
+    """
+    Calculates and stores the distribution statistics and the
+    Shapiro-Wilk test of a phenotype or RNASeq
+    """
+    defaults, shapiro = calculate_statistics(phenotype, rnaseq)
+    # update() does not change the update_date or send the post_save signal
+    type(phenotype).objects.filter(pk=phenotype.pk).update(**shapiro)
+    for field, value in shapiro.items():
+        setattr(phenotype, field, value)
+    try:
+        result, _ = StatisticsResult.objects.update_or_create(defaults=defaults,
+                                                              **_variable_filter(phenotype, rnaseq))
+    except IntegrityError:
+        # another process stored the result in the meantime
+        logger.debug('Statistics of %s already stored', phenotype)
+        result = StatisticsResult.objects.get(**_variable_filter(phenotype, rnaseq))
+    return result
+
+
+# the stored results and the functions that calculate them
+STAGES = ((TransformationResult, store_transformations),
+          (StatisticsResult, store_statistics))
+
+
+def precompute_study(study, force=False):
+    """
+    Calculates and stores the results of all phenotypes or RNASeqs of a study
+    that are not stored yet and the RNASeq matrix. Returns the number of calculated results
+    """
+    if study.rnaseq_set.exists():
+        store_rnaseq_matrix(study)
+    count = 0
+    for rnaseq, ids in ((False, study.phenotype_set.values_list('id', flat=True)),
+                        (True, study.rnaseq_set.values_list('id', flat=True))):
+        count += precompute(list(ids), rnaseq, force)
+    return count
+
+
+def precompute(ids, rnaseq=False, force=False):
+    """
+    Calculates and stores the results of the phenotypes or RNASeqs with the ids.
+    Returns the number of calculated results
+    """
+    model = RNASeq if rnaseq else Phenotype
+    variables = list(model.objects.filter(pk__in=ids).select_related('study'))
+    count = 0
+    for result_model, store in STAGES:
+        stored = set()
+        if not force:
+            stored = set(result_model.objects.filter(**_variable_filter(ids, rnaseq, '_id__in'))
+                         .values_list('rnaseq_id' if rnaseq else 'phenotype_id', 'study_update_date'))
+        for variable in variables:
+            if (variable.id, variable.study.update_date) in stored:
+                continue
+            store(variable, rnaseq)
+            count += 1
+    return count
+
+
+def precompute_parallel(studies, processes=None, force=False):
+    """
+    Calculates and stores the results of the studies in chunks of phenotypes or
+    RNASeqs with a pool of processes. Returns the number of calculated results
+    """
+    tasks = []
+    for study in studies:
+        if study.rnaseq_set.exists():
+            store_rnaseq_matrix(study)
+        for rnaseq, ids in ((False, study.phenotype_set.order_by('id').values_list('id', flat=True)),
+                            (True, study.rnaseq_set.order_by('id').values_list('id', flat=True))):
+            ids = list(ids)
+            for start in range(0, len(ids), CHUNK_SIZE):
+                tasks.append((ids[start:start + CHUNK_SIZE], rnaseq, force))
+    # the forked processes must not share the database connection of the parent
+    connections.close_all()
+    pool = multiprocessing.Pool(processes)
+    try:
+        return sum(pool.imap_unordered(_precompute_task, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _precompute_task(task):
+    ids, rnaseq, force = task
+    try:
+        return precompute(ids, rnaseq, force)
+    except Exception as err:
+        # database exceptions can not be pickled and sent to the parent process
+        raise Exception('%s: %s' % (type(err).__name__, str(err)))
+    finally:
+        connections.close_all()
+
+
+def _variable_filter(variable, rnaseq, lookup=''):
+    return {('rnaseq' if rnaseq else 'phenotype') + lookup: variable}
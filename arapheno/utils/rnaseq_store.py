@@ -0,0 +1,216 @@
+"""
+Columnar storage of the RNASeq values of a study.
+The values are stored per study and update_date as a dense float64 rnaseq x obs_unit
+matrix under settings.RNASEQ_MATRIX_DIR together with the index arrays and loaded
+memory-mapped, so that the values of a gene or of the whole study are read as slices:
+
+    <matrix dir>/<study_id>/<update_date>/values.npy
+                                          /rnaseqs.npy
+                                          /obs_units.npy
+                                          /labels.json
+                                          /standardized.npy (computed on first use)
+
+The matrix is a derived cache: the RNASeqValue rows stay the source of the data.
+It is built when a study is imported or precomputed (see utils.precompute.precompute_study)
+and removed when the study changes. Requests never build it, they query the RNASeqValue
+rows while it is missing. The values are stored in double precision,
+so that the value endpoints return the database values unchanged
+"""
+import json
+import logging
+import os
+
+import numpy as np
+
+from phenotypedb.models import ObservationUnit
+from utils.entry_store import EntryStore
+from utils.matrix import StudyMatrix, build_study_matrix
+
+logger = logging.getLogger(__name__)
+
+# rnaseqs that are standardized together
+STANDARDIZE_BLOCK_SIZE = 2000
+
+STORE = EntryStore('RNASEQ_MATRIX_DIR', 'RNASeq matrix')
+
+
+class RNASeqMatrix(object):
+    """
+    Values of an RNASeq study as a dense float64 matrix (rnaseqs x obs_units)
+    with the rnaseq and obs_unit index arrays. Missing values are stored as NaN
+    """
+
+    def __init__(self, rnaseq_ids, rnaseq_names, obs_unit_ids, accession_ids, accession_names, values):
+        self.rnaseq_ids = np.asarray(rnaseq_ids, dtype=np.int64)
+        self.rnaseq_names = np.asarray(rnaseq_names, dtype=object)
+        self.obs_unit_ids = np.asarray(obs_unit_ids, dtype=np.int64)
+        self.accession_ids = np.asarray(accession_ids, dtype=np.int64)
+        self.accession_names = np.asarray(accession_names, dtype=object)
+        self.values = values
+
+    def get_row(self, rnaseq_id):
+        """Returns the values of a rnaseq per obs_unit or None if it has no values"""
+        # the rnaseqs are ordered by id
+        ix = np.searchsorted(self.rnaseq_ids, rnaseq_id)
+        if ix >= len(self.rnaseq_ids) or self.rnaseq_ids[ix] != rnaseq_id:
+            return None
+        return self.values[ix]
+
+    def select(self, rnaseq_ids):
+        """
+        Returns the values of the rnaseqs as an obs_unit x rnaseq StudyMatrix.
+        Like in build_study_matrix the obs_units and rnaseqs without values are dropped
+        """
+        ix = np.flatnonzero(np.in1d(self.rnaseq_ids, np.asarray(rnaseq_ids, dtype=np.int64)))
+        # one fancy-indexed read of the selected rows of the memory-mapped matrix
+        values = self.values[ix]
+        present = ~np.isnan(values)
+        rows = np.flatnonzero(present.any(axis=1))
+        columns = np.flatnonzero(present.any(axis=0))
+        values = values[np.ix_(rows, columns)]
+        rows = ix[rows]
+        return StudyMatrix(self.obs_unit_ids[columns], self.accession_ids[columns], self.accession_names[columns],
+                           self.rnaseq_ids[rows], self.rnaseq_names[rows], values.T)
+
+    def to_study_matrix(self):
+        """Returns the values as an obs_unit x rnaseq StudyMatrix without copying them"""
+        return StudyMatrix(self.obs_unit_ids, self.accession_ids, self.accession_names,
+                           self.rnaseq_ids, self.rnaseq_names, self.values.T)
+
+
+def get_rnaseq_matrix(study):
+    """
+    Returns the stored RNASeqMatrix of a study or None if it is not stored
+    (yet or since the study changed) or the storage is disabled
+    """
+    entry_dir = STORE.get_path(study)
+    if entry_dir is None:
+        return None
+    return _load_entry(entry_dir)
+
+
+def store_rnaseq_matrix(study):
+    """
+    Builds the RNASeqMatrix of a study from the RNASeqValues and stores it if it is
+    not stored yet. Returns None if the storage is disabled
+    """
+    entry_dir = STORE.get_path(study)
+    if entry_dir is None:
+        return None
+    with STORE.lock(study.id):
+        matrix = _load_entry(entry_dir)
+        if matrix is None:
+            # the entries of earlier update_dates or of an earlier format are replaced
+            STORE.remove(study.id)
+            matrix = _build_matrix(study)
+            STORE.store_dir(entry_dir, lambda tmp_dir: _write_entry(tmp_dir, matrix))
+    return matrix
+
+
+def remove_rnaseq_matrix(study_id):
+    """Removes the stored matrices of a study"""
+    STORE.remove(study_id)
+
+
+def get_standardized_values(study):
+    """
+    Returns the standardized values (see standardize) of the stored matrix of a study
+    and computes and stores them on first use. Returns None if the matrix is not stored
+    """
+    matrix = get_rnaseq_matrix(study)
+    if matrix is None:
+        return None
+    path = os.path.join(STORE.get_path(study), 'standardized.npy')
+    try:
+        return np.load(path, mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        pass
+    values = standardize(matrix.values)
+    tmp_file = STORE.open_tmp_file(path, '.npy')
+    if tmp_file is not None:
+        with tmp_file:
+            np.save(tmp_file, values)
+        STORE.move_into_place(tmp_file.name, path)
+    return values
+
+
+def standardize(values, block_size=STANDARDIZE_BLOCK_SIZE):
+    """
+    Returns the rows of a rnaseq x obs_unit matrix centered and scaled to unit length as float32,
+    so that the dot product of two rows is their Pearson correlation. Missing values are
+    replaced by the mean of the row and rows without variance are zero
+    """
+    standardized = np.empty(values.shape, dtype=np.float32)
+    for start in range(0, len(values), block_size):
+        block = np.array(values[start:start + block_size], dtype=np.float64)
+        present = ~np.isnan(block)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            block -= np.where(present, block, 0).sum(axis=1)[:, np.newaxis] / present.sum(axis=1)[:, np.newaxis]
+            block[~present] = 0
+            block /= np.sqrt((block ** 2).sum(axis=1))[:, np.newaxis]
+        block[~np.isfinite(block)] = 0
+        standardized[start:start + block_size] = block
+    return standardized
+
+
+def get_gene_matrix(study, rnaseq_ids):
+    """
+    Returns the values of the rnaseqs of a study as an obs_unit x rnaseq StudyMatrix
+    from the stored matrix or with one query of their values if it is not stored
+    """
+    matrix = get_rnaseq_matrix(study)
+    if matrix is None:
+        return build_study_matrix(study, 'rnaseq', variable_ids=rnaseq_ids)
+    return matrix.select(rnaseq_ids)
+
+
+def get_value_rows(rnaseq):
+    """
+    Returns the flat value rows of a rnaseq in the order of the PhenotypeValueRenderer
+    header from the stored matrix or None if it is not stored
+    """
+    matrix = get_rnaseq_matrix(rnaseq.study)
+    if matrix is None:
+        return None
+    values = matrix.get_row(rnaseq.id)
+    if values is None:
+        return []
+    present = np.flatnonzero(~np.isnan(values))
+    accessions = dict((row[0], row[1:]) for row in ObservationUnit.objects.filter(study_id=rnaseq.study_id).values_list(
+        'id', 'accession_id', 'accession__name', 'accession__cs_number',
+        'accession__longitude', 'accession__latitude', 'accession__country'))
+    return [(rnaseq.name,) + accessions[obs_unit_id] + (value, obs_unit_id)
+            for obs_unit_id, value in zip(matrix.obs_unit_ids[present].tolist(), values[present].tolist())]
+
+
+def _build_matrix(study):
+    matrix = build_study_matrix(study, 'rnaseq')
+    return RNASeqMatrix(matrix.phenotype_ids, matrix.phenotype_names, matrix.obs_unit_ids,
+                        matrix.accession_ids, matrix.accession_names,
+                        np.ascontiguousarray(matrix.values.T, dtype=np.float64))
+
+
+def _load_entry(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, 'labels.json')) as fhandle:
+            labels = json.load(fhandle)
+        rnaseqs = np.load(os.path.join(entry_dir, 'rnaseqs.npy'))
+        obs_units = np.load(os.path.join(entry_dir, 'obs_units.npy'))
+        values = np.load(os.path.join(entry_dir, 'values.npy'), mmap_mode='r')
+    except (IOError, OSError, ValueError):
+        return None
+    if values.dtype != np.float64:
+        # stored in single precision by an earlier version
+        return None
+    return RNASeqMatrix(rnaseqs, labels['rnaseq_names'], obs_units[:, 0], obs_units[:, 1],
+                        labels['accession_names'], values)
+
+
+def _write_entry(entry_dir, matrix):
+    np.save(os.path.join(entry_dir, 'values.npy'), matrix.values)
+    np.save(os.path.join(entry_dir, 'rnaseqs.npy'), matrix.rnaseq_ids)
+    np.save(os.path.join(entry_dir, 'obs_units.npy'),
+            np.column_stack((matrix.obs_unit_ids, matrix.accession_ids)).reshape(-1, 2))
+    with open(os.path.join(entry_dir, 'labels.json'), 'w') as fhandle:
+        json.dump({'rnaseq_names': matrix.rnaseq_names.tolist(),
+                   'accession_names': matrix.accession_names.tolist()}, fhandle)
@@ -0,0 +1,284 @@
+"""
+Search index over the published phenotypes and studies, the accessions and the ontology terms.
+The entries are stored in the SearchEntry table, which is built by migration 0030 and the
+build_search_index command (after loading the accession or ontology fixtures) and kept up
+to date by the signals of the indexed models. On PostgreSQL the entries are matched with
+a trigram index and ranked, counted and paged in the database, on other databases every
+worker process keeps an inverted trigram index in memory that is reloaded when the
+DataVersion changes. Matches are ranked by exact name, name prefix, word prefix and name length
+"""
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+from django.db import connection, transaction
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+from django.db.models.functions import Length
+from phenotypedb.models import (Accession, DataVersion, OntologyTerm, Phenotype,
+                                SearchEntry, Study)
+
+logger = logging.getLogger(__name__)
+
+VERSION_NAME = 'search'
+
+ENTITIES = ('phenotype', 'study', 'accession', 'ontology')
+
+MAX_PAGE_SIZE = 1000
+
+# rank of a match from best to worst
+EXACT, PREFIX, WORD_PREFIX, SUBSTRING = range(4)
+
+
+def search(query, entities=ENTITIES):
+    """
+    Returns the ranked primary keys of the matching objects per entity in an OrderedDict.
+    If the query is empty all indexed objects are returned ordered by name.
+    On PostgreSQL the primary keys are DatabaseRankings that only fetch the requested slice
+    """
+    query = _normalize(query)
+    if connection.vendor == 'postgresql':
+        return OrderedDict((entity, DatabaseRanking(entity, query)) for entity in entities)
+    rows = get_index().search(query)
+    ranked = defaultdict(list)
+    for entity, object_id, name, text in rows:
+        ranked[entity].append((_rank(query, name, text), name, object_id))
+    results = OrderedDict()
+    for entity in entities:
+        results[entity] = [_to_pk(entity, object_id) for _, _, object_id in sorted(ranked[entity])]
+    return results
+
+
+class DatabaseRanking(object):
+    """
+    Sequence of the ranked primary keys of the matching entries of an entity
+    that are ranked, counted and sliced in the database (see _rank)
+    """
+
+    def __init__(self, entity, query):
+        self.entity = entity
+        entries = SearchEntry.objects.filter(entity=entity)
+        if query:
+            # the texts are lower case, so a case sensitive LIKE can use the trigram index
+            entries = entries.filter(text__contains=query).annotate(
+                rank=Case(When(name=query, then=Value(EXACT)),
+                          When(name__startswith=query, then=Value(PREFIX)),
+                          When(Q(text__contains=' ' + query) | Q(text__contains='\n' + query), then=Value(WORD_PREFIX)),
+                          default=Value(SUBSTRING), output_field=IntegerField()),
+                name_length=Length('name')).order_by('rank', 'name_length', 'name', 'object_id')
+        else:
+            entries = entries.order_by('name', 'object_id')
+        self.entries = entries
+        self.count = None
+
+    def __len__(self):
+        if self.count is None:
+            self.count = self.entries.count()
+        return self.count
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [_to_pk(self.entity, object_id) for object_id in
+                    self.entries.values_list('object_id', flat=True)[key]]
+        return self[key:key + 1][0]
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+class RankedResults(object):
+    """
+    Sequence of the objects of a ranked list of primary keys that only
+    fetches the objects of the requested slice from the database
+    """
+
+    def __init__(self, queryset, pks):
+        self.queryset = queryset
+        self.pks = pks
+
+    def __len__(self):
+        return len(self.pks)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            pks = self.pks[key]
+            objects = self.queryset.in_bulk(pks)
+            return [objects[pk] for pk in pks if pk in objects]
+        return self[key:key + 1][0]
+
+    def __iter__(self):
+        return iter(self[:])
+
+
+def get_querysets():
+    """Returns the querysets of the searchable objects per entity"""
+    return {'phenotype': Phenotype.objects.published().select_related('to_term', 'study', 'species')
+                         .annotate(num_values=Count('phenotypevalue')),
+            'study': Study.objects.published(),
+            'accession': Accession.objects.all(),
+            'ontology': OntologyTerm.objects.select_related('source')}
+
+
+def rebuild_index():
+    """Rebuilds the whole search index and returns the number of entries"""
+    entries = []
+    for phenotype in Phenotype.objects.published().select_related('to_term'):
+        entries.append(_phenotype_entry(phenotype))
+    for study in Study.objects.published():
+        entries.append(_entry('study', study.pk, study.name))
+    for accession in Accession.objects.all():
+        entries.append(_entry('accession', accession.pk, accession.name))
+    for term in OntologyTerm.objects.all():
+        entries.append(_entry('ontology', term.pk, term.name))
+    with transaction.atomic():
+        SearchEntry.objects.all().delete()
+        SearchEntry.objects.bulk_create(entries)
+        DataVersion.increment(VERSION_NAME)
+        # accessions and ontology terms are loaded from fixtures without signals
+        DataVersion.increment(DataVersion.DATA)
+    return len(entries)
+
+
+def index_study(study):
+    """
+    Adds or updates the entries of a published study, its phenotypes and its accessions
+    or removes the entries of the study and its phenotypes if it is not published
+    """
+    if not Study.objects.published().filter(pk=study.pk).exists():
+        remove_study(study.pk)
+        return
+    entries = [_entry('study', study.pk, study.name)]
+    entries.extend(_phenotype_entry(phenotype) for phenotype in
+                   study.phenotype_set.select_related('to_term'))
+    entries.extend(_entry('accession', accession.pk, accession.name) for accession in
+                   Accession.objects.filter(observationunit__study=study).distinct())
+    _replace_entries(entries)
+
+
+def index_phenotype(phenotype):
+    """Updates the entry of a phenotype if its study is published"""
+    if Phenotype.objects.published().filter(pk=phenotype.pk).exists():
+        _replace_entries([_phenotype_entry(phenotype)])
+
+
+def index_object(entity, pk, name):
+    """Adds or updates the entry of an accession or ontology term"""
+    _replace_entries([_entry(entity, pk, name)])
+
+
+def remove_study(study_id):
+    """Removes the entries of a study and its phenotypes"""
+    phenotype_ids = ['%s' % pk for pk in Phenotype.objects.filter(study_id=study_id).values_list('pk', flat=True)]
+    remove_entries('phenotype', phenotype_ids)
+    remove_entries('study', ['%s' % study_id])
+
+
+def remove_entries(entity, object_ids):
+    """Removes the entries of the objects and increments the version if any was indexed"""
+    if SearchEntry.objects.filter(entity=entity, object_id__in=object_ids).delete()[0]:
+        DataVersion.increment(VERSION_NAME)
+
+
+class InvertedIndex(object):
+    """
+    In-memory inverted index from the trigrams of the entry texts to the entries
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        postings = defaultdict(list)
+        for position, (_, _, _, text) in enumerate(rows):
+            for trigram in _trigrams(text):
+                postings[trigram].append(position)
+        self.postings = dict((trigram, np.array(positions, dtype=np.int64))
+                             for trigram, positions in postings.items())
+
+    def search(self, query):
+        """Returns the rows whose text contains the query"""
+        if not query:
+            return self.rows
+        trigrams = _trigrams(query)
+        if trigrams:
+            if any(trigram not in self.postings for trigram in trigrams):
+                return []
+            lists = sorted((self.postings[trigram] for trigram in trigrams), key=len)
+            candidates = lists[0]
+            for positions in lists[1:]:
+                candidates = np.intersect1d(candidates, positions, assume_unique=True)
+            rows = (self.rows[position] for position in candidates.tolist())
+        else:
+            # queries shorter than a trigram are matched against all texts
+            rows = self.rows
+        # all trigrams of a text can occur without the query being a substring
+        return [row for row in rows if query in row[3]]
+
+
+_INDEX = {'version': None, 'index': None}
+_INDEX_LOCK = threading.Lock()
+
+
+def get_index(version=None):
+    """Returns the in-memory index of the worker and reloads it if the version has changed"""
+    if version is None:
+        version = DataVersion.get_version(VERSION_NAME)
+    with _INDEX_LOCK:
+        if _INDEX['index'] is None or _INDEX['version'] != version:
+            rows = [tuple(row) for row in
+                    SearchEntry.objects.values_list('entity', 'object_id', 'name', 'text').iterator()]
+            _INDEX['index'] = InvertedIndex(rows)
+            _INDEX['version'] = version
+            logger.debug('Loaded search index version %s with %s entries', version, len(rows))
+        return _INDEX['index']
+
+
+def _replace_entries(entries):
+    with transaction.atomic():
+        for entity in ENTITIES:
+            ids = [entry.object_id for entry in entries if entry.entity == entity]
+            if ids:
+                SearchEntry.objects.filter(entity=entity, object_id__in=ids).delete()
+        SearchEntry.objects.bulk_create(entries)
+        DataVersion.increment(VERSION_NAME)
+
+
+def _rank(query, name, text):
+    """Sort key of a match. Without a query the entries are ordered by name only"""
+    if not query:
+        return (EXACT, 0)
+    if name == query:
+        rank = EXACT
+    elif name.startswith(query):
+        rank = PREFIX
+    elif (' ' + query) in text or ('\n' + query) in text:
+        rank = WORD_PREFIX
+    else:
+        rank = SUBSTRING
+    # shorter names are closer matches
+    return (rank, len(name))
+
+
+def _phenotype_entry(phenotype):
+    fields = [phenotype.name]
+    if phenotype.to_term_id:
+        fields.extend([phenotype.to_term_id, phenotype.to_term.name])
+    return _entry('phenotype', phenotype.pk, *fields)
+
+
+def _entry(entity, pk, name, *fields):
+    name = _normalize(name)
+    text = '\n'.join([name] + [_normalize(field) for field in fields])
+    return SearchEntry(entity=entity, object_id='%s' % pk, name=name[:255], text=text)
+
+
+def _normalize(text):
+    return (text or '').strip().lower()
+
+
+def _trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def _to_pk(entity, object_id):
+    # the primary keys of ontology terms are strings
+    return object_id if entity == 'ontology' else int(object_id)
@@ -1,11 +1,22 @@
 import logging
 import scipy as sp
-from scipy import stats
+from scipy import special, stats
 
 logger = logging.getLogger(__name__)
 
 SUPPORTED_TRANSFORMATIONS = ("no","log", "sqrt", "sqr", "arcsin_sqrt", "box_cox","ascombe")
 
+BOX_COX_LAMBDAS = sp.arange(-2.0, 2.1, 0.1)
+
+HISTOGRAM_BINS = 20
+
+# value counts are only stored for phenotypes with few distinct (e.g. categorical) values
+MAX_VALUE_COUNTS = 20
+
+# polynomial coefficients (highest order first) of Royston's approximation of the Shapiro-Wilk weights
+_SW_C1 = [-2.706056, 4.434685, -2.071190, -0.147981, 0.221157, 0.0]
+_SW_C2 = [-3.582633, 5.682633, -1.752461, -0.293762, 0.042981, 0.0]
+
 def transform(values, transformation, standard=True):
     if transformation == 'no':
         return sp.array(values)
@@ -82,33 +93,152 @@ def _box_cox_transform(values, standard=True):
         vals = (a - min(a)) + 0.1 * sp.var(a)
     else:
         vals = a
-    sw_pvals = []
-    lambdas = sp.arange(-2.0, 2.1, 0.1)
-    for l in lambdas:
-        if l == 0:
-            vs = sp.log(vals)
-        else:
-            vs = ((vals ** l) - 1) / l
-        r = stats.shapiro(vs)
-        if sp.isfinite(r[0]):
-            pval = r[1]
-        else:
-            pval = 0.0
-        sw_pvals.append(pval)
-    i = sp.argmax(sw_pvals)
-    l = lambdas[i]
+    return _box_cox(vals)
+
+def _box_cox(vals):
+    """
+    Applies all Box-Cox lambdas in one pass and returns the values transformed with the
+    lambda of the highest Shapiro-Wilk W. The p-value of the test only depends on W for a
+    given number of values, so this is the lambda with the best p-value.
+    """
+    vals = sp.asarray(vals, dtype=float)
+    lambdas = BOX_COX_LAMBDAS[:, None]
+    sorted_vals = sp.sort(vals)
+    with sp.errstate(all='ignore'):
+        transformed = ((sorted_vals ** lambdas) - 1) / lambdas
+        # Box-Cox preserves the order of positive values
+        if sorted_vals[0] <= 0:
+            transformed = sp.sort(transformed, axis=1)
+        w = _shapiro_w(transformed)
+    w[~sp.isfinite(w)] = -sp.inf
+    l = BOX_COX_LAMBDAS[sp.argmax(w)]
     if l == 0:
         vs = sp.log(vals)
     else:
         vs = ((vals ** l) - 1) / l
     return vs
 
+def _shapiro_w(sorted_values):
+    """
+    Returns the Shapiro-Wilk W statistic of each row of sorted values
+    """
+    n = sorted_values.shape[1]
+    a = _shapiro_coefficients(n)
+    half = len(a)
+    differences = sorted_values[:, ::-1][:, :half] - sorted_values[:, :half]
+    centered = sorted_values - sorted_values.mean(axis=1)[:, None]
+    return sp.dot(differences, a) ** 2 / (centered ** 2).sum(axis=1)
+
+def _shapiro_coefficients(n):
+    """
+    Returns the first half of the Shapiro-Wilk coefficients for n values
+    using Royston's approximation (as done by scipy's swilk)
+    """
+    if n < 3:
+        raise ValueError('Data must be at least length 3.')
+    if n == 3:
+        return sp.array([sp.sqrt(0.5)])
+    half = n // 2
+    m = -special.ndtri((sp.arange(1, half + 1) - 0.375) / (n + 0.25))
+    summ2 = 2 * sp.sum(m ** 2)
+    ssumm2 = sp.sqrt(summ2)
+    rsn = 1.0 / sp.sqrt(n)
+    a = m / ssumm2
+    a[0] = sp.polyval(_SW_C1, rsn) + m[0] / ssumm2
+    if n > 5:
+        a[1] = sp.polyval(_SW_C2, rsn) + m[1] / ssumm2
+        fac = sp.sqrt((summ2 - 2 * m[0] ** 2 - 2 * m[1] ** 2) / (1 - 2 * a[0] ** 2 - 2 * a[1] ** 2))
+        a[2:] = m[2:] / fac
+    else:
+        fac = sp.sqrt((summ2 - 2 * m[0] ** 2) / (1 - 2 * a[0] ** 2))
+        a[1:] = m[1:] / fac
+    return a
+
+def transform_all(values, transformations=SUPPORTED_TRANSFORMATIONS, standard=True):
+    """
+    Returns a dictionary with the transformed values for each of the transformations
+    (None if the transformation can not be applied).
+    The values are converted and shifted only once for all transformations
+    """
+    a = sp.array(values, dtype=float)
+    if standard:
+        shifted = (a - a.min()) + 0.1 * a.var()
+    else:
+        shifted = a
+    results = {}
+    for transformation in transformations:
+        if transformation == 'no':
+            results[transformation] = a
+        elif transformation == 'sqrt':
+            results[transformation] = sp.sqrt(shifted)
+        elif transformation == 'log':
+            results[transformation] = sp.log(shifted)
+        elif transformation == 'sqr':
+            results[transformation] = shifted * shifted
+        elif transformation == 'ascombe':
+            results[transformation] = 2.0 * sp.sqrt(a + 3.0 / 8.0)
+        elif transformation == 'arcsin_sqrt':
+            results[transformation] = _arcsin_sqrt_transform(a)
+        elif transformation == 'box_cox':
+            results[transformation] = _box_cox(shifted)
+        else:
+            raise Exception('Transformation %s unknown' % transformation)
+    return results
+
 def calculate_sp_pval(values):
-    r = stats.shapiro(values)
+    r = shapiro_test(values)
     if sp.isfinite(r[0]):
         sp_pval = r[1]
     else:
         sp_pval = 0.0
     return sp_pval
 
+def histogram(values, bins=HISTOGRAM_BINS):
+    """Returns the bin edges and counts of a histogram of the finite values with the number of bins"""
+    counts, edges = sp.histogram(values, bins=bins)
+    return {'edges': edges.tolist(), 'counts': counts.tolist()}
+
+def quantiles(values, percents):
+    """Returns the quantiles of the finite values at the percents"""
+    return [float(q) for q in sp.percentile(values, percents)]
+
+def shapiro_test(values):
+    """Returns the Shapiro-Wilk test statistic and p-value of the values"""
+    a = sp.array(values, dtype=float)
+    std = a.std()
+    # stats.shapiro works in single precision and loses values with a small spread
+    # relative to their magnitude (e.g. Box-Cox with negative lambdas). W does not
+    # change with scale and location, so the values are standardized first
+    if std > 0 and sp.isfinite(std):
+        a = (a - a.mean()) / std
+    return stats.shapiro(a)
+
+def describe(values, bins=HISTOGRAM_BINS, max_value_counts=MAX_VALUE_COUNTS):
+    """
+    Returns the distribution statistics of the values: count, mean, variance,
+    quartiles, a histogram with a fixed number of bins, the Shapiro-Wilk test
+    and the counts of the distinct values if there are at most max_value_counts
+    """
+    a = sp.array(values, dtype=float)
+    a = a[sp.isfinite(a)]
+    result = {'count': len(a), 'mean': None, 'variance': None, 'quantiles': None,
+              'value_counts': None, 'histogram': None,
+              'shapiro_test_statistic': None, 'shapiro_p_value': None}
+    if len(a) == 0:
+        return result
+    result['mean'] = float(a.mean())
+    if len(a) > 1:
+        result['variance'] = float(a.var(ddof=1))
+    result['quantiles'] = quantiles(a, [0, 25, 50, 75, 100])
+    result['histogram'] = histogram(a, bins)
+    distinct, distinct_counts = sp.unique(a, return_counts=True)
+    if len(distinct) <= max_value_counts:
+        result['value_counts'] = zip(distinct.tolist(), distinct_counts.tolist())
+    if len(a) >= 3:
+        w, pval = shapiro_test(a)
+        if sp.isfinite(w):
+            result['shapiro_test_statistic'] = float(w)
+            result['shapiro_p_value'] = float(pval)
+    return result
+
 
@@ -0,0 +1,70 @@
+"""
+Pre-binned summaries of the values of a phenotype or RNASeq for the detail plots.
+The histogram and the quantiles are computed like the stored statistics (see utils.statistics)
+"""
+import json
+
+import numpy as np
+
+from django.db.models import Avg, Count
+from utils.statistics import HISTOGRAM_BINS, histogram, quantiles
+
+MAX_BINS = 200
+
+QUANTILES = (0, 5, 25, 50, 75, 95, 100)
+
+
+def get_value_summary(phenotype, rnaseq=False, bins=HISTOGRAM_BINS):
+    """
+    Returns the histogram, the quantiles and the number of values and mean
+    per country of the values of a phenotype or RNASeq in one query
+    """
+    if rnaseq:
+        value_set = phenotype.rnaseqvalue_set
+    else:
+        value_set = phenotype.phenotypevalue_set
+    rows = list(value_set.values_list('value', 'obs_unit__accession__country'))
+    values = np.array([value for value, _ in rows], dtype=np.float64)
+    countries = [country or '' for _, country in rows]
+    return summarize_values(values, countries, bins)
+
+
+def summarize_values(values, countries, bins=HISTOGRAM_BINS):
+    """
+    Returns the histogram with the number of bins, the quantiles and the
+    number of values and mean per country of the values
+    """
+    bins = max(1, min(int(bins), MAX_BINS))
+    present = np.isfinite(values)
+    values = values[present]
+    countries = np.array(countries, dtype=object)[present]
+    summary = {'count': len(values), 'histogram': None, 'quantiles': None, 'countries': []}
+    if len(values) == 0:
+        return summary
+    summary['histogram'] = histogram(values, bins)
+    summary['quantiles'] = dict(('%s' % q, value) for q, value in zip(QUANTILES, quantiles(values, QUANTILES)))
+    names, index = np.unique(countries, return_inverse=True)
+    country_counts = np.bincount(index)
+    country_means = np.bincount(index, values) / country_counts
+    summary['countries'] = [{'country': name, 'count': int(count), 'mean': float(mean)}
+                            for name, count, mean in zip(names.tolist(), country_counts, country_means)
+                            if name]
+    return summary
+
+
+def get_page_summary(phenotype, statistics, rnaseq=False):
+    """
+    Returns the summary of the detail page of a phenotype or RNASeq with the histogram
+    of its StatisticsResult and the number of values and mean per country aggregated
+    in the database
+    """
+    if rnaseq:
+        value_set = phenotype.rnaseqvalue_set
+    else:
+        value_set = phenotype.phenotypevalue_set
+    rows = (value_set.values('obs_unit__accession__country').order_by('obs_unit__accession__country')
+            .annotate(count=Count('id'), mean=Avg('value')))
+    return {'count': statistics.count,
+            'histogram': json.loads(statistics.histogram) if statistics.histogram else None,
+            'countries': [{'country': row['obs_unit__accession__country'], 'count': row['count'], 'mean': row['mean']}
+                          for row in rows if row['obs_unit__accession__country']]}